@@ -0,0 +1,85 @@
+""" cache.py -- a small bounded LRU cache that counts how well it's doing.
+
+Log traffic is extremely repetitive: a few user agents, referers and client
+addresses make up most of the hits.  Caching the work we do on them pays off,
+but only if the cache can't grow without bound and we can tell whether it's
+earning its keep.
+
+This only depends on the standard library so the sender can use it too.
+"""
+
+_missing = object()
+
+
+class LRUCache(object):
+    """ Holds up to `size` entries, throwing out the least recently used.
+
+    The textbook LRU (a dict plus a linked list) costs more per hit in python
+    than the md5 of a short string, which defeats the point.  So this is the
+    usual two generation approximation: new entries go into `young`, and when
+    that holds half of `size`, `old` is thrown out and `young` takes its
+    place.  A hit in `old` moves the entry back into `young`.  Whatever was
+    used since the last turnover survives it, and a hit costs one dict
+    lookup.
+
+    There's no lock.  Two threads racing can at worst lose an entry or a
+    count, which only ever costs a miss.
+    """
+
+    def __init__(self, size):
+        if size < 2:
+            raise ValueError("An LRUCache needs room for at least two entries")
+
+        self.size = size
+        self.generation = size / 2
+        self.young = {}
+        self.old = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def __contains__(self, key):
+        return key in self.young or key in self.old
+
+    def get(self, key, default=None):
+        """ Return the value for `key` (and count a hit) or `default` (and
+        count a miss). """
+
+        value = self.young.get(key, _missing)
+        if value is _missing:
+            value = self.old.pop(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.put(key, value)
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Remember `value` for `key`, turning the generations over if the
+        young one is full. """
+
+        self.young[key] = value
+        if len(self.young) >= self.generation:
+            self.evictions += len(self.old)
+            self.old, self.young = self.young, {}
+
+    def clear(self):
+        self.young, self.old = {}, {}
+
+    def stats(self):
+        """ Return a dict of counters, plus the hit rate so far. """
+        lookups = self.hits + self.misses
+        return {
+            'size': self.size,
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': lookups and float(self.hits) / lookups,
+        }
@@ -38,24 +38,31 @@ Diagram::
 |                           |
 |                           V
 |                  NarcissusPlotWidget
+
+When the log-sender parses lines itself (``--preparse``) the records arrive on
+``httpdlight_http_parsed`` instead and :class:`PreParsedHttpLightConsumer`
+takes the place of :class:`HttpLightConsumer` above.
 """
 
 from moksha.api.hub import Consumer
 from moksha.api.hub.producer import PollingProducer
 from pprint import pformat
-from pygeoip import GeoIP
-from pygeoip.const import GEOIP_MEMORY_CACHE
 from datetime import timedelta, datetime
-from hashlib import md5
 from subprocess import Popen, PIPE, STDOUT
 from pyrrd.rrd import DataSource, RRD, RRA
+from paste.deploy.converters import asbool, asint
 
 import narcissus.model as m
+import narcissus.parsers
+import narcissus.counters
+import narcissus.sketches
+import narcissus.geo
+import narcissus.workers
+import narcissus.wire
 
-import itertools
 import geojson
 import simplejson
-import threading
+import base64
 import time
 import re
 import os
@@ -100,10 +107,124 @@ rrd_categories = [
 # TODO -- pull this from configuration
 rrd_dir = os.getcwd() + '/rrds'
 
-PAIRED = '__paired__'
+PAIRED = narcissus.counters.PAIRED
+UNIQUE = '__unique__'
 AGGREGATE = 'aggregate'
 
 
+def load_wire_dictionaries(config):
+    """ Register the extra compression dictionaries our log-senders use.
+
+    These are listed, whitespace separated, as `narcissus.wire.dictionaries`
+    in the hub's config.  The built-in dictionary is always available.
+    """
+
+    for path in config.get('narcissus.wire.dictionaries', '').split():
+        dict_id = narcissus.wire.load_dictionary(path)
+        log.info("Loaded wire dictionary %s from %s" % (dict_id, path))
+
+
+def log_format_for(config, topic):
+    """ Return the log format spec of raw lines on `topic`.
+
+    That's `narcissus.log_format.<topic>` in the hub's config, falling back to
+    `narcissus.log_format` and then httpd-light's own format.  See
+    :func:`narcissus.parsers.get_format`.
+    """
+
+    return config.get('narcissus.log_format.' + topic,
+                      config.get('narcissus.log_format', 'lighttpd'))
+
+
+def configure_geo(config):
+    """ Set up this process's :class:`narcissus.geo.Locator` from the hub's
+    config: `narcissus.geoip.path`, `narcissus.geoip.cache`,
+    `narcissus.geoip.cache_size`, `narcissus.geoip.index`,
+    `narcissus.geoip.negative_cache_size` and `narcissus.geoip.resolution`.
+    """
+
+    sizes = []
+    for key in ['cache_size', 'negative_cache_size']:
+        size = config.get('narcissus.geoip.' + key)
+        sizes.append(size if size is None else asint(size))
+
+    return narcissus.geo.configure(config.get('narcissus.geoip.path'),
+                                   config.get('narcissus.geoip.cache'),
+                                   sizes[0],
+                                   config.get('narcissus.geoip.index'),
+                                   sizes[1],
+                                   config.get('narcissus.geoip.resolution'))
+
+
+def unresolved_log_for(config, logger, what="hits could not be geolocated"):
+    """ A :class:`narcissus.geo.UnresolvedLog` for `logger`, summing up
+    every `narcissus.geoip.log_interval` seconds (60 by default). """
+
+    interval = asint(config.get('narcissus.geoip.log_interval', 60))
+    return narcissus.geo.UnresolvedLog(logger, what, interval)
+
+
+def digest_for(config):
+    """ Return the digest name and cache size for the 'refererhash' of hits.
+
+    That's `narcissus.refererhash.digest` and
+    `narcissus.refererhash.cache_size` in the hub's config.  See
+    :func:`narcissus.parsers.set_digest`.
+    """
+
+    return (config.get('narcissus.refererhash.digest', 'md5'),
+            asint(config.get('narcissus.refererhash.cache_size', 1024)))
+
+
+def worker_pool_for(config, task, publish, log_format='lighttpd'):
+    """ Return a :class:`narcissus.workers.WorkerPool` running `task`, or
+    None if `narcissus.workers` in the hub's config doesn't ask for one. """
+
+    processes = asint(config.get('narcissus.workers', 0))
+    if not processes:
+        return None
+
+    pool = narcissus.workers.WorkerPool(
+        processes, task, publish, log_format,
+        ordered=asbool(config.get('narcissus.workers.ordered', True)),
+        batch_lines=asint(config.get('narcissus.workers.batch_lines', 500)),
+        batch_ms=asint(config.get('narcissus.workers.batch_ms', 100)),
+        digest=digest_for(config),
+        batch_timeout=asint(config.get('narcissus.workers.batch_timeout', 60)),
+        max_batches=asint(config.get('narcissus.workers.max_batches', 0)))
+    log.info("Started %i workers for %s" % (processes, task.__name__))
+    return pool
+
+
+def pairs_for(config):
+    """ Return the pairs of categories to count hits by, from
+    `narcissus.timeseries.pairs` in the hub's config ("country:tag,
+    tag:country"), or None for every ordered pair. """
+
+    spec = config.get('narcissus.timeseries.pairs')
+    if spec is None:
+        return None
+    return [tuple(pair.split(':')) for pair in spec.replace(',', ' ').split()]
+
+
+def topk_for(config, frequency):
+    """ Return ``{category: narcissus.sketches.TopK}`` for the categories
+    that only keep their busiest keys, `narcissus.timeseries.topk.<category>`
+    of them.  Polled every `frequency` seconds, their counts fade with a half
+    life of `narcissus.timeseries.topk.half_life` seconds (an hour by
+    default). """
+
+    half_life = asint(config.get('narcissus.timeseries.topk.half_life', 3600))
+    decay = 0.5 ** (float(frequency) / half_life) if half_life else 1.0
+
+    heavy_hitters = {}
+    for category in rrd_categories:
+        k = config.get('narcissus.timeseries.topk.' + category)
+        if k:
+            heavy_hitters[category] = narcissus.sketches.TopK(asint(k), decay)
+    return heavy_hitters
+
+
 def bobby_droptables(msg):
     """ Return true if `msg` might be Bobby's cousin. """
 
@@ -114,45 +235,68 @@ def bobby_droptables(msg):
 
     return False
 
-_bucket_lock = threading.Lock()
-_bucket = {}
-def _dump_bucket():
-    """ Returns and flushes the _bucket for the current timestep. """
-    global _bucket_lock
-    global _bucket
-    with _bucket_lock:
-        retval = _bucket
-        _bucket = {}
-    return retval
+# Hit counts for the current timestep, bumped by every TimeSeriesConsumer
+# thread without waiting on the others (see narcissus.counters).  Keys are
+# (category, key) or (PAIRED, cat1, cat2, key1, key2).
+_bucket = narcissus.counters.ShardedCounter()
+
+def _dump_bucket(heavy_hitters=None):
+    """ Returns and flushes the _bucket for the current timestep, as
+    ``{category: {key: count}}``, plus ``{(cat1, cat2): {(key1, key2):
+    count}}`` under PAIRED for the pairs of categories counted together
+    (each of them one way round only; see
+    :class:`narcissus.counters.ExtractionPlan`).
+
+    Categories in `heavy_hitters` (see :func:`topk_for`) only keep their
+    busiest keys, paired or not; the rest are rolled up into
+    :data:`narcissus.sketches.OTHER`. """
+    bucket, paired = {}, {}
+    for path, count in _bucket.dump().iteritems():
+        if path[0] == PAIRED:
+            paired[path[1:]] = count
+        else:
+            bucket.setdefault(path[0], {})[path[1]] = count
+
+    if heavy_hitters:
+        for category, topk in heavy_hitters.iteritems():
+            if category in bucket:
+                bucket[category] = topk.fold(bucket[category])
+
+    if paired:
+        grouped = {}
+        for (cat1, cat2, key1, key2), count in paired.iteritems():
+            if heavy_hitters:
+                if cat1 in heavy_hitters:
+                    key1 = heavy_hitters[cat1].name(key1)
+                if cat2 in heavy_hitters:
+                    key2 = heavy_hitters[cat2].name(key2)
+            counts = grouped.setdefault((cat1, cat2), {})
+            counts[key1, key2] = counts.get((key1, key2), 0) + count
+        bucket[PAIRED] = grouped
+    return bucket
+
+def _dump_uniques(heavy_hitters=None):
+    """ Returns and flushes the unique client sketches for the current
+    timestep, as ``{(category, key): HyperLogLog}``.  Keys that aren't among
+    the busiest of their category (see :func:`_dump_bucket`) are merged into
+    :data:`narcissus.sketches.OTHER`. """
+    uniques = {}
+    for (category, key), sketch in _bucket.dump_uniques().iteritems():
+        if heavy_hitters and category in heavy_hitters:
+            key = heavy_hitters[category].name(key)
+        if (category, key) in uniques:
+            uniques[category, key].merge(sketch)
+        else:
+            uniques[category, key] = sketch
+    return uniques
 
 def _pump_bucket(category, key):
     """ Increments `key` in for the current timestep.  Thread safe. """
-    global _bucket_lock
-    global _bucket
-    with _bucket_lock:
-        if not category in _bucket:
-            _bucket[category] = {}
-        _bucket[category][key] = _bucket[category].get(key, 0) + 1
+    _bucket.add([(category, key)])
 
 def _pump_paired_bucket(cat1, cat2, key1, key2):
     """ Increments `key1` by `key2` in `cat1` by `cat2`. """
-    global _bucket_lock
-    global _bucket
-    with _bucket_lock:
-        if not PAIRED in _bucket:
-            _bucket[PAIRED] = {}
-
-        if not cat1 in _bucket[PAIRED]:
-            _bucket[PAIRED][cat1] = {}
-
-        if not cat2 in _bucket[PAIRED][cat1]:
-            _bucket[PAIRED][cat1][cat2] = {}
-
-        if not key1 in _bucket[PAIRED][cat1][cat2]:
-            _bucket[PAIRED][cat1][cat2][key1] = {}
-
-        _bucket[PAIRED][cat1][cat2][key1][key2] = \
-                _bucket[PAIRED][cat1][cat2][key1].get(key2, 0) + 1
+    _bucket.add([(PAIRED, cat1, cat2, key1, key2)])
 
 class TimeSeriesProducer(PollingProducer):
     """ PollingProducer responsible for building time-series.
@@ -175,7 +319,22 @@ class TimeSeriesProducer(PollingProducer):
 
     def __init__(self, *args, **kw):
         super(TimeSeriesProducer, self).__init__(*args, **kw)
+        # Only for its views: which pairs of categories we log, which way
+        # round.
+        self.plan = narcissus.counters.ExtractionPlan(
+            key_extractors, rrd_categories, pairs_for(self.hub.config))
+        self.heavy_hitters = topk_for(self.hub.config, self.frequency.seconds)
+        self.uniques = asbool(self.hub.config.get(
+            'narcissus.timeseries.uniques', False))
+        self.unique_windows = dict(
+            [(name, narcissus.sketches.UniqueWindows())
+             for name in rrd_categories])
+        self.uniques_save_interval = asint(self.hub.config.get(
+            'narcissus.timeseries.uniques.save_interval', 60))
+        self.uniques_saved = time.time()
         self.rrdtool_setup()
+        if self.uniques:
+            self.load_uniques()
         self.history = dict(
             [(name, {AGGREGATE : self._make_empty_hist()})
              for name in rrd_categories]
@@ -188,7 +347,13 @@ class TimeSeriesProducer(PollingProducer):
         return [[i, series[i]] for i in range(self.n_timesteps)]
 
     def poll(self):
-        __bucket = _dump_bucket()
+        # Tallies of hits that went nowhere go out on time, even once the
+        # failures have stopped coming.
+        narcissus.geo.tick_unresolved()
+
+        __bucket = _dump_bucket(self.heavy_hitters)
+        if self.uniques:
+            self.process_uniques(_dump_uniques(self.heavy_hitters))
         for key in __bucket.keys():
             if key is PAIRED:
                 self.process_paired_bucket(__bucket[key])
@@ -199,17 +364,98 @@ class TimeSeriesProducer(PollingProducer):
                 )
 
     def process_paired_bucket(self, paired):
-        for cat1 in paired.keys():
-            for cat2 in paired[cat1].keys():
-                for key1 in paired[cat1][cat2].keys():
-                    for key2 in paired[cat1][cat2][key1].keys():
-                        value = paired[cat1][cat2][key1][key2]
-                        self.rrdtool_log_paired(value, cat1, cat2, key1, key2)
+        """ Log every pair of categories, both ways round if asked to, from
+        the one way round it was counted. """
+        for cat1, cat2 in self.plan.views:
+            if (cat1, cat2) in paired:
+                for (key1, key2), count in paired[cat1, cat2].iteritems():
+                    self.rrdtool_log_paired(count, cat1, cat2, key1, key2)
+            elif (cat2, cat1) in paired:
+                for (key2, key1), count in paired[cat2, cat1].iteritems():
+                    self.rrdtool_log_paired(count, cat1, cat2, key1, key2)
 
         # TODO -- As yet unimplemented!!!
         # send off the appropriate amqp stuff for any listening live
         # widgets (of which there are as yet none).
 
+    def process_uniques(self, uniques):
+        """ Add up a timestep's unique clients over the hour and the day, and
+        log how many each key had to rrdtool. """
+
+        now = time.time()
+        for category, windows in self.unique_windows.iteritems():
+            for span, start, sketches in windows.roll(now):
+                self.save_uniques(category, span, start, sketches)
+
+        for (category, key), sketch in uniques.iteritems():
+            self.unique_windows[category].add(key, sketch)
+            self.rrdtool_log_unique(sketch.estimate(), category, key)
+
+        if now - self.uniques_saved >= self.uniques_save_interval:
+            self.save_current_uniques()
+
+    def uniques_filename(self, category, span, start):
+        return '%s/%s/%s/%s-%i.json' % (rrd_dir, UNIQUE, category, span, start)
+
+    def save_uniques(self, category, span, start, sketches):
+        """ Keep the sketches of a window, so its clients can be counted (or
+        merged with others) later.  A window that's still going is saved
+        again, over the top, until it closes. """
+
+        filename = self.uniques_filename(category, span, start)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Never leave half a file behind for load_uniques to choke on.
+        with open(filename + '.tmp', 'w') as f:
+            simplejson.dump(dict(
+                (key, base64.b64encode(sketch.dumps()))
+                for key, sketch in sketches.iteritems()), f)
+        os.rename(filename + '.tmp', filename)
+
+    def save_current_uniques(self):
+        """ Save the hour and day so far, to pick up after a restart. """
+        for category, windows in self.unique_windows.iteritems():
+            for span, start, sketches in windows.current():
+                self.save_uniques(category, span, start, sketches)
+        self.uniques_saved = time.time()
+
+    def load_uniques(self):
+        """ Pick up the hour and day an earlier run saved, if they're still
+        going. """
+
+        now = time.time()
+        for category, windows in self.unique_windows.iteritems():
+            for span, seconds in windows.spans:
+                start = int(now) - int(now) % seconds
+                filename = self.uniques_filename(category, span, start)
+                if not os.path.exists(filename):
+                    continue
+
+                try:
+                    with open(filename) as f:
+                        saved = simplejson.load(f)
+                    sketches = dict(
+                        (key.encode('utf-8'), narcissus.sketches.HyperLogLog.
+                         loads(base64.b64decode(data)))
+                        for key, data in saved.iteritems())
+                    windows.resume(span, start, sketches, now)
+                except (IOError, ValueError, TypeError) as e:
+                    log.warn("Can't pick up unique clients from %s: %s" % (
+                        filename, e))
+                    continue
+                log.info("Picked up %i keys' unique clients from %s" % (
+                    len(sketches), filename))
+
+    def stop(self):
+        if self.uniques:
+            self.save_current_uniques()
+
+        stop = getattr(super(TimeSeriesProducer, self), 'stop', None)
+        if stop:
+            stop()
+
     def process_bucket(self, series_name, bucket):
         topic = 'http_counts_' + series_name
 
@@ -237,6 +483,12 @@ class TimeSeriesProducer(PollingProducer):
         for key in bucket.keys():
             self.history[series_name][key][-1] = bucket[key]
 
+        # Keys that dropped out of the top-K go once they've scrolled off.
+        if series_name in self.heavy_hitters:
+            for key, series in self.history[series_name].items():
+                if key != AGGREGATE and not any(series):
+                    del self.history[series_name][key]
+
         # Convert from convenient 'self.history' internal repr to flot json
         json = {'data':[]}
         for key, series in self.history[series_name].iteritems():
@@ -253,6 +505,13 @@ class TimeSeriesProducer(PollingProducer):
                 'label': key
             })
 
+        # How many different clients each key has had this hour and today.
+        if self.uniques:
+            windows = self.unique_windows[series_name]
+            json['uniques'] = dict(
+                (key, windows.estimates(key))
+                for key in self.history[series_name] if key != AGGREGATE)
+
         self.send_message(topic, [json])
 
     def rrdtool_setup(self):
@@ -351,6 +610,17 @@ class TimeSeriesProducer(PollingProducer):
         filename = "/".join([rrd_dir, PAIRED, cat1, cat2, key1, key2 + '.rrd'])
         self._rrdtool_log(count, filename)
 
+    def rrdtool_log_unique(self, count, category, key):
+        """ Log how many different clients `key` had in a timestep """
+
+        key = self.safe_key(key)
+
+        if category not in rrd_categories:
+            raise ValueError, "Invalid category %s" % category
+
+        filename = "/".join([rrd_dir, UNIQUE, category, key + '.rrd'])
+        self._rrdtool_log(count, filename)
+
     def rrdtool_log(self, count, category, key):
         """ Log a message to an category's corresponding rrdtool databse """
 
@@ -396,29 +666,49 @@ class TimeSeriesConsumer(Consumer):
     topic = 'http_latlon'
     jsonify = True
 
+    def __init__(self, *args, **kw):
+        super(TimeSeriesConsumer, self).__init__(*args, **kw)
+        self.plan = narcissus.counters.ExtractionPlan(
+            key_extractors, rrd_categories, pairs_for(self.hub.config))
+        self.uniques = asbool(self.hub.config.get(
+            'narcissus.timeseries.uniques', False))
+
     def consume(self, message):
         """ Drop message metrics about country and filename into a bucket """
         if not message:
             return
 
-        for category in rrd_categories:
-            # key_extractors is a dict of callables
-            key = key_extractors[category](message['body'])
-            if key:
-                _pump_bucket(category, key)
-
-        for cat1, cat2 in itertools.product(rrd_categories, rrd_categories):
-            if cat1 == cat2:
-                # No point in pairing something with itself
-                continue
+        # Each key extractor runs once, and everything this message counts
+        # towards is bumped in one go.
+        plan = self.plan
+        body = message['body']
+        values = plan.extract(body)
+        if self.uniques and body.get('ip'):
+            _bucket.add(plan.keys(values),
+                        narcissus.sketches.hll_position(body['ip']),
+                        plan.singles(values))
+        else:
+            _bucket.add(plan.keys(values))
+
+
+class PooledConsumer(Consumer):
+    """ A consumer that may hand its work to a worker pool (see
+    :func:`worker_pool_for`).  The pool goes down with the hub: whatever it
+    has pending is published, and its processes and threads are joined. """
+
+    pool = None
 
-            key1 = key_extractors[cat1](message['body'])
-            key2 = key_extractors[cat2](message['body'])
-            if key1 and key2:
-                _pump_paired_bucket(cat1, cat2, key1, key2)
+    def stop(self):
+        if self.pool:
+            self.pool.close()
+            self.pool = None
 
+        stop = getattr(super(PooledConsumer, self), 'stop', None)
+        if stop:
+            stop()
 
-class RawIPConsumer(Consumer):
+
+class RawIPConsumer(PooledConsumer):
     """ Consumes dummy objects for testing like:
         {
             'ip': 'some_ip',
@@ -429,9 +719,15 @@ class RawIPConsumer(Consumer):
     topic = 'narcissus.hits'
     jsonify = True
 
-    geoip_url = '/'.join(__file__.split('/')[:-1] +
-                         ["public/data/GeoLiteCity.dat"])
-    gi = GeoIP(geoip_url, GEOIP_MEMORY_CACHE)
+    # What the worker processes do for us, if we have any.
+    worker_task = staticmethod(narcissus.workers.locate_hits)
+
+    def __init__(self, *args, **kwargs):
+        super(RawIPConsumer, self).__init__(*args, **kwargs)
+        configure_geo(self.hub.config)
+        self.unresolved = unresolved_log_for(self.hub.config, self.log)
+        self.pool = worker_pool_for(self.hub.config, self.worker_task,
+                                    self.publish_batch)
 
     def consume(self, message):
         if not message:
@@ -440,28 +736,34 @@ class RawIPConsumer(Consumer):
         #self.log.info("%r got message '%r'" % (self, message))
         message = simplejson.loads(message['body'])
 
-        # Get IP 2 LatLon info
-        rec = self.gi.record_by_addr(message['ip'])
-
-        if not(rec and rec['latitude'] and rec['longitude']):
-            self.log.warn("Failed to geo-encode %r" % message)
+        if self.pool:
+            self.pool.submit([message])
             return
 
-        updates = {
-            'lat'           : rec['latitude'],
-            'lon'           : rec['longitude'],
-            'country'       : rec.get('country_name', 'undefined'),
-        }
-        message.update(updates)
+        # Get IP 2 LatLon info
+        if not narcissus.geo.locate(message):
+            self.unresolved.add(1, message)
+            return
 
         self.send_message('http_latlon', message)
 
-class HttpLightConsumer(Consumer):
+    def publish_batch(self, hits, failed, error):
+        """ Send along a batch of hits geolocated by the workers """
+        if error:
+            self.log.error("%r workers failed: %s" % (self, error))
+        elif failed:
+            self.unresolved.add(failed)
+
+        for hit in hits:
+            self.send_message('http_latlon', hit)
+
+class HttpLightConsumer(PooledConsumer):
     """ Main entry point of raw log messages.
 
     Responsible for:
 
-        - Parsing raw logs
+        - Parsing raw logs (httpd-light's format, unless the config says
+          otherwise; see :func:`log_format_for`)
         - Logging to sqlalchemy
         - Sending parsed objects to other consumers
 
@@ -471,83 +773,114 @@ class HttpLightConsumer(Consumer):
     topic = 'httpdlight_http_rawlogs'
     jsonify = False
 
-    geoip_url = '/'.join(__file__.split('/')[:-1] +
-                         ["public/data/GeoLiteCity.dat"])
-    gi = GeoIP(geoip_url, GEOIP_MEMORY_CACHE)
+    # What the worker processes do for us, if we have any.
+    worker_task = staticmethod(narcissus.workers.parse_lines)
 
     def __init__(self, *args, **kwargs):
-        self.llre = re.compile('^(\d+\.\d+\.\d+\.\d+)\s(\S+)\s(\S+)\s\[(\S+\s\S+)\]\s"(\S+)\s(\S+)\s(\S+)"\s(\d+)\s(\d+)\s"(\S+)"\s"(.+)"\s(\d+)\s(\d+)$')
         super(HttpLightConsumer, self).__init__(*args, **kwargs)
+        load_wire_dictionaries(self.hub.config)
+        configure_geo(self.hub.config)
+        self.unresolved = unresolved_log_for(
+            self.hub.config, self.log, "lines could not be parsed or geolocated")
+        narcissus.parsers.set_digest(*digest_for(self.hub.config))
+        spec = log_format_for(self.hub.config, self.topic)
+        self.log_format = narcissus.parsers.get_format(spec)
+        self.pool = worker_pool_for(self.hub.config, self.worker_task,
+                                    self.publish_batch, spec)
 
     def consume(self, message):
         """ Main entry point for messages from the log-sender """
         if not message:
             #self.log.warn("%r got empty message." % self)
             return
-        self.log.info("%r got message '%r'" % (self, message))
+        # Messages are whole (often zlib'd) batches of lines now; far too
+        # much to log on every delivery.
+        #self.log.info("%r got message '%r'" % (self, message))
 
-        regex_result = self.llre.match(message.body)
+        # The log-sender may have packed many lines into a single message.
+        try:
+            lines = narcissus.wire.unpack(message.body)
+        except ValueError as e:
+            self.log.warn("%r could not unpack message: %s" % (self, e))
+            return
 
-        # TODO -- this should pass off messages to the RawIPConsumer now
-        raise NotImplementedError("this code needs to be updated")
+        # Let the workers do the heavy lifting, if we have any.
+        if self.pool:
+            self.pool.submit(lines)
+            return
 
-        if regex_result and regex_result.group(1):
-            # Get IP 2 LatLon info
-            rec = self.gi.record_by_addr(regex_result.group(1))
-            if rec and rec['latitude'] and rec['longitude']:
+        for line in lines:
+            self.consume_line(line)
 
-                # Strip the timezone from the logged timestamp.  Python can't
-                # parse it.
-                no_timezone = regex_result.group(4).split(" ")[0]
+    def consume_line(self, line):
+        """ Parse and geo-encode a single raw log line """
+        record = self.log_format.parse(line)
+        if record:
+            self.publish_hit(record)
+        else:
+            self.unresolved.add(1, line)
 
-                try:
-                    # Format the log timestamp into a python datetime object
-                    log_date = datetime.strptime(
-                        no_timezone, "%d/%b/%Y:%H:%M:%S")
-                except ImportError as e:
-                    # There was some thread error.  Crap.
-                    self.log.warn(str(e))
-                    return
-
-                # Build a big python dictionary that we're going to stream
-                # around town (and use to build a model.ServerHit object.
-                obj = {
-                    'ip'            : regex_result.group(1),
-                    'lat'           : rec['latitude'],
-                    'lon'           : rec['longitude'],
-                    'country'       : rec.get('country_name', 'undefined'),
-                    'logdatetime'   : log_date,
-                    'requesttype'   : regex_result.group(5),
-                    'filename'      : regex_result.group(6),
-                    'tag'           : regex_result.group(6),
-                    'httptype'      : regex_result.group(7),
-                    'statuscode'    : regex_result.group(8),
-                    'filesize'      : regex_result.group(9),
-                    'refererhash'   : md5(regex_result.group(11)).hexdigest(),
-                    'bytesin'       : regex_result.group(12),
-                    'bytesout'      : regex_result.group(13),
-                }
-
-                # XXX - Commenting this out since we never really use it.
-                ## Now log to the DB.  We're doing this every hit which will be slow.
-                #hit = m.ServerHit(**obj)
-                #self.DBSession.add(hit)
-                #self.DBSession.commit()
-
-                # python datetime objects are not JSON serializable
-                # We should make this more readable on the other side
-                obj['logdatetime'] = str(obj['logdatetime'])
-
-                #self.log.debug("%r built %s" % (self, pformat(obj)))
-                self.send_message('http_latlon', simplejson.dumps(obj))
-                self.send_message('graph_info', simplejson.dumps(
-                    dict((key, obj[key]) for key in ['country', 'tag'])
-                ))
+    def publish_hit(self, obj):
+        """ Geo-encode a parsed hit record and send it along its way """
 
-            else:
-                self.log.warn("%r failed on '%s'" % (self, message))
-        else:
-            self.log.warn("other failure.")
+        # Get IP 2 LatLon info.  That makes this a big python dictionary
+        # that we're going to stream around town (and use to build a
+        # model.ServerHit object).
+        if not narcissus.geo.locate(obj):
+            self.unresolved.add(1, obj)
+            return
+
+        self.send_hit(obj)
+
+    def publish_batch(self, hits, failed, error):
+        """ Send along a batch of hits parsed and geolocated by the workers """
+        if error:
+            self.log.error("%r workers failed: %s" % (self, error))
+        elif failed:
+            self.unresolved.add(failed)
+
+        for hit in hits:
+            self.send_hit(hit)
+
+    def send_hit(self, obj):
+        """ Send a geo-encoded hit record on to everybody that wants it """
+
+        # XXX - Commenting this out since we never really use it.
+        ## Now log to the DB.  We're doing this every hit which will be slow.
+        #hit = m.ServerHit(**obj)
+        #self.DBSession.add(hit)
+        #self.DBSession.commit()
+
+        # The hub json-encodes whatever we send, so send plain objects just
+        # like the RawIPConsumer does.  (Pre-encoding them here meant the
+        # TimeSeriesConsumer got a string instead of a dict.)
+        #self.log.debug("%r built %s" % (self, pformat(obj)))
+        self.send_message('http_latlon', obj)
+        self.send_message('graph_info',
+            dict((key, obj[key]) for key in ['country', 'tag']))
+
+
+class PreParsedHttpLightConsumer(HttpLightConsumer):
+    """ Entry point for hit records parsed at the edge.
+
+    ``amqp-log-sender.py --preparse`` runs :func:`narcissus.parsers.parse_line`
+    on the monitored machine and ships compact records on their own topic, so
+    all we have left to do here is the geo lookup.  Lines the sender couldn't
+    parse still show up raw on ``httpdlight_http_rawlogs``.
+    """
+
+    topic = 'httpdlight_http_parsed'
+    worker_task = staticmethod(narcissus.workers.unpack_records)
+
+    def consume_line(self, line):
+        """ Unpack a single pre-parsed hit record """
+        try:
+            record = narcissus.parsers.unpack_record(line)
+        except ValueError:
+            self.unresolved.add(1, line)
+            return
+
+        self.publish_hit(record)
 
 class LatLon2GeoJsonConsumer(Consumer):
     topic = 'http_latlon'
@@ -575,19 +908,31 @@ class LogColorizer(Consumer):
         from ansi2html import Ansi2HTMLConverter
         self.converter = Ansi2HTMLConverter()
         super(LogColorizer, self).__init__(*args, **kw)
+        load_wire_dictionaries(self.hub.config)
 
     def consume(self, message):
         if not message:
             return
 
+        # The log-sender may have packed many lines into a single message.
+        try:
+            lines = narcissus.wire.unpack(message.body)
+        except ValueError as e:
+            self.log.warn("%r could not unpack message: %s" % (self, e))
+            return
+
+        for line in lines:
+            self.consume_line(line)
+
+    def consume_line(self, line):
         # Look for dangerous injection stuff
-        if bobby_droptables(message.body):
-            self.log.warn("Bad message %s." % message)
+        if bobby_droptables(line):
+            self.log.warn("Bad message %s." % line)
             return
 
         # Pad the ip so the logs line up nice and straight.
         # This is also slow.  Could we replace this with a regex?
-        ip, host, rest = message.body.split(' ', 2)
+        ip, host, rest = line.split(' ', 2)
         msg = "%16s %17s %s" % (ip, host, rest)
 
         # This has got to be slow as all balls.  Can we do this in pure python?
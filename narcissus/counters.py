@@ -0,0 +1,187 @@
+""" counters.py -- hit counters that threads can bump without queueing up.
+
+Every hit the :class:`narcissus.consumers.TimeSeriesConsumer` sees bumps a
+handful of counters, and the :class:`narcissus.consumers.TimeSeriesProducer`
+collects them all every few seconds.  With one lock around one dict, the
+reactor and every consumer thread took turns at that lock several times a
+hit -- and under the GIL, a contended lock is a lot more expensive than the
+increment it protects.
+
+So each thread gets a :class:`Shard` of its own.  A thread only ever bumps
+its own shard, so its lock is never contended, except in the instant the
+producer swaps the shard's counts out.  :meth:`ShardedCounter.dump` merges
+what it swapped out of every shard.
+
+Counters are keyed by tuples, so what would be nested dicts are flat ones:
+one dict lookup per increment, however deep the key.
+
+Which counters a hit bumps is worked out by an :class:`ExtractionPlan`: every
+category's key is extracted from the hit exactly once, and the single and
+paired counter keys are all built from those.  A pair of categories is only
+counted one way round, however many ways round it's wanted.
+
+Shards can also hold a :class:`narcissus.sketches.HyperLogLog` per key, to
+estimate how many different clients each key had.
+
+This only depends on the standard library.
+"""
+
+from narcissus.sketches import HyperLogLog
+
+import threading
+
+# Counter keys for pairs of categories start with this.
+PAIRED = '__paired__'
+
+
+class Shard(object):
+    """ One thread's counts, and the lock it shares with :meth:`dump`. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.uniques = {}
+        self.thread = threading.current_thread()
+
+
+class ShardedCounter(object):
+    """ Counts occurrences of hashable keys, one shard per thread, and the
+    unique clients of some of them in HyperLogLogs of `precision`. """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+
+    def shard(self):
+        """ Return the calling thread's :class:`Shard`, making one first if
+        need be. """
+
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def add(self, keys, client=None, unique=()):
+        """ Count one more of every key in `keys`.  If the hit's `client` is
+        given, as a :func:`narcissus.sketches.hll_position`, count it as a
+        client of every key in `unique`. """
+
+        shard = self.shard()
+        with shard.lock:
+            counts = shard.counts
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+
+            if client is not None:
+                uniques = shard.uniques
+                for key in unique:
+                    if key not in uniques:
+                        uniques[key] = HyperLogLog(self.precision)
+                    uniques[key].add_position(*client)
+
+    def dump(self):
+        """ Return the counts so far, merged from every shard, and start all
+        of them over from zero. """
+
+        with self.lock:
+            shards = list(self.shards)
+
+        total = {}
+        for shard in shards:
+            # Look before emptying it: a thread that's still alive now could
+            # count some more and exit before we're done here.
+            dead = not shard.thread.is_alive()
+            with shard.lock:
+                counts, shard.counts = shard.counts, {}
+
+            for key, count in counts.iteritems():
+                total[key] = total.get(key, 0) + count
+
+            # Nobody's going to bump this one again.  (Its uniques go once
+            # dump_uniques has had them.)
+            if dead and not shard.uniques:
+                with self.lock:
+                    self.shards.remove(shard)
+
+        return total
+
+    def dump_uniques(self):
+        """ Return ``{key: HyperLogLog}`` of the clients so far, merged from
+        every shard, and start all of them over. """
+
+        with self.lock:
+            shards = list(self.shards)
+
+        total = {}
+        for shard in shards:
+            with shard.lock:
+                uniques, shard.uniques = shard.uniques, {}
+
+            for key, sketch in uniques.iteritems():
+                if key in total:
+                    total[key].merge(sketch)
+                else:
+                    total[key] = sketch
+
+        return total
+
+
+class ExtractionPlan(object):
+    """ Works out every counter a hit counts towards.
+
+    `extractors` maps each of `categories` to a callable that returns the
+    hit's key in that category, or None.  Hits are also counted by `pairs`
+    of categories, ``(cat1, cat2)`` -- by default every ordered pair of two
+    different ones.  Those are kept in :attr:`views`, once each however
+    often they're asked for; :attr:`pairs` only has each pair one way round,
+    the way it's counted.
+    """
+
+    def __init__(self, extractors, categories, pairs=None):
+        self.categories = list(categories)
+        self.extractors = [extractors[category] for category in categories]
+
+        if pairs is None:
+            pairs = [(cat1, cat2) for cat1 in categories
+                     for cat2 in categories if cat1 != cat2]
+
+        # Where each pair's keys are in what extract() returns.
+        position = dict((cat, i) for i, cat in enumerate(self.categories))
+        self.views = []
+        self.pairs = []
+        for pair in pairs:
+            if len(pair) != 2 or pair[0] == pair[1] or \
+               not all(cat in position for cat in pair):
+                raise ValueError("Can't pair up categories %r (have %s)" % (
+                    pair, ", ".join(self.categories)))
+            cat1, cat2 = pair
+            if (cat1, cat2) in self.views:
+                continue
+            self.views.append((cat1, cat2))
+            if (cat2, cat1) not in self.views[:-1]:
+                self.pairs.append((position[cat1], position[cat2], cat1, cat2))
+
+    def extract(self, hit):
+        """ Return `hit`'s key in each category, in order. """
+        return tuple([extract(hit) for extract in self.extractors])
+
+    def singles(self, values):
+        """ Return the ``(category, key)`` counter keys of a hit with
+        category keys `values`, leaving out the pairs. """
+        return [(category, value)
+                for category, value in zip(self.categories, values) if value]
+
+    def keys(self, values):
+        """ Return the counter keys for a hit with category keys `values`
+        (see :meth:`extract`), for :meth:`ShardedCounter.add`. """
+
+        keys = self.singles(values)
+        for i, j, cat1, cat2 in self.pairs:
+            if values[i] and values[j]:
+                keys.append((PAIRED, cat1, cat2, values[i], values[j]))
+        return keys
@@ -0,0 +1,398 @@
+""" geo.py -- where in the world a hit came from.
+
+There is one :class:`Locator` per process (see :func:`locator`).  It doesn't
+open GeoLiteCity.dat until the first lookup, so merely importing
+:mod:`narcissus.consumers` -- which paster does, for the charts -- costs
+nothing.  By default the database is mmap'ed read-only rather than read into
+memory, so every process on the box (the hub and its worker processes, say)
+shares the same pages of it through the OS page cache.
+
+Most hits on a mirror come from the same clients over and over (CI farms,
+distro update bots, big NATs), so a :class:`narcissus.cache.LRUCache` of
+recent answers sits in front of the database.  The ips that *aren't* in there
+are remembered in a cache of their own, so a flood of them can't push the
+good answers out.  Private and reserved addresses (internal monitoring, load
+balancer health checks) are turned away before either cache or the database
+is asked.
+
+Batches of hits (see :mod:`narcissus.workers`) go through
+:meth:`Locator.locate_many`, which uses a precompiled
+:class:`narcissus.geoindex.RangeIndex` when one is configured and falls back
+to looking each hit up on its own when not.  A deployment that only needs to
+know which country hits come from can run at ``'country'`` resolution, off a
+small country level index, without GeoLiteCity.dat in memory at all.
+"""
+
+from pygeoip import GeoIP
+
+from narcissus.cache import LRUCache
+from narcissus.geoindex import RangeIndex, ip_to_int
+
+import pygeoip.const
+import threading
+import weakref
+import time
+import os
+
+import logging
+log = logging.getLogger(__name__)
+
+GEOIP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'public', 'data', 'GeoLiteCity.dat')
+
+# How pygeoip may hold the database: read from disk on every lookup, read
+# into memory, or mmap'ed.
+CACHE_MODES = {
+    'standard': pygeoip.const.GEOIP_STANDARD,
+    'memory': pygeoip.const.GEOIP_MEMORY_CACHE,
+}
+
+# Older pygeoips can't mmap.
+if hasattr(pygeoip.const, 'GEOIP_MMAP_CACHE'):
+    CACHE_MODES['mmap'] = pygeoip.const.GEOIP_MMAP_CACHE
+    DEFAULT_MODE = 'mmap'
+else:
+    DEFAULT_MODE = 'memory'
+
+# How precisely hits are placed: at their city, from GeoLiteCity.dat, or at
+# the centroid of their country, from a country level range index.
+RESOLUTIONS = ('city', 'country')
+
+# How many ips to remember the whereabouts of, and how many to remember
+# nobody knows the whereabouts of.
+DEFAULT_CACHE_SIZE = 65536
+DEFAULT_NEGATIVE_CACHE_SIZE = 16384
+
+# Private, shared, loopback, link local, documentation, benchmarking,
+# multicast and reserved IPv4 space.  None of it is ever in the database.
+RESERVED_NETWORKS = [
+    '0.0.0.0/8',
+    '10.0.0.0/8',
+    '100.64.0.0/10',
+    '127.0.0.0/8',
+    '169.254.0.0/16',
+    '172.16.0.0/12',
+    '192.0.0.0/24',
+    '192.0.2.0/24',
+    '192.168.0.0/16',
+    '198.18.0.0/15',
+    '198.51.100.0/24',
+    '203.0.113.0/24',
+    '224.0.0.0/4',
+    '240.0.0.0/4',
+]
+
+
+def _network(cidr):
+    address, bits = cidr.split('/')
+    mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
+    return ip_to_int(address) & mask, mask
+
+_reserved = [_network(cidr) for cidr in RESERVED_NETWORKS]
+# Most addresses are ruled out by their first octet alone.
+_reserved_octets = set(network >> 24 for network, mask in _reserved) | \
+    set(range(224, 256))
+
+
+def unroutable(ip):
+    """ True if `ip` can't possibly be in the database: it isn't an IPv4
+    address at all, or it's in one of :data:`RESERVED_NETWORKS`. """
+
+    number = ip_to_int(ip)
+    if number < 0:
+        return True
+    if number >> 24 not in _reserved_octets:
+        return False
+    for network, mask in _reserved:
+        if number & mask == network:
+            return True
+    return False
+
+
+class Locator(object):
+    """ Looks up the lat, lon and country of ip addresses.
+
+    `mode` is one of :data:`CACHE_MODES`.  The database at `path` is opened
+    the first time it's needed.  The answers for the last `cache_size` ips
+    are kept in :attr:`cache`, and the last `negative_cache_size` ips the
+    database didn't know in :attr:`unresolved` (0 turns either off).  `index`
+    is the path of a :class:`RangeIndex` for :meth:`locate_many`, loaded on
+    first use.
+
+    At the ``'country'`` `resolution`, every lookup is answered from `index`
+    (see :meth:`RangeIndex.countries_only`) and the database is left alone.
+    Should the index not load, we fall back to the database after all.
+    """
+
+    def __init__(self, path=GEOIP_PATH, mode=DEFAULT_MODE,
+                 cache_size=DEFAULT_CACHE_SIZE, index=None,
+                 negative_cache_size=DEFAULT_NEGATIVE_CACHE_SIZE,
+                 resolution='city'):
+        if mode not in CACHE_MODES:
+            raise ValueError("Unknown GeoIP cache mode %r (try one of %s)" % (
+                mode, ", ".join(sorted(CACHE_MODES))))
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown geo resolution %r (try one of %s)" % (
+                resolution, ", ".join(RESOLUTIONS)))
+        if resolution == 'country' and not index:
+            raise ValueError("Country resolution needs a country index")
+
+        self.path = path
+        self.mode = mode
+        self.cache_size = cache_size
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.negative_cache_size = negative_cache_size
+        self.unresolved = LRUCache(negative_cache_size) \
+            if negative_cache_size else None
+        self.reserved = 0
+        self.index_path = index
+        self.resolution = resolution
+        self._gi = None
+        self._index = None
+        self._index_failed = False
+        self.lock = threading.Lock()
+
+    def settings(self):
+        """ What it takes to make another one of us, see :func:`configure` """
+        return (self.path, self.mode, self.cache_size, self.index_path,
+                self.negative_cache_size, self.resolution)
+
+    @property
+    def gi(self):
+        """ The pygeoip database, opened on first use. """
+        if self._gi is None:
+            with self.lock:
+                # Somebody may have beaten us to it.
+                if self._gi is None:
+                    log.info("Opening %s (%s)" % (self.path, self.mode))
+                    self._gi = GeoIP(self.path, CACHE_MODES[self.mode])
+        return self._gi
+
+    @property
+    def index(self):
+        """ The :class:`RangeIndex`, loaded on first use, or None if there
+        isn't one (or it won't load). """
+
+        if self._index is None and self.index_path and not self._index_failed:
+            with self.lock:
+                if self._index is None and not self._index_failed:
+                    self._index = self._load_index()
+                    self._index_failed = self._index is None
+        return self._index
+
+    def _load_index(self):
+        try:
+            log.info("Loading %s" % self.index_path)
+            index = RangeIndex.load(self.index_path)
+        except (IOError, ValueError) as e:
+            log.warn("Can't use geo index %s, looking hits up in %s "
+                     "instead: %s" % (self.index_path, self.path, e))
+            return None
+
+        if self.resolution != index.resolution:
+            log.warn("%s places hits at their %s, not their %s" % (
+                self.index_path, index.resolution, self.resolution))
+        return index
+
+    def record(self, ip):
+        """ Return pygeoip's record for `ip`, or None """
+        return self.gi.record_by_addr(ip)
+
+    def lookup(self, ip):
+        """ Return ``(lat, lon, country)`` for `ip`, or None if the database
+        doesn't know it.  Repeat ips are answered from the caches, and
+        :func:`unroutable` ones without asking anybody. """
+
+        cache, unresolved = self.cache, self.unresolved
+        if cache is not None:
+            found = cache.get(ip)
+            if found is not None:
+                return found
+
+        if unroutable(ip):
+            self.reserved += 1
+            return None
+
+        if unresolved is not None and unresolved.get(ip):
+            return None
+
+        found = self._lookup(ip)
+        if found is None:
+            if unresolved is not None:
+                unresolved.put(ip, True)
+        elif cache is not None:
+            cache.put(ip, found)
+        return found
+
+    def _lookup(self, ip):
+        if self.resolution == 'country':
+            index = self.index
+            if index is not None:
+                return index.lookup(ip)
+
+        rec = self.record(ip)
+        if not (rec and rec['latitude'] and rec['longitude']):
+            return None
+        return (rec['latitude'], rec['longitude'],
+                rec.get('country_name', 'undefined'))
+
+    def locate(self, hit):
+        """ Add lat, lon and country to `hit`.
+
+        Returns False (and leaves `hit` alone) when its ip isn't in the
+        database.
+        """
+
+        found = self.lookup(hit['ip'])
+        if found is None:
+            return False
+
+        hit['lat'], hit['lon'], hit['country'] = found
+        return True
+
+    def lookup_many(self, ips):
+        """ :meth:`lookup` every one of `ips` in one go.  With an
+        :attr:`index` that's one vectorized search and the cache stays out of
+        it. """
+
+        index = self.index
+        if index is None:
+            return [self.lookup(ip) for ip in ips]
+        return index.lookup_many(ips)
+
+    def locate_many(self, hits):
+        """ :meth:`locate` every one of `hits`, and return those it worked
+        for. """
+
+        located = []
+        for hit, found in zip(hits, self.lookup_many([h['ip'] for h in hits])):
+            if found is not None:
+                hit['lat'], hit['lon'], hit['country'] = found
+                located.append(hit)
+        return located
+
+    def stats(self):
+        """ The cache's counters (see :meth:`LRUCache.stats`), or None """
+        if self.cache is not None:
+            return self.cache.stats()
+
+    def negative_stats(self):
+        """ The negative cache's counters, plus how many unroutable ips were
+        turned away, or None """
+        if self.unresolved is not None:
+            return dict(self.unresolved.stats(), reserved=self.reserved)
+
+
+_locator = None
+_locator_lock = threading.Lock()
+
+
+def locator():
+    """ Return this process's :class:`Locator`. """
+    global _locator
+    if _locator is None:
+        with _locator_lock:
+            if _locator is None:
+                _locator = Locator()
+    return _locator
+
+
+def configure(path=None, mode=None, cache_size=None, index=None,
+              negative_cache_size=None, resolution=None):
+    """ Point this process's :class:`Locator` at database `path`, held the
+    `mode` way, remembering `cache_size` ips (and `negative_cache_size` it
+    couldn't find), with range index `index` for bulk lookups, placing hits
+    at `resolution`.  Anything left out (None) keeps its current setting.
+
+    The database isn't (re)opened until the next lookup, and not at all if
+    nothing actually changed.
+    """
+
+    global _locator
+    current = locator()
+    settings = tuple(
+        new if new is not None else old
+        for new, old in zip((path, mode, cache_size, index,
+                             negative_cache_size, resolution),
+                            current.settings()))
+    if settings != current.settings():
+        with _locator_lock:
+            _locator = Locator(*settings)
+    return _locator
+
+
+def locate(hit):
+    """ Geolocate `hit` with this process's :class:`Locator`. """
+    return locator().locate(hit)
+
+
+def locate_many(hits):
+    """ Geolocate a batch of `hits` with this process's :class:`Locator`. """
+    return locator().locate_many(hits)
+
+
+class UnresolvedLog(object):
+    """ Tallies hits that went nowhere and logs how many every `interval`
+    seconds, rather than a warning apiece.
+
+    Internal monitoring traffic alone can fail to geolocate hundreds of times
+    a second, which used to bury everything else in the log.  The tally goes
+    out with the first hit to fail once `interval` is up, on :meth:`flush`,
+    or on :meth:`tick` -- which :func:`tick_unresolved` calls for every
+    tally there is, so the last of a burst gets logged too.
+    """
+
+    def __init__(self, logger, what="hits could not be geolocated",
+                 interval=60):
+        self.log = logger
+        self.what = what
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.count = 0
+        self.example = None
+        self.since = time.time()
+        _unresolved_logs.add(self)
+
+    def add(self, count=1, example=None):
+        """ Count `count` more, logging the tally if it's been long enough.
+        `example` is one of them, to show what they look like. """
+
+        with self.lock:
+            self.count += count
+            if example is not None:
+                self.example = example
+            if time.time() - self.since >= self.interval:
+                self._flush()
+
+    def tick(self):
+        """ Log the tally if `interval` is up, failures or not since. """
+        with self.lock:
+            if time.time() - self.since >= self.interval:
+                self._flush()
+
+    def flush(self):
+        """ Log the tally now, if there is one. """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.count:
+            message = "%i %s in the last %is" % (
+                self.count, self.what, time.time() - self.since)
+            if self.example is not None:
+                message += " (for one, %r)" % (self.example,)
+            self.log.warn(message)
+        self.count = 0
+        self.example = None
+        self.since = time.time()
+
+
+# Every UnresolvedLog in the process, for tick_unresolved.
+_unresolved_logs = weakref.WeakSet()
+
+
+def tick_unresolved():
+    """ Log every tally whose interval is up.  Call this regularly (the
+    :class:`narcissus.consumers.TimeSeriesProducer` does, every poll). """
+    for unresolved in list(_unresolved_logs):
+        unresolved.tick()
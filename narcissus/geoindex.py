@@ -0,0 +1,337 @@
+""" geoindex.py -- GeoLiteCity.dat compiled into sorted ranges, for bulk lookups.
+
+pygeoip answers one address at a time by walking the database's binary trie
+and decoding a city record, all in python.  That's fine for a hit here and
+there, but not for geolocating a batch of thousands of addresses (a worker
+pool batch, or a backfill).
+
+A :class:`RangeIndex` walks the trie once, ahead of time, and keeps the
+result as parallel arrays sorted by address::
+
+    starts[i] .. ends[i]  -->  lats[i], lons[i], countries[i]
+
+Geolocating a whole list of addresses is then one binary search over
+`starts` -- vectorized with numpy's ``searchsorted`` when numpy is around,
+one :func:`bisect.bisect_right` per address when it isn't.
+
+Compiling takes a while, so do it once with ``scripts/build-geo-index.py``
+and point ``narcissus.geoip.index`` in the hub's config at the result.
+
+Deployments that only care which country hits come from can go further with
+:meth:`RangeIndex.countries_only`: neighbouring ranges in the same country
+merge into one, placed at the country's centroid.  That's a small fraction of
+the ranges, and with ``narcissus.geoip.resolution = country`` the hub answers
+every lookup from it and never opens GeoLiteCity.dat at all.
+"""
+
+from bisect import bisect_right
+
+import array
+import socket
+import struct
+import math
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# What MaxMind's legacy GeoIP City databases (revisions 0 and 1) look like.
+CITY_EDITIONS = (6, 2)
+RECORD_LENGTH = 3
+STRUCTURE_INFO_MAX_SIZE = 20
+STRUCTURE_DELIMITER = '\xff\xff\xff'
+
+MAGIC = 'NARCGEO1\n'
+
+# GeoIP has lat and lon to four places; the index keeps them as 32 bit floats,
+# which is plenty, but they need rounding on the way out.
+PRECISION = 4
+
+# The columns of a RangeIndex: array typecodes, and the numpy dtypes with the
+# same layout.
+ARRAYS = [
+    ('starts', 'I', '<u4'),
+    ('ends', 'I', '<u4'),
+    ('lats', 'f', '<f4'),
+    ('lons', 'f', '<f4'),
+    ('countries', 'H', '<u2'),
+]
+
+
+def ip_to_int(ip):
+    """ '129.21.1.1' -> 2165637377, or -1 if `ip` isn't an IPv4 address """
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return -1
+
+
+def int_to_ip(number):
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+
+def city_segments(data):
+    """ Return the number of trie nodes in GeoIP City database `data`.
+
+    Raises ValueError if `data` isn't a GeoIP City database.
+    """
+
+    for i in range(STRUCTURE_INFO_MAX_SIZE):
+        pos = len(data) - 3 - i
+        if data[pos:pos + 3] != STRUCTURE_DELIMITER:
+            continue
+
+        edition = ord(data[pos + 3])
+        if edition >= 106:
+            edition -= 105
+        if edition not in CITY_EDITIONS:
+            raise ValueError("Not a GeoIP City database (edition %i)" %
+                             edition)
+        return struct.unpack('<I', data[pos + 4:pos + 7] + '\x00')[0]
+
+    raise ValueError("Not a GeoIP database (no structure info)")
+
+
+def read_ranges(data):
+    """ Yield ``(start, end, leaf)`` for every address range that has a
+    record in GeoIP City database `data`, lowest addresses first.
+
+    `leaf` identifies the record; ranges with the same `leaf` are in the same
+    place.
+    """
+
+    segments = city_segments(data)
+    node_size = 2 * RECORD_LENGTH
+
+    # Depth first, left (0) before right (1), so ranges come out in order.
+    # Leaves wait on the stack like nodes do, or a leaf on the right would
+    # come out before everything under the node on its left.
+    stack = [(0, 0, 0)]
+    while stack:
+        value, depth, start = stack.pop()
+        if value > segments:
+            yield start, start + (1 << (32 - depth)) - 1, value
+            continue
+        elif value == segments:
+            # Nothing here.
+            continue
+
+        offset = value * node_size
+        left = struct.unpack('<I', data[offset:offset + 3] + '\x00')[0]
+        right = struct.unpack('<I', data[offset + 3:offset + 6] + '\x00')[0]
+
+        stack.append((right, depth + 1, start | (1 << (31 - depth))))
+        stack.append((left, depth + 1, start))
+
+
+class RangeIndex(object):
+    """ Sorted, non-overlapping address ranges and where they are.
+
+    Build one with :meth:`compile` or :meth:`load`.  `countries` holds an
+    index into `names` for each range.  `resolution` says whether ranges are
+    placed at their city (``'city'``) or their country's centroid
+    (``'country'``).
+    """
+
+    def __init__(self, starts, ends, lats, lons, countries, names,
+                 resolution='city'):
+        self.names = names
+        self.resolution = resolution
+        if numpy is not None:
+            converted = [numpy.asarray(values, dtype=dtype)
+                         for values, (name, typecode, dtype) in zip(
+                             [starts, ends, lats, lons, countries], ARRAYS)]
+        else:
+            converted = [array.array(typecode, values)
+                         for values, (name, typecode, dtype) in zip(
+                             [starts, ends, lats, lons, countries], ARRAYS)]
+        self.starts, self.ends, self.lats, self.lons, self.countries = \
+            converted
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def compile(cls, data, gi):
+        """ Walk GeoIP City database `data` (the file's contents, or an mmap
+        of it) and ask pygeoip database `gi` where each range is.
+
+        Only one lookup is made per distinct place, not per range.
+        Neighbouring ranges in the same place are merged.
+        """
+
+        starts, ends, lats, lons, countries = [], [], [], [], []
+        names, name_ids, places = [], {}, {}
+
+        for start, end, leaf in read_ranges(data):
+            if leaf not in places:
+                rec = gi.record_by_addr(int_to_ip(start))
+                if rec and rec['latitude'] and rec['longitude']:
+                    name = rec.get('country_name', 'undefined')
+                    if name not in name_ids:
+                        name_ids[name] = len(names)
+                        names.append(name)
+                    places[leaf] = (rec['latitude'], rec['longitude'],
+                                    name_ids[name])
+                else:
+                    places[leaf] = None
+
+            place = places[leaf]
+            if place is None:
+                continue
+
+            if ends and ends[-1] + 1 == start and \
+               (lats[-1], lons[-1], countries[-1]) == place:
+                ends[-1] = end
+                continue
+
+            starts.append(start)
+            ends.append(end)
+            lats.append(place[0])
+            lons.append(place[1])
+            countries.append(place[2])
+
+        return cls(starts, ends, lats, lons, countries, names)
+
+    def columns(self):
+        """ Return the starts, ends, lats, lons and countries as lists. """
+        return [getattr(self, name).tolist() for name, t, d in ARRAYS]
+
+    def centroids(self):
+        """ Return ``{country: (lat, lon)}``, the middle of each country's
+        ranges weighted by how many addresses each holds.
+
+        Points are averaged on the sphere, so countries either side of the
+        antimeridian (Fiji, say) don't end up in the middle of Africa.
+        """
+
+        sums = {}
+        for start, end, lat, lon, country in zip(*self.columns()):
+            lat, lon = math.radians(lat), math.radians(lon)
+            weight = end - start + 1
+            x, y, z = sums.get(country, (0.0, 0.0, 0.0))
+            sums[country] = (x + weight * math.cos(lat) * math.cos(lon),
+                             y + weight * math.cos(lat) * math.sin(lon),
+                             z + weight * math.sin(lat))
+
+        centroids = {}
+        for country, (x, y, z) in sums.items():
+            centroids[self.names[country]] = (
+                round(math.degrees(math.atan2(z, math.hypot(x, y))),
+                      PRECISION),
+                round(math.degrees(math.atan2(y, x)), PRECISION))
+        return centroids
+
+    def countries_only(self, centroids=None):
+        """ Return a country level copy of this index: ranges in the same
+        country merge, and every one of them is placed at its country's
+        centroid.  Those come from :meth:`centroids` unless `centroids` (a
+        dict just like it) has something better. """
+
+        found = self.centroids()
+        found.update(centroids or {})
+
+        starts, ends, lats, lons, countries = [], [], [], [], []
+        for start, end, lat, lon, country in zip(*self.columns()):
+            if ends and ends[-1] + 1 == start and countries[-1] == country:
+                ends[-1] = end
+                continue
+
+            lat, lon = found[self.names[country]]
+            starts.append(start)
+            ends.append(end)
+            lats.append(lat)
+            lons.append(lon)
+            countries.append(country)
+
+        return RangeIndex(starts, ends, lats, lons, countries, self.names,
+                          'country')
+
+    def lookup(self, ip):
+        """ Return ``(lat, lon, country)`` for `ip`, or None """
+        return self._lookup_one(ip_to_int(ip))
+
+    def lookup_many(self, ips):
+        """ Return ``(lat, lon, country)`` or None for each of `ips`. """
+        if numpy is not None:
+            return self._lookup_numpy(ips)
+        return [self._lookup_one(ip_to_int(ip)) for ip in ips]
+
+    def _lookup_one(self, number):
+        if number < 0:
+            return None
+        if numpy is not None:
+            i = int(self.starts.searchsorted(number, 'right')) - 1
+        else:
+            i = bisect_right(self.starts, number) - 1
+        if i < 0 or number > self.ends[i]:
+            return None
+        return (round(float(self.lats[i]), PRECISION),
+                round(float(self.lons[i]), PRECISION),
+                self.names[self.countries[i]])
+
+    def _lookup_numpy(self, ips):
+        if not len(self):
+            return [None] * len(ips)
+
+        numbers = numpy.fromiter((ip_to_int(ip) for ip in ips),
+                                 dtype=numpy.int64, count=len(ips))
+        found = numpy.searchsorted(self.starts, numbers, side='right') - 1
+        clipped = found.clip(0)
+        ok = (numbers >= 0) & (found >= 0) & (numbers <= self.ends[clipped])
+
+        lats = self.lats[clipped].astype(numpy.float64).round(PRECISION)
+        lons = self.lons[clipped].astype(numpy.float64).round(PRECISION)
+        names = self.names
+        return [(lat, lon, names[country]) if found_ else None
+                for found_, lat, lon, country in zip(
+                    ok.tolist(), lats.tolist(), lons.tolist(),
+                    self.countries[clipped].tolist())]
+
+    def save(self, path):
+        """ Write the index to `path`, for :meth:`load` """
+        header = json.dumps({'ranges': len(self), 'names': self.names,
+                             'resolution': self.resolution})
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(header + '\n')
+            for (name, typecode, dtype) in ARRAYS:
+                values = getattr(self, name)
+                if numpy is not None:
+                    f.write(numpy.asarray(values, dtype=dtype).tostring())
+                else:
+                    f.write(array.array(typecode, values).tostring())
+
+    @classmethod
+    def load(cls, path):
+        """ Read an index written by :meth:`save`.  Raises ValueError if
+        `path` holds something else. """
+
+        with open(path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise ValueError("%s is not a narcissus geo index" % path)
+            header = json.loads(f.readline())
+            data = f.read()
+
+        count, offset, columns = header['ranges'], 0, []
+        for (name, typecode, dtype) in ARRAYS:
+            size = array.array(typecode).itemsize * count
+            if numpy is not None:
+                columns.append(numpy.frombuffer(data, dtype, count, offset))
+            else:
+                column = array.array(typecode)
+                column.fromstring(data[offset:offset + size])
+                columns.append(column)
+            offset += size
+
+        if offset != len(data):
+            raise ValueError("%s is truncated or corrupt" % path)
+
+        return cls(*(columns + [header['names'],
+                                header.get('resolution', 'city')]))
@@ -0,0 +1,189 @@
+""" loopback.py -- the whole consumer chain in one process, no services needed.
+
+Measuring the pipeline for real means running qpid, the moksha-hub, orbited
+and paster.  For benchmarks we'd rather wire the consumers straight together::
+
+|  RawIPConsumer or HttpLightConsumer
+|                 |
+|                 V
+|          LoopbackHub  --------> TimeSeriesConsumer --> _bucket
+|                 |                                         |
+|                 V                                         V
+|      LatLon2GeoJsonConsumer                 TimeSeriesProducer.poll
+|                 |                                         |
+|                 V                                         V
+|           (http_geojson)                        (http_counts_*)
+
+:class:`LoopbackHub` stands in for the moksha hub.  Messages sent by a
+consumer go on an in-memory FIFO and are handed to every consumer on that
+topic, encoded and decoded the same way the real hub does.  Every delivery is
+timed, so we can report per-stage service time and queueing latency.
+
+With ``narcissus.workers`` in the config, the entry consumer hands its work to
+worker processes and their results come back on another thread; call
+:meth:`LoopbackHub.drain` to wait for them.
+"""
+
+from collections import defaultdict, deque
+
+import narcissus.consumers
+
+import simplejson
+import time
+
+
+class LoopbackMessage(object):
+    """ What a consumer with ``jsonify = False`` gets handed. """
+
+    def __init__(self, topic, body):
+        self.topic = topic
+        self.body = body
+
+
+class Stage(object):
+    """ Timings for everything one consumer (or producer) did. """
+
+    def __init__(self, name):
+        self.name = name
+        self.service = []
+        self.wait = []
+
+    def record(self, wait, service):
+        self.wait.append(wait)
+        self.service.append(service)
+
+    def percentile(self, values, pct):
+        if not values:
+            return 0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+    def summary(self):
+        return "%-28s %8i %9.3f %9.3f %9.3f %11.3f" % (
+            self.name, len(self.service),
+            1000 * sum(self.service) / max(1, len(self.service)),
+            1000 * self.percentile(self.service, 50),
+            1000 * self.percentile(self.service, 99),
+            1000 * self.percentile(self.wait, 99),
+        )
+
+
+class LoopbackHub(object):
+    """ Just enough of a moksha hub to drive our consumers in-process. """
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.queue = deque()
+        self.consumers = defaultdict(list)
+        self.stages = {}
+        self.sunk = defaultdict(int)
+
+    def subscribe(self, *args, **kw):
+        """ moksha's own wiring is ignored; see :meth:`add_consumer` """
+        pass
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def add_consumer(self, consumer):
+        self.consumers[consumer.topic].append(consumer)
+        return consumer
+
+    def send_message(self, topic, message, jsonify=True):
+        if jsonify:
+            message = simplejson.dumps(message)
+        self.queue.append((topic, message, time.time()))
+
+    def pump(self):
+        """ Deliver messages until there are none left. """
+        while self.queue:
+            topic, message, sent = self.queue.popleft()
+            if not self.consumers[topic]:
+                # Would have gone out to the browsers.
+                self.sunk[topic] += 1
+
+            for consumer in self.consumers[topic]:
+                self.deliver(consumer, topic, message, sent)
+
+    def deliver(self, consumer, topic, message, sent):
+        if consumer.jsonify:
+            message = {'topic': topic, 'body': simplejson.loads(message)}
+        else:
+            message = LoopbackMessage(topic, message)
+
+        start = time.time()
+        consumer.consume(message)
+        self.stage(type(consumer).__name__).record(
+            start - sent, time.time() - start)
+
+    def drain(self):
+        """ Wait for every consumer's worker pool to publish, then pump. """
+        for consumers in self.consumers.values():
+            for consumer in consumers:
+                if getattr(consumer, 'pool', None):
+                    consumer.pool.drain()
+        self.pump()
+
+    def close(self):
+        """ Stop every consumer, like the hub does on its way down. """
+        for consumers in self.consumers.values():
+            for consumer in consumers:
+                if hasattr(consumer, 'stop'):
+                    consumer.stop()
+
+    def poll(self, producer):
+        """ Wake `producer` up, like the reactor would every `frequency` """
+        start = time.time()
+        producer.poll()
+        self.stage(type(producer).__name__ + '.poll').record(
+            0, time.time() - start)
+        self.pump()
+
+    def report(self):
+        lines = ["%-28s %8s %9s %9s %9s %11s" % (
+            'stage', 'msgs', 'mean ms', 'p50 ms', 'p99 ms', 'wait p99 ms')]
+        lines += [stage.summary() for name, stage in sorted(
+            self.stages.items())]
+        lines += ["%-28s %8i" % ('-> ' + topic, count)
+                  for topic, count in sorted(self.sunk.items())]
+        return "\n".join(lines)
+
+
+def loopback_class(cls, rrd=False):
+    """ Return a subclass of `cls` that behaves itself outside the hub.
+
+    Hit logging to the database is switched off (we don't have one), and so
+    is rrdtool unless `rrd` is true.
+    """
+
+    attrs = {'app': None}
+    if not rrd:
+        attrs['rrdtool_setup'] = lambda self: None
+        attrs['_rrdtool_log'] = lambda self, count, filename: None
+        attrs['save_uniques'] = lambda self, *args: None
+        attrs['load_uniques'] = lambda self: None
+
+    return type(cls.__name__, (cls,), attrs)
+
+
+entry_points = {
+    'rawip': narcissus.consumers.RawIPConsumer,
+    'httpdlight': narcissus.consumers.HttpLightConsumer,
+    'preparsed': narcissus.consumers.PreParsedHttpLightConsumer,
+}
+
+
+def build_pipeline(entry='rawip', config=None, rrd=False):
+    """ Return a hub with the whole chain hooked up behind `entry`, plus the
+    :class:`TimeSeriesProducer` to poll. """
+
+    hub = LoopbackHub(config)
+    for cls in [entry_points[entry],
+                narcissus.consumers.TimeSeriesConsumer,
+                narcissus.consumers.LatLon2GeoJsonConsumer]:
+        hub.add_consumer(loopback_class(cls, rrd)(hub))
+
+    producer = loopback_class(narcissus.consumers.TimeSeriesProducer, rrd)(hub)
+    return hub, producer
@@ -0,0 +1,598 @@
+""" parsers.py -- turning raw access log lines into hit records.
+
+httpd-light's format (:func:`parse_line`) is what narcissus started with.
+Other formats -- Apache combined and common, nginx JSON, or any Apache
+``LogFormat`` string -- are looked up in a registry with :func:`get_format`,
+which can also work out the format from the first few lines of a log.
+
+This is shared between the hub (:class:`narcissus.consumers.HttpLightConsumer`)
+and amqp-log-sender.py, which can parse lines at the edge with ``--preparse``
+and ship compact records instead of raw lines.  Like :mod:`narcissus.wire` it
+only depends on the standard library.
+
+A pre-parsed record goes over the wire as a JSON list of the values in
+`RECORD_FIELDS` order, one record per line of a batch.
+"""
+
+from datetime import datetime, timedelta, tzinfo
+from hashlib import md5
+
+from narcissus.cache import LRUCache
+
+import zlib
+import re
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# httpd-light's access log format, with bytesin and bytesout tacked on.  The
+# referer and user agent are quoted strings, in which a quote is escaped with
+# a backslash: a run of anything but quotes, then any number of escaped
+# quotes each followed by another run.  Runs are scanned in one go, and only
+# ever give back the backslash in front of a quote, so however long a line
+# is, matching it (or failing to) takes time in proportion to its length.
+QUOTED = r'"([^"]*(?:\\"[^"]*)*)"'
+LIGHTTPD_RE = re.compile(
+    r'^(\d+\.\d+\.\d+\.\d+)\s(\S+)\s(\S+)\s\[(\S+\s\S+)\]\s"(\S+)\s(\S+)\s(\S+)"'
+    r'\s(\d+)\s(\d+)\s' + QUOTED + r'\s' + QUOTED + r'\s(\d+)\s(\d+)$')
+
+# The fields of a hit record, in the order they're packed for the wire.  The
+# 'tag' is always the same as the 'filename' so it isn't sent twice.
+RECORD_FIELDS = (
+    'ip',
+    'logdatetime',
+    'requesttype',
+    'filename',
+    'httptype',
+    'statuscode',
+    'filesize',
+    'refererhash',
+    'bytesin',
+    'bytesout',
+)
+
+MONTHS = dict((name, i) for i, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1))
+
+
+class FixedOffset(tzinfo):
+    """ The UTC offset a line was logged with, like -0400.
+
+    Python 2 doesn't come with a concrete tzinfo, so here's ours.
+    """
+
+    def __init__(self, minutes):
+        self.offset = timedelta(minutes=minutes)
+        self.name = "%s%02i%02i" % ('-' if minutes < 0 else '+',
+                                    abs(minutes) / 60, abs(minutes) % 60)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return self.name
+
+    def __repr__(self):
+        return "<FixedOffset %s>" % self.name
+
+
+class TimestampDecoder(object):
+    """ Turns logged timestamps into (aware datetime, text) pairs, the text
+    being what goes in a hit record's 'logdatetime'.
+
+    Every line logged in the same second has the same stamp, so the last one
+    is remembered, along with up to `size` recent others for when lines from a
+    few servers are interleaved.  Calling this is much cheaper than
+    ``datetime.strptime``, which also can't handle the UTC offset.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.cache = {}
+        self.zones = {}
+        self.last = (None, None)
+
+    def __call__(self, stamp):
+        last = self.last
+        if stamp == last[0]:
+            return last[1]
+
+        decoded = self.cache.get(stamp)
+        if decoded is None:
+            decoded = self.decode(stamp)
+            if len(self.cache) >= self.size:
+                self.cache.clear()
+            self.cache[stamp] = decoded
+
+        self.last = (stamp, decoded)
+        return decoded
+
+    def zone(self, minutes):
+        if minutes not in self.zones:
+            self.zones[minutes] = FixedOffset(minutes)
+        return self.zones[minutes]
+
+    def decode(self, stamp):
+        """ Decode a stamp like ``15/Apr/2011:13:37:00 -0400`` from scratch.
+
+        Raises ValueError if that isn't what `stamp` looks like.
+        """
+
+        digits = (stamp[0:2] + stamp[7:11] + stamp[12:14] + stamp[15:17] +
+                  stamp[18:20] + stamp[22:26])
+        if (len(stamp) != 26 or not digits.isdigit() or
+            stamp[21] not in '+-' or stamp[3:6] not in MONTHS or
+            stamp[2] + stamp[6] + stamp[11] + stamp[14] + stamp[17] +
+            stamp[20] != '//::: '):
+            raise ValueError("Unrecognized timestamp %r" % stamp)
+
+        fields = (int(stamp[7:11]), MONTHS[stamp[3:6]], int(stamp[0:2]),
+                  int(stamp[12:14]), int(stamp[15:17]), int(stamp[18:20]))
+        minutes = int(stamp[22:24]) * 60 + int(stamp[24:26])
+        if stamp[21] == '-':
+            minutes = -minutes
+
+        # datetime() raises ValueError for the 31st of February and so on.
+        when = datetime(*fields, tzinfo=self.zone(minutes))
+
+        # python datetime objects are not JSON serializable, so this goes out
+        # like '2011-04-15 13:37:00-04:00', UTC offset and all.
+        return when, str(when)
+
+
+# Shared by everybody who calls parse_line.
+decode_timestamp = TimestampDecoder()
+
+
+# Ways of boiling a user agent down for the 'refererhash'.  md5 fills the
+# 32 character column in the database; crc32 is a lot cheaper where nothing
+# needs that.
+DIGESTS = {
+    'md5': lambda text: md5(text).hexdigest(),
+    'crc32': lambda text: '%08x' % (zlib.crc32(text) & 0xffffffff),
+}
+
+
+class Digester(LRUCache):
+    """ Digests user agents, remembering the last `size`.
+
+    A handful of them make up nearly every hit, so most calls never get as
+    far as the digest.  :meth:`stats` says how true that is.
+    """
+
+    def __init__(self, name='md5', size=1024):
+        if name not in DIGESTS:
+            raise ValueError("Unknown digest %r (try one of %s)" % (
+                name, ", ".join(sorted(DIGESTS))))
+
+        super(Digester, self).__init__(size)
+        self.name = name
+        self.digest = DIGESTS[name]
+        self.length = len(self.digest(''))
+
+    def matches(self, value):
+        """ Could `value` have come out of this digest? """
+        return isinstance(value, basestring) and len(value) == self.length
+
+    def __call__(self, text):
+        # The common case, without even the cost of calling get().
+        value = self.young.get(text)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        value = self.get(text)
+        if value is None:
+            value = self.digest(text)
+            self.put(text, value)
+        return value
+
+
+# Shared by everybody who builds hit records.  See set_digest.
+digest_agent = Digester()
+
+
+def set_digest(name='md5', size=1024):
+    """ Switch every hit record built from now on over to digest `name`,
+    remembering `size` user agents.  Raises ValueError for unknown digests. """
+
+    global digest_agent
+    digest_agent = Digester(name, size)
+
+
+def parse_fields(line):
+    """ Return the 13 raw fields of `line`, as :data:`LIGHTTPD_RE` captures
+    them, or None if it won't parse. """
+
+    regex_result = LIGHTTPD_RE.match(line)
+    if not regex_result:
+        return None
+    return regex_result.groups()
+
+
+def make_record(ip, stamp, method, path, protocol, status, size,
+                agent='-', bytesin='0', bytesout='0'):
+    """ Build a hit record out of the raw fields of a line, whatever format it
+    was logged in.  Returns None if `stamp` won't decode.
+
+    The record has everything but the geo info, which is added by the hub.
+    """
+
+    try:
+        log_date, log_text = decode_timestamp(stamp)
+    except ValueError:
+        return None
+
+    return {
+        'ip'            : ip,
+        'logdatetime'   : log_text,
+        'requesttype'   : method,
+        'filename'      : path,
+        'tag'           : path,
+        'httptype'      : protocol,
+        'statuscode'    : status,
+        'filesize'      : size,
+        'refererhash'   : digest_agent(agent),
+        'bytesin'       : bytesin,
+        'bytesout'      : bytesout,
+    }
+
+
+def parse_line(line):
+    """ Return a hit record for httpd-light log `line` or None if it won't
+    parse.  See :func:`get_format` for everything else. """
+
+    fields = parse_fields(line)
+    if not fields:
+        return None
+
+    return make_record(fields[0], fields[3], fields[4], fields[5], fields[6],
+                       fields[7], fields[8], fields[10], fields[11],
+                       fields[12])
+
+
+class LogFormat(object):
+    """ One way of writing access logs down.
+
+    Subclasses implement :meth:`parse`, returning a hit record (see
+    :func:`make_record`) or None for lines they don't understand, and
+    :meth:`stamp`, returning just the line's raw timestamp (or None) for
+    anybody who only cares when a hit happened.
+    """
+
+    name = None
+
+    def parse(self, line):
+        raise NotImplementedError
+
+    def stamp(self, line):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, self.name)
+
+
+class LighttpdFormat(LogFormat):
+    """ httpd-light's combined format with bytesin and bytesout tacked on.
+
+    This is what narcissus was written for.
+    """
+
+    name = 'lighttpd'
+
+    def parse(self, line):
+        return parse_line(line)
+
+    def stamp(self, line):
+        fields = parse_fields(line)
+        return fields and fields[3]
+
+
+# Apache LogFormat directives we know what to do with, and the make_record
+# argument each fills in.  Request headers are matched case-insensitively.
+APACHE_DIRECTIVES = {
+    'h': 'ip',
+    'a': 'ip',
+    't': 'stamp',
+    'r': 'request',
+    '>s': 'status',
+    's': 'status',
+    'b': 'size',
+    'B': 'size',
+    'I': 'bytesin',
+    'O': 'bytesout',
+    '{referer}i': 'referer',
+    '{user-agent}i': 'agent',
+}
+
+APACHE_DIRECTIVE_RE = re.compile(r'%(>?[a-zA-Z]|\{[^}]+\}[a-zA-Z])')
+
+# A double quoted value, with the quotes escaped inside it the way apache and
+# nginx do.  Unlike (.+) this can't backtrack its way through a long line.
+QUOTED_VALUE = r'((?:[^"\\]|\\.)*)'
+
+
+class ApacheFormat(LogFormat):
+    """ Any log written with an Apache ``LogFormat`` string, like::
+
+        %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i"
+
+    The string is compiled into a single regex.  Raises ValueError for a
+    format without the directives a hit record can't do without.
+    """
+
+    def __init__(self, format_string, name=None):
+        self.format_string = format_string
+        self.name = name or format_string
+
+        pattern, used, last = '^', set(), 0
+        for match in APACHE_DIRECTIVE_RE.finditer(format_string):
+            literal = format_string[last:match.start()]
+            pattern += re.escape(literal)
+            last = match.end()
+
+            directive = match.group(1)
+            if directive.startswith('{'):
+                directive = directive.lower()
+            field = APACHE_DIRECTIVES.get(directive)
+
+            around = ('', '')
+            if directive == 't':
+                value, around = r'([^\]]+)', (r'\[', r'\]')
+            elif literal.endswith('"'):
+                value = QUOTED_VALUE
+            elif field in ('status', 'bytesin', 'bytesout'):
+                value = r'(\d+)'
+            elif field == 'size':
+                value = r'(\d+|-)'
+            else:
+                value = r'(\S+)'
+
+            if field and field not in used:
+                used.add(field)
+                value = '(?P<%s>%s)' % (field, value[1:-1])
+            pattern += around[0] + value + around[1]
+
+        pattern += re.escape(format_string[last:]) + '$'
+
+        missing = set(['ip', 'stamp', 'request', 'status']) - used
+        if missing:
+            raise ValueError("Log format %r has no %s" % (
+                format_string, ", ".join(sorted(missing))))
+
+        self.regex = re.compile(pattern)
+
+    def stamp(self, line):
+        match = self.regex.match(line.rstrip('\r\n'))
+        return match and match.group('stamp')
+
+    def parse(self, line):
+        match = self.regex.match(line.rstrip('\r\n'))
+        if not match:
+            return None
+
+        fields = match.groupdict()
+        request = fields['request'].split(' ')
+        if len(request) != 3:
+            return None
+
+        size = fields.get('size')
+        return make_record(fields['ip'], fields['stamp'],
+                           request[0], request[1], request[2],
+                           fields['status'],
+                           size if size and size != '-' else '0',
+                           fields.get('agent') or '-',
+                           fields.get('bytesin') or '0',
+                           fields.get('bytesout') or '0')
+
+
+# What nginx calls things, for a JSON log_format that uses the variable names
+# as keys.  ``request`` wins over method, uri and protocol when it's there.
+NGINX_JSON_KEYS = {
+    'ip': 'remote_addr',
+    'stamp': 'time_local',
+    'request': 'request',
+    'method': 'request_method',
+    'path': 'request_uri',
+    'protocol': 'server_protocol',
+    'status': 'status',
+    'size': 'body_bytes_sent',
+    'agent': 'http_user_agent',
+    'bytesin': 'request_length',
+    'bytesout': 'bytes_sent',
+}
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class JSONFormat(LogFormat):
+    """ One JSON object per line, like nginx writes with::
+
+        log_format json escape=json '{"remote_addr":"$remote_addr",'
+            '"time_local":"$time_local","request":"$request",...}';
+
+    Pass `keys` to override any of :data:`NGINX_JSON_KEYS`.
+    """
+
+    def __init__(self, name='nginx-json', keys=None):
+        self.name = name
+        self.keys = dict(NGINX_JSON_KEYS)
+        self.keys.update(keys or {})
+
+    def load(self, line):
+        """ Return the object on `line`, or None if it doesn't hold one. """
+        line = line.strip()
+        if not line.startswith('{'):
+            return None
+
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(obj, dict):
+            return None
+        return obj
+
+    def stamp(self, line):
+        obj = self.load(line)
+        value = obj and obj.get(self.keys['stamp'])
+        return value and _text(value)
+
+    def parse(self, line):
+        obj = self.load(line)
+        if obj is None:
+            return None
+
+        keys = self.keys
+
+        # A field that's there but null is as good as missing.
+        def get(field, default=None):
+            value = obj.get(keys[field])
+            if value is None:
+                if default is None:
+                    raise KeyError(keys[field])
+                return default
+            return _text(value)
+
+        try:
+            if obj.get(keys['request']) is not None:
+                method, path, protocol = get('request').split(' ')
+            else:
+                method, path, protocol = [
+                    get(field) for field in ['method', 'path', 'protocol']]
+            ip, stamp, status = [get(field)
+                                 for field in ['ip', 'stamp', 'status']]
+        except (KeyError, ValueError):
+            return None
+
+        if not status.isdigit():
+            return None
+
+        return make_record(ip, stamp, method, path, protocol, status,
+                           get('size', '0'), get('agent', '-'),
+                           get('bytesin', '0'), get('bytesout', '0'))
+
+
+class FormatDetector(LogFormat):
+    """ Works out which registered format a log is in from its first lines.
+
+    Until `sample` lines have been seen, each line is tried against every
+    format in :data:`format_order` and parsed by the first that takes it.
+    After that, whichever format took the most lines is :attr:`chosen` and
+    used for everything else.
+    """
+
+    name = 'auto'
+
+    def __init__(self, sample=10, candidates=None):
+        self.sample = sample
+        self.candidates = [log_formats[name]
+                           for name in candidates or format_order]
+        self.tally = dict((log_format.name, 0)
+                          for log_format in self.candidates)
+        self.seen = 0
+        self.chosen = None
+
+    def parse(self, line):
+        if self.chosen:
+            return self.chosen.parse(line)
+
+        self.seen += 1
+        record = None
+        for log_format in self.candidates:
+            record = log_format.parse(line)
+            if record:
+                self.tally[log_format.name] += 1
+                break
+
+        if self.seen >= self.sample and max(self.tally.values()):
+            # Ties go to whoever was registered first.
+            self.chosen = max(self.candidates, key=lambda log_format: (
+                self.tally[log_format.name],
+                -self.candidates.index(log_format)))
+
+        return record
+
+    def stamp(self, line):
+        if self.chosen:
+            return self.chosen.stamp(line)
+
+        # Still sampling: let the line count towards choosing.
+        self.parse(line)
+        for log_format in self.candidates:
+            stamp = log_format.stamp(line)
+            if stamp:
+                return stamp
+        return None
+
+
+# The registry.  Detection tries formats in the order they were registered.
+log_formats = {}
+format_order = []
+
+
+def register_format(log_format):
+    """ Make `log_format` available to :func:`get_format` by its name. """
+    if log_format.name not in log_formats:
+        format_order.append(log_format.name)
+    log_formats[log_format.name] = log_format
+    return log_format
+
+
+def get_format(spec):
+    """ Return the :class:`LogFormat` for `spec`.
+
+    That's the name of a registered format, ``auto`` for a fresh
+    :class:`FormatDetector`, or an Apache ``LogFormat`` string.  Raises
+    ValueError for anything else.
+    """
+
+    if spec == FormatDetector.name:
+        return FormatDetector()
+    if spec in log_formats:
+        return log_formats[spec]
+    if '%' in spec:
+        return ApacheFormat(spec)
+    raise ValueError("Unknown log format %r (try one of %s, auto or an "
+                     "Apache LogFormat string)" % (spec, ", ".join(format_order)))
+
+
+register_format(LighttpdFormat())
+register_format(ApacheFormat(
+    '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i"', 'combined'))
+register_format(ApacheFormat('%h %l %u %t "%r" %>s %b', 'common'))
+register_format(JSONFormat())
+
+
+def pack_record(record):
+    """ Serialize a hit record into a single compact line. """
+    return json.dumps([record[field] for field in RECORD_FIELDS],
+                      separators=(',', ':'))
+
+
+def unpack_record(line):
+    """ Inverse of :func:`pack_record`.  Raises ValueError on junk, and on
+    records whose 'refererhash' wasn't made with our digest (see
+    :func:`set_digest`) -- the sender's ``--digest`` has to match. """
+
+    values = json.loads(line)
+    if not isinstance(values, list) or len(values) != len(RECORD_FIELDS):
+        raise ValueError("Malformed hit record %r" % line)
+
+    record = dict(zip(RECORD_FIELDS, values))
+    if not digest_agent.matches(record['refererhash']):
+        raise ValueError("Hit record %r isn't digested with %s" % (
+            line, digest_agent.name))
+
+    record['tag'] = record['filename']
+    return record
@@ -0,0 +1,606 @@
+""" sender.py -- the moving parts of amqp-log-sender.py.
+
+Everything the sender does that has state worth testing lives here, so it can
+be: reading the log (:class:`StdinReader`, or :class:`FileTailer` with its
+checkpoint), batching lines up (:class:`Batcher`), sharding them across
+targets (:class:`HashRing`), keeping track of what every target has taken
+(:class:`Ledger`), delivering to each target on a thread of its own
+(:class:`Target`) and spooling for targets that are away (:class:`Spool`).
+The transports themselves -- subclasses of :class:`Target` -- stay in the
+script.
+
+Like :mod:`narcissus.wire`, this only depends on the standard library, so the
+sender can import it from a plain git checkout on the monitored machine.
+"""
+
+from hashlib import md5
+
+import narcissus.wire
+
+import itertools
+import threading
+import Queue
+import select
+import bisect
+import time
+import os
+
+
+class StdinReader(object):
+    """ Reads big chunks off of stdin and hands back whole lines.
+
+    Unlike ``sys.stdin.readline()`` this won't block forever, so we get a
+    chance to flush a partially filled batch when the log goes quiet.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.partial = ''
+
+    def read_lines(self, timeout=None):
+        """ Return a list of lines, [] on timeout, or None at end of file. """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        chunk = os.read(self.fd, self.chunk_size)
+        if not chunk:
+            if not self.partial:
+                return None
+            lines, self.partial = [self.partial], ''
+            return lines
+
+        lines = (self.partial + chunk).split('\n')
+        self.partial = lines.pop()
+        return [line + '\n' for line in lines]
+
+    def checkpoint(self, pending=0):
+        """ There's no going back on a pipe, so there's nothing to save. """
+        pass
+
+
+class FileTailer(object):
+    """ Our own ``tail -F`` that knows about logrotate and restarts.
+
+    We read the file in big chunks.  Once we hit the end, we check whether the
+    path now points at a new inode (the file was moved away and recreated) or
+    whether the file shrank under us (copytruncate) and start over from the
+    top of the new data in either case.
+
+    Our position is remembered as an (inode, offset) pair in the `checkpoint`
+    file.  The offset only ever counts whole lines that we've handed out.
+    """
+
+    chunk_size = 1048576
+    poll_interval = 0.25
+
+    def __init__(self, path, checkpoint=None):
+        self.path = path
+        self.checkpoint_path = checkpoint
+        self.fd = None
+        self.inode = None
+        self.offset = 0
+        self.partial = ''
+
+        inode, offset = self.load_checkpoint()
+        while not self.open():
+            time.sleep(self.poll_interval)
+
+        if inode == self.inode and offset <= os.fstat(self.fd).st_size:
+            print "Resuming %s at byte %i" % (self.path, offset)
+            self.seek(offset)
+        elif inode is None:
+            # Nothing to resume from.  Just like tail, start at the end.
+            self.seek(os.fstat(self.fd).st_size)
+        else:
+            print "%s was rotated while we were away" % self.path
+
+    def open(self):
+        """ (Re)open `path`.  Return false if it isn't there right now. """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = fd
+        self.inode = os.fstat(fd).st_ino
+        self.offset = 0
+        self.partial = ''
+        return True
+
+    def seek(self, offset):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        self.offset = offset
+        self.partial = ''
+
+    def rotated(self):
+        """ Return true if `path` is now a different file than the one we have
+        open.  Only meaningful once we've drained the old one. """
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            # Moved away but not yet recreated.  Keep waiting.
+            return False
+
+    def read_lines(self, timeout=None):
+        """ Return a list of lines, or [] if there is nothing new yet. """
+        chunk = os.read(self.fd, self.chunk_size)
+        if chunk:
+            lines = (self.partial + chunk).split('\n')
+            self.partial = lines.pop()
+            lines = [line + '\n' for line in lines]
+            self.offset += sum(map(len, lines))
+            return lines
+
+        if os.fstat(self.fd).st_size < self.offset + len(self.partial):
+            print "%s was truncated" % self.path
+            self.seek(0)
+            return []
+
+        if self.rotated():
+            print "%s was rotated" % self.path
+            leftover = self.partial
+            self.open()
+            if leftover:
+                return [leftover + '\n']
+            return []
+
+        if timeout is None:
+            timeout = self.poll_interval
+        time.sleep(min(timeout, self.poll_interval))
+        return []
+
+    def load_checkpoint(self):
+        if not self.checkpoint_path or \
+           not os.path.exists(self.checkpoint_path):
+            return None, 0
+
+        with open(self.checkpoint_path) as f:
+            inode, offset = f.read().split()
+        return int(inode), int(offset)
+
+    def checkpoint(self, pending=0):
+        """ Save our position, less `pending` bytes that haven't gone out. """
+        if not self.checkpoint_path:
+            return
+
+        if pending > self.offset:
+            # Some of those lines belong to the file before the rotation.
+            # Wait until they've been sent before we move the checkpoint.
+            return
+
+        # Write and rename so we never leave a half-written checkpoint behind.
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write("%i %i\n" % (self.inode, self.offset - pending))
+        os.rename(tmp, self.checkpoint_path)
+
+
+class Batcher(object):
+    """ Collects lines until we have `max_lines` or `max_age` seconds pass. """
+
+    def __init__(self, topic, targets, max_lines, max_age,
+                 codec=narcissus.wire.PLAIN,
+                 dict_id=narcissus.wire.DEFAULT_DICTIONARY_ID):
+        self.topic = topic
+        self.targets = targets
+        self.max_lines = max_lines
+        self.max_age = max_age
+        self.codec = codec
+        self.dict_id = dict_id
+        self.lines = []
+        self.first = None
+        self.started = None
+
+        # Unbatched raw lines go out bare to stay compatible with hubs that
+        # predate batching.
+        self.bare = max_lines == 1 and codec == narcissus.wire.PLAIN
+
+    def add(self, line, position):
+        """ Add `line`, which starts `position` bytes into what we've read """
+        if not self.lines:
+            self.started = time.time()
+            self.first = position
+        self.lines.append(line)
+
+    def full(self):
+        return len(self.lines) >= self.max_lines
+
+    def timeout(self):
+        """ Seconds until the current batch goes stale (None if empty). """
+        if not self.lines:
+            return None
+        return max(0, self.started + self.max_age - time.time())
+
+    def flush(self):
+        """ Return the wire-ready message body and empty the batch. """
+        lines, self.lines = self.lines, []
+        if self.bare:
+            return lines[0]
+        return narcissus.wire.pack(lines, self.codec, self.dict_id)
+
+
+class HashRing(object):
+    """ Consistent hashing of client IPs onto targets.
+
+    Each target gets `replicas` points on the ring, so adding or removing a
+    target only moves about 1/n of the clients around.
+    """
+
+    replicas = 100
+
+    def __init__(self, targets):
+        self.ring = sorted([
+            (self.hash("%s#%i" % (target.target, i)), target)
+            for target in targets for i in range(self.replicas)
+        ])
+        self.points = [point for point, target in self.ring]
+
+    def hash(self, key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def lookup(self, key):
+        """ Return the target that owns `key` """
+        i = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.ring[i][1]
+
+
+class Ledger(object):
+    """ Keeps track of which lines every target has taken off our hands.
+
+    Every message gets a ticket when it's handed to its targets, naming the
+    position of its first line (in bytes read since we started) and how many
+    targets still have to take it.  A target takes a message by sending it,
+    spooling it or -- while we're running -- dropping it, which is what the
+    'drop' policy (or having no spool) signs up for.  A message a target
+    couldn't take on our way out is never taken, and holds the checkpoint
+    back, so the next run sends it again.
+
+    :meth:`low_water` is the position of the first line that hasn't been
+    taken by all of its targets, so everything before it is safe to
+    checkpoint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tickets = itertools.count()
+        self.pending = {}
+        self.pinned = None
+
+    def open(self, first, recipients):
+        """ Return a ticket for a message to `recipients` targets """
+        with self.lock:
+            ticket = self.tickets.next()
+            self.pending[ticket] = [first, recipients]
+        return ticket
+
+    def settle(self, ticket, taken=True):
+        """ One target is done with `ticket`, for better (`taken`) or worse """
+        if ticket is None:
+            return
+
+        with self.lock:
+            entry = self.pending[ticket]
+            if not taken and (self.pinned is None or entry[0] < self.pinned):
+                self.pinned = entry[0]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.pending[ticket]
+
+    def low_water(self):
+        """ Return the position of the first line not yet taken by all its
+        targets, or None if they've all been. """
+        with self.lock:
+            firsts = [first for first, recipients in self.pending.values()]
+            if self.pinned is not None:
+                firsts.append(self.pinned)
+        return min(firsts) if firsts else None
+
+    def behind(self, position, firsts=()):
+        """ Return how many of the bytes read up to `position` aren't safe
+        to checkpoint yet.  `firsts` are the positions of lines we haven't
+        even handed out (the ones still in a batch). """
+
+        firsts = list(firsts)
+        low_water = self.low_water()
+        if low_water is not None:
+            firsts.append(low_water)
+        if not firsts:
+            return 0
+        return position - min(firsts)
+
+
+class Spool(object):
+    """ An append-only file of messages waiting for a target to come back.
+
+    Each message is framed as ``<topic> <length>\\n<body>`` so binary (say,
+    compressed) bodies are fine.  How far we've drained is kept next to it in
+    ``<path>.offset``, so a spool left behind by one run is delivered by the
+    next.  Once we've caught all the way up both files are emptied.
+
+    Only the owning target's worker thread ever touches a spool.
+    """
+
+    save_interval = 1
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.max_bytes = max_bytes
+        self.writer = open(path, 'ab')
+        self.reader = open(path, 'rb')
+        self.size = os.path.getsize(path)
+        self.offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path) as f:
+                self.offset = min(int(f.read().strip() or 0), self.size)
+        self.last_save = time.time()
+        self.head = None
+
+    def pending(self):
+        return self.offset < self.size
+
+    def append(self, topic, msg):
+        """ Spool `msg`.  Return false if the spool is full. """
+        frame = "%s %i\n%s" % (topic, len(msg), msg)
+        if self.size + len(frame) > self.max_bytes:
+            return False
+
+        self.writer.write(frame)
+        self.writer.flush()
+        self.size += len(frame)
+        return True
+
+    def peek(self):
+        """ Return the oldest (topic, msg) without removing it, or None if
+        there's only a torn frame left -- see :meth:`cut`. """
+        if self.head is None:
+            self.reader.seek(self.offset)
+            header = self.reader.readline()
+            try:
+                topic, length = header.split()
+                length = int(length)
+            except ValueError:
+                length = -1
+            msg = self.reader.read(length) if length >= 0 else ''
+            if not header.endswith('\n') or length < 0 or len(msg) < length:
+                self.cut()
+                return None
+            self.head = (topic, msg, self.offset + len(header) + len(msg))
+        return self.head[:2]
+
+    def cut(self):
+        """ Throw away everything from the frame at our offset on.  That's
+        what a crash halfway through :meth:`append` leaves behind. """
+        print "Cutting %i bytes of torn messages off of %s" % (
+            self.size - self.offset, self.path)
+        self.writer.truncate(self.offset)
+        self.size = self.offset
+        if not self.pending():
+            self.empty()
+
+    def pop(self):
+        """ Forget about the message :meth:`peek` just returned. """
+        self.offset = self.head[2]
+        self.head = None
+
+        if not self.pending():
+            self.empty()
+        elif time.time() - self.last_save >= self.save_interval:
+            self.save()
+
+    def empty(self):
+        """ All caught up.  Start over with an empty file. """
+        self.writer.truncate(0)
+        self.offset = self.size = 0
+        self.save()
+        # The reader may still have the old bytes buffered.
+        self.reader.close()
+        self.reader = open(self.path, 'rb')
+
+    def save(self):
+        with open(self.offset_path, 'w') as f:
+            f.write("%i\n" % self.offset)
+        self.last_save = time.time()
+
+    def close(self):
+        self.save()
+        self.writer.close()
+        self.reader.close()
+
+
+class Target(object):
+    """ A single destination with its own bounded queue and worker thread.
+
+    The stdin loop only ever puts messages on our queue, so a slow or stalled
+    broker can't hold up the other targets.  When the queue is full we either
+    drop the message (and count it) or, with the 'block' policy, make the
+    reader wait for us -- backpressure all the way back to the web server.
+
+    The worker (re)connects on its own, backing off exponentially between
+    attempts.  While the broker is unreachable messages go to the `spool` if
+    we have one (and are dropped if we don't).  Once we're back, live traffic
+    goes straight out and the spool is drained behind it at no more than
+    `catch_up_rate` messages a second.
+
+    What happens to each message is settled with the `ledger`, if we have one.
+    Drops are settled as taken, except the ones once we've been asked to
+    :meth:`stop`: those are left for the next run.
+
+    Subclasses fill in the transport: :meth:`open`, :meth:`close` and
+    :meth:`publish`.
+    """
+
+    def __init__(self, target, policy, queue_size, spool=None,
+                 catch_up_rate=100, max_backoff=60, ledger=None):
+        self.target = target
+        self.policy = policy
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.spool = spool
+        self.catch_up_rate = catch_up_rate
+        self.max_backoff = max_backoff
+        self.ledger = ledger
+        self.stopping = False
+        self.thread = None
+        self.session = None     # Whatever open() gave us, while it's good.
+        self.backoff = 0
+        self.next_attempt = 0
+        self.tokens = 0
+        self.last_refill = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.spooled = 0
+
+    def connect(self):
+        """ Create connection and session.  Return true on success. """
+        print "Attempting to setup connection with", self.target
+        try:
+            self.session = self.open()
+            self.backoff = 0
+            print "    Created target", self.target
+            return True
+        except Exception as e:
+            print "    Failed to create target", self.target
+            print str(e)
+            self.disconnect()
+            return False
+
+    def disconnect(self):
+        """ Give up on the current connection and schedule the next try. """
+        if self.session is not None:
+            try:
+                self.close()
+            except Exception:
+                pass
+
+        self.session = None
+        self.backoff = min(self.max_backoff, max(1, self.backoff * 2))
+        self.next_attempt = time.time() + self.backoff
+        print "    Retrying %s in %i seconds" % (self.target, self.backoff)
+
+    def connected(self):
+        """ Return true if we have a session, trying to get one if it's time """
+        if self.session is None and time.time() >= self.next_attempt:
+            self.connect()
+        return self.session is not None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.target)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def settle(self, ticket, taken=True):
+        if self.ledger:
+            self.ledger.settle(ticket, taken)
+
+    def put(self, topic, msg, ticket=None):
+        """ Hand `msg` to the worker.  Only blocks under the 'block' policy. """
+        if self.policy == 'block':
+            self.queue.put((topic, msg, ticket))
+            return
+
+        try:
+            self.queue.put_nowait((topic, msg, ticket))
+        except Queue.Full:
+            self.dropped += 1
+            self.settle(ticket)
+
+    def transfer(self, topic, msg):
+        """ Try to send `msg` right now.  Return true on success. """
+        if not self.connected():
+            return False
+
+        try:
+            self.publish(topic, msg)
+            self.sent += 1
+            return True
+        except Exception as e:
+            self.errors += 1
+            print "    Failed to send to", self.target, str(e)
+            self.disconnect()
+            return False
+
+    def deliver(self, topic, msg, ticket=None):
+        """ Send `msg`, or spool it for later if we can't. """
+        if self.transfer(topic, msg):
+            self.settle(ticket)
+            return
+
+        if self.spool and self.spool.append(topic, msg):
+            self.spooled += 1
+            self.settle(ticket)
+        else:
+            self.dropped += 1
+            self.settle(ticket, not self.stopping)
+
+    def catch_up(self):
+        """ Send some spooled messages, without exceeding the catch-up rate """
+        if not (self.spool and self.spool.pending()):
+            return
+
+        now = time.time()
+        self.tokens = min(self.catch_up_rate,
+                          self.tokens + (now - self.last_refill) *
+                          self.catch_up_rate)
+        self.last_refill = now
+
+        while self.tokens >= 1 and self.spool.pending():
+            head = self.spool.peek()
+            if head is None:
+                break
+            topic, msg = head
+            if not self.transfer(topic, msg):
+                break
+            self.spool.pop()
+            self.tokens -= 1
+
+    def run(self):
+        while True:
+            # Connect before there's traffic, not when it arrives: a zmq PUB
+            # socket drops whatever it's handed before subscribers join, and
+            # a broker that's down should show up in the log right away.
+            self.connected()
+
+            # Don't sleep forever if there's reconnecting or catching up to do
+            timeout = None
+            if self.session is None or (self.spool and self.spool.pending()):
+                timeout = 0.1
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                item = ()
+
+            if item is None:
+                break
+
+            if item:
+                self.deliver(*item)
+
+            self.catch_up()
+
+    def stop(self):
+        """ Drain whatever is queued up, then close the session. """
+        self.stopping = True
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.spool:
+            self.spool.close()
+
+        if self.session is not None:
+            self.close()
+
+    def stats(self):
+        backlog = 0
+        if self.spool:
+            backlog = self.spool.size - self.spool.offset
+        return ("%s: sent=%i dropped=%i errors=%i queued=%i spooled=%i "
+                "backlog=%ib" % (
+                    self.target, self.sent, self.dropped, self.errors,
+                    self.queue.qsize(), self.spooled, backlog))
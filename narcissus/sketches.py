@@ -0,0 +1,338 @@
+""" sketches.py -- busy keys and unique clients, in bounded memory.
+
+Some categories have a very long tail: the first path segment of every file
+on a mirror, say, easily runs to tens of thousands of keys.  Every key used to
+get its own history, rrd file and flot series, forever.  Most of them are hit
+once in a blue moon and nobody looks at them.
+
+A :class:`TopK` keeps tabs on the `k` busiest keys and rolls everything else
+up into :data:`OTHER`.  It is Space-Saving (Metwally et al.) with a
+Count-Min sketch in front of it, as a filter: a key from the tail only takes
+the place of the least busy tracked one once the sketch says it's been
+busier.  Plain Space-Saving would let every new key in, briefly, which makes
+the bottom of the top-K flicker from one poll to the next.
+
+Both decay, so a key that *was* busy doesn't hold on to its place forever.
+
+How many different clients hit a key is estimated with a
+:class:`HyperLogLog` per key and timestep, which :class:`UniqueWindows` adds
+up over the hour and the day.
+
+This only depends on the standard library.
+"""
+
+import hashlib
+import array
+import heapq
+import math
+
+# Where the keys that didn't make the cut are counted.
+OTHER = '(other)'
+
+
+class CountMinSketch(object):
+    """ Approximate counts of any number of keys in `depth` rows of `width`
+    counters.  Estimates are never low, and high by at most about
+    ``2 / width`` of the total with probability ``1 - 2 ** -depth``. """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array('d', [0.0]) * width for i in range(depth)]
+
+    def cells(self, key):
+        # One hash, split into as many indexes as there are rows (the
+        # Kirsch-Mitzenmacher trick).
+        first = hash(key)
+        second = hash((key, 'narcissus')) | 1
+        return [(first + i * second) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """ Count `count` more of `key`, and return its new estimate """
+        estimate = None
+        for row, cell in zip(self.rows, self.cells(key)):
+            row[cell] += count
+            if estimate is None or row[cell] < estimate:
+                estimate = row[cell]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in zip(self.rows, self.cells(key)))
+
+    def decay(self, factor):
+        """ Scale every count by `factor` """
+        for i, row in enumerate(self.rows):
+            self.rows[i] = array.array('d', [value * factor for value in row])
+
+
+class TopK(object):
+    """ Tracks the `k` busiest keys seen, and roughly how busy they are.
+
+    Counts are multiplied by `decay` every time :meth:`fold` is called.  The
+    Count-Min filter is `width` by `depth`.
+
+    The least busy tracked key is found with a heap of ``(count, key)``, one
+    entry per key.  Bumping a tracked key leaves its entry alone, so entries
+    can be behind; they're only brought up to date when they come out on
+    top.  Adding a hit is O(log k) however big `k` is.
+    """
+
+    def __init__(self, k, decay=1.0, width=2048, depth=4):
+        if k < 1:
+            raise ValueError("A TopK needs room for at least one key")
+
+        self.k = k
+        self.decay = decay
+        self.sketch = CountMinSketch(width, depth)
+        self.counts = {}
+        self.heap = []
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def add(self, key, count=1):
+        """ Count `count` more hits on `key` """
+
+        estimate = self.sketch.add(key, count)
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+
+        if len(counts) < self.k:
+            counts[key] = count
+            heapq.heappush(self.heap, (count, key))
+            return
+
+        # Space-Saving would hand the least busy key's place (and count) to
+        # `key` right away.  We wait until the sketch thinks it's earned it.
+        floor, floor_key = self.floor()
+        if estimate > floor:
+            del counts[floor_key]
+            counts[key] = min(estimate, floor + count)
+            heapq.heapreplace(self.heap, (counts[key], key))
+
+    def floor(self):
+        """ Return ``(count, key)`` of the least busy tracked key, leaving it
+        on top of the heap. """
+        heap, counts = self.heap, self.counts
+        while True:
+            count, key = heap[0]
+            if counts[key] == count:
+                return count, key
+            # It's been bumped since; it may not be the least busy any more.
+            heapq.heapreplace(heap, (counts[key], key))
+
+    def top(self):
+        """ Return ``[(key, count)]`` for the tracked keys, busiest first. """
+        return sorted(self.counts.items(), key=lambda item: -item[1])
+
+    def name(self, key):
+        """ `key` if it's one of the busiest, otherwise :data:`OTHER` """
+        return key if key in self.counts else OTHER
+
+    def fold(self, bucket):
+        """ Count a timestep's ``{key: hits}``, and return it with the keys
+        that aren't among the busiest rolled up into :data:`OTHER`. """
+
+        if self.decay != 1.0:
+            self.sketch.decay(self.decay)
+            for key in self.counts:
+                self.counts[key] *= self.decay
+            self.heap = [(count, key) for key, count in self.counts.iteritems()]
+            heapq.heapify(self.heap)
+
+        for key, count in bucket.iteritems():
+            self.add(key, count)
+
+        folded = {}
+        for key, count in bucket.iteritems():
+            key = self.name(key)
+            folded[key] = folded.get(key, 0) + count
+        return folded
+
+
+def hll_position(item, precision=12):
+    """ Return which register `item` lands in, of the ``2 ** precision`` in a
+    :class:`HyperLogLog`, and the rank it leaves there.  Work this out once
+    per item, and it can go into any number of sketches. """
+
+    value = int(hashlib.md5(item).hexdigest()[:16], 16)
+    bits = 64 - precision
+    rest = value & ((1 << bits) - 1)
+    return value >> bits, bits - rest.bit_length() + 1
+
+
+class HyperLogLog(object):
+    """ Estimates how many different items were added, to within about
+    ``1.04 / sqrt(2 ** precision)`` (1.6% at the default precision of 12).
+
+    Sketches with the same precision can be merged, so the sketches of many
+    timesteps add up to the sketch of the hour.  Registers start out sparse,
+    as a dict; a sketch only takes its full ``2 ** precision`` bytes once
+    it's seen enough items to need them.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.m = 1 << precision
+        self.sparse = {}
+        self.registers = None
+
+    def add(self, item):
+        self.add_position(*hll_position(item, self.precision))
+
+    def add_position(self, index, rank):
+        """ Add an item given its :func:`hll_position` """
+        registers = self.registers
+        if registers is not None:
+            if rank > registers[index]:
+                registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) > self.m / 32:
+                self.densify()
+
+    def densify(self):
+        if self.registers is None:
+            self.registers = bytearray(self.m)
+            for index, rank in self.sparse.iteritems():
+                self.registers[index] = rank
+            self.sparse = {}
+
+    def positions(self):
+        """ Return ``[(index, rank)]`` for every register in use """
+        if self.registers is None:
+            return self.sparse.items()
+        return [(index, rank) for index, rank in enumerate(self.registers)
+                if rank]
+
+    def merge(self, other):
+        """ Fold `other` into this sketch: afterwards it counts everything
+        either of them saw. """
+
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLogs of different precision")
+
+        if other.registers is not None:
+            self.densify()
+            self.registers = bytearray(map(max, self.registers,
+                                           other.registers))
+        else:
+            for index, rank in other.sparse.iteritems():
+                self.add_position(index, rank)
+        return self
+
+    def estimate(self):
+        """ Return roughly how many different items there were """
+        m = self.m
+        used = self.positions()
+        zeros = m - len(used)
+        total = zeros + sum(2.0 ** -rank for index, rank in used)
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / total
+
+        # Small cardinalities are better counted by the empty registers.
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def dumps(self):
+        """ The registers as a string, for :meth:`loads`.  A sparse sketch
+        stays sparse. """
+        if self.registers is not None:
+            return str(self.registers)
+        registers = bytearray(self.m)
+        for index, rank in self.sparse.iteritems():
+            registers[index] = rank
+        return str(registers)
+
+    @classmethod
+    def loads(cls, data):
+        sketch = cls(int(math.log(len(data), 2)))
+        registers = bytearray(data)
+        if len(registers) - registers.count('\0') > sketch.m / 32:
+            sketch.registers = registers
+        else:
+            sketch.sparse = dict((index, rank) for index, rank
+                                 in enumerate(registers) if rank)
+        return sketch
+
+
+class UniqueWindows(object):
+    """ Unique client sketches for every key of a category, over the current
+    hour and day (UTC).
+
+    When a window is up, :meth:`roll` hands back its sketches, for the
+    record, and starts over.  The windows still going are :meth:`current`;
+    what they had can be picked back up after a restart with :meth:`resume`.
+    """
+
+    spans = [('hour', 3600), ('day', 86400)]
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.sketches = dict((name, {}) for name, seconds in self.spans)
+        self.started = dict((name, None) for name, seconds in self.spans)
+        # Estimates of the keys nothing's been added to since.
+        self.cached = {}
+
+    def roll(self, now):
+        """ Start new windows if it's time.  Returns ``[(name, start,
+        {key: HyperLogLog})]`` for the windows that closed. """
+
+        closed = []
+        for name, seconds in self.spans:
+            start = int(now) - int(now) % seconds
+            if self.started[name] != start:
+                if self.started[name] is not None and self.sketches[name]:
+                    closed.append((name, self.started[name],
+                                   self.sketches[name]))
+                self.sketches[name] = {}
+                self.started[name] = start
+                self.cached = {}
+        return closed
+
+    def current(self):
+        """ Return ``[(name, start, {key: HyperLogLog})]`` for the windows
+        that are still going and have anything in them. """
+        return [(name, self.started[name], self.sketches[name])
+                for name, seconds in self.spans if self.sketches[name]]
+
+    def resume(self, name, start, sketches, now):
+        """ Count `sketches`, kept from window `name` that began at `start`,
+        towards that window again.  Returns false, and does nothing, if the
+        window's over by `now`. """
+
+        seconds = dict(self.spans)[name]
+        if start != int(now) - int(now) % seconds:
+            return False
+
+        if self.started[name] != start:
+            self.sketches[name] = {}
+            self.started[name] = start
+        window = self.sketches[name]
+        for key, sketch in sketches.iteritems():
+            if key in window:
+                window[key].merge(sketch)
+            else:
+                window[key] = sketch
+        self.cached = {}
+        return True
+
+    def add(self, key, sketch):
+        """ Count the clients in `sketch` towards `key`, in every window """
+        for name, seconds in self.spans:
+            window = self.sketches[name]
+            if key not in window:
+                window[key] = HyperLogLog(self.precision)
+            window[key].merge(sketch)
+        self.cached.pop(key, None)
+
+    def estimates(self, key):
+        """ Return ``{'hour': clients, 'day': clients}`` for `key` """
+        if key not in self.cached:
+            self.cached[key] = dict(
+                (name, self.sketches[name][key].estimate()
+                 if key in self.sketches[name] else 0)
+                for name, seconds in self.spans)
+        return self.cached[key]
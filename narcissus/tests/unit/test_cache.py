@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the bounded LRU cache"""
+from nose.tools import eq_, assert_raises
+
+from narcissus.cache import LRUCache
+
+
+class TestLRUCache(object):
+    """Unit tests for the LRU cache."""
+
+    def setUp(self):
+        self.cache = LRUCache(4)
+
+    def test_get_put(self):
+        """What goes in comes back out"""
+        self.cache.put('a', 1)
+        eq_(self.cache.get('a'), 1)
+        eq_(self.cache.get('b', 'nope'), 'nope')
+
+    def test_bounded(self):
+        """The cache never holds more than its size"""
+        for i in range(100):
+            self.cache.put(i, i)
+            assert len(self.cache) <= 4
+        eq_(self.cache.stats()['evictions'], 100 - len(self.cache))
+
+    def test_recently_used_survive(self):
+        """Entries that keep getting used aren't thrown out"""
+        self.cache.put('hot', 1)
+        for i in range(100):
+            self.cache.put(i, i)
+            eq_(self.cache.get('hot'), 1)
+
+    def test_stats(self):
+        """Hits and misses are counted"""
+        self.cache.put('a', 1)
+        self.cache.get('a')
+        self.cache.get('a')
+        self.cache.get('b')
+        stats = self.cache.stats()
+        eq_((stats['hits'], stats['misses']), (2, 1))
+        eq_(round(stats['hit_rate'], 2), 0.67)
+
+    def test_too_small(self):
+        """A cache has to have some room"""
+        assert_raises(ValueError, LRUCache, 1)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the sharded hit counters"""
+from nose.tools import eq_, assert_raises
+
+from narcissus.counters import ShardedCounter, ExtractionPlan, PAIRED
+from narcissus.sketches import hll_position
+
+import threading
+
+
+class TestShardedCounter(object):
+    """Unit tests for counting across threads."""
+
+    def setUp(self):
+        self.counter = ShardedCounter()
+
+    def test_add_and_dump(self):
+        """Counts come back out, and start over"""
+        self.counter.add(['a', 'b', 'a'])
+        self.counter.add([('x', 'y')])
+        eq_(self.counter.dump(), {'a': 2, 'b': 1, ('x', 'y'): 1})
+        eq_(self.counter.dump(), {})
+
+    def test_one_shard_per_thread(self):
+        """Every thread counts in a shard of its own, all of them merged"""
+        def count():
+            for i in range(1000):
+                self.counter.add(['hit'])
+
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        self.counter.add(['hit'])
+        for thread in threads:
+            thread.join()
+
+        eq_(len(self.counter.shards), 5)
+        eq_(self.counter.dump(), {'hit': 4001})
+
+    def test_dead_threads(self):
+        """Shards of threads that are gone are dropped once emptied"""
+        thread = threading.Thread(target=self.counter.add, args=(['hit'],))
+        thread.start()
+        thread.join()
+        eq_(self.counter.dump(), {'hit': 1})
+        eq_(self.counter.shards, [])
+
+    def test_nothing_lost(self):
+        """Dumping while other threads count doesn't lose any"""
+        done = []
+
+        def count():
+            for i in range(2000):
+                self.counter.add(['hit'])
+            done.append(True)
+
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+
+        total = 0
+        while len(done) < len(threads):
+            total += self.counter.dump().get('hit', 0)
+        for thread in threads:
+            thread.join()
+        total += self.counter.dump().get('hit', 0)
+        eq_(total, 8000)
+
+    def test_uniques(self):
+        """Clients are counted once per key, across threads"""
+        def count(client):
+            self.counter.add(['a', 'b'], hll_position(client), ['a'])
+
+        threads = [threading.Thread(target=count, args=(client,))
+                   for client in ['1.2.3.4', '5.6.7.8', '1.2.3.4']]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        count('9.9.9.9')
+
+        uniques = self.counter.dump_uniques()
+        eq_(uniques.keys(), ['a'])
+        eq_(uniques['a'].estimate(), 3)
+        eq_(self.counter.dump_uniques(), {})
+        eq_(self.counter.dump(), {'a': 4, 'b': 4})
+
+
+class TestExtractionPlan(object):
+    """Unit tests for working out what a hit counts towards."""
+
+    def setUp(self):
+        self.calls = []
+
+        def extractor(name):
+            def extract(hit):
+                self.calls.append(name)
+                return hit.get(name)
+            return extract
+
+        self.extractors = dict((name, extractor(name))
+                               for name in ['country', 'tag', 'os'])
+
+    def test_every_pair(self):
+        """By default every ordered pair is wanted, but counted one way"""
+        plan = ExtractionPlan(self.extractors, ['country', 'tag'])
+        eq_(plan.views, [('country', 'tag'), ('tag', 'country')])
+        values = plan.extract({'country': 'France', 'tag': 'fedora'})
+        eq_(values, ('France', 'fedora'))
+        eq_(plan.keys(values), [
+            ('country', 'France'), ('tag', 'fedora'),
+            (PAIRED, 'country', 'tag', 'France', 'fedora'),
+        ])
+
+    def test_extract_once(self):
+        """Each extractor runs once per hit, however many pairs there are"""
+        plan = ExtractionPlan(self.extractors, ['country', 'tag', 'os'])
+        eq_((len(plan.views), len(plan.pairs)), (6, 3))
+        plan.keys(plan.extract({'country': 'France'}))
+        eq_(sorted(self.calls), ['country', 'os', 'tag'])
+
+    def test_chosen_pairs(self):
+        """Only the pairs asked for are counted, and missing keys skipped"""
+        plan = ExtractionPlan(self.extractors, ['country', 'tag', 'os'],
+                              [('country', 'os')])
+        eq_(plan.keys(plan.extract({'country': 'France', 'os': 'linux'})), [
+            ('country', 'France'), ('os', 'linux'),
+            (PAIRED, 'country', 'os', 'France', 'linux'),
+        ])
+
+    def test_repeated_pairs(self):
+        """A pair asked for twice is still counted once"""
+        plan = ExtractionPlan(self.extractors, ['country', 'tag'],
+                              [('country', 'tag'), ['country', 'tag'],
+                               ('tag', 'country')])
+        eq_(plan.views, [('country', 'tag'), ('tag', 'country')])
+        eq_(plan.keys(plan.extract({'country': 'France', 'tag': 'epel'})), [
+            ('country', 'France'), ('tag', 'epel'),
+            (PAIRED, 'country', 'tag', 'France', 'epel'),
+        ])
+
+    def test_bad_pairs(self):
+        """Pairs of unknown categories, or of one with itself, are refused"""
+        for pairs in [[('country', 'planet')], [('tag', 'tag')], [('tag',)]]:
+            assert_raises(ValueError, ExtractionPlan, self.extractors,
+                          ['country', 'tag'], pairs)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the shared GeoIP locator"""
+from nose.tools import eq_, assert_raises
+
+import narcissus.geo as geo
+
+
+class TestLocator(object):
+    """Unit tests for the process-wide GeoIP locator."""
+
+    def tearDown(self):
+        geo.configure(geo.GEOIP_PATH, geo.DEFAULT_MODE,
+                      geo.DEFAULT_CACHE_SIZE)
+
+    def test_lazy(self):
+        """The database isn't opened until somebody needs it"""
+        locator = geo.Locator('/no/such/GeoLiteCity.dat')
+        eq_(locator._gi, None)
+
+    def test_shared(self):
+        """Everybody in the process gets the same locator"""
+        assert geo.locator() is geo.locator()
+
+    def test_configure(self):
+        """Reconfiguring only makes a new locator if something changed"""
+        locator = geo.locator()
+        assert geo.configure() is locator
+        assert geo.configure(locator.path, locator.mode) is locator
+
+        moved = geo.configure('/elsewhere/GeoLiteCity.dat')
+        assert moved is geo.locator() and moved is not locator
+        eq_(moved.mode, locator.mode)
+
+        resized = geo.configure(cache_size=10)
+        eq_(resized.settings()[:2], moved.settings()[:2])
+        eq_(resized.cache.size, 10)
+
+    def test_bad_mode(self):
+        """Unknown cache modes are refused"""
+        assert_raises(ValueError, geo.Locator, geo.GEOIP_PATH, 'telepathy')
+
+
+class FakeGeoIP(object):
+    """Knows where exactly one ip is, and counts how often it's asked."""
+
+    def __init__(self):
+        self.lookups = 0
+
+    def record_by_addr(self, ip):
+        self.lookups += 1
+        if ip == '129.21.1.1':
+            return {'latitude': 43.1, 'longitude': -77.6,
+                    'country_name': 'United States'}
+        return None
+
+
+class TestLocatorCache(object):
+    """Unit tests for remembering where ips are."""
+
+    def setUp(self):
+        self.locator = geo.Locator(cache_size=4)
+        self.locator._gi = self.gi = FakeGeoIP()
+
+    def test_repeats_skip_the_database(self):
+        """A repeat ip is answered from the cache"""
+        for i in range(3):
+            hit = {'ip': '129.21.1.1'}
+            assert self.locator.locate(hit)
+            eq_(hit['country'], 'United States')
+        eq_(self.gi.lookups, 1)
+        eq_(self.locator.stats()['hits'], 2)
+
+    def test_failures_are_remembered(self):
+        """Ips the database doesn't know aren't looked up again either"""
+        for i in range(3):
+            assert not self.locator.locate({'ip': '1.2.3.4'})
+        eq_(self.gi.lookups, 1)
+        eq_(self.locator.negative_stats()['hits'], 2)
+
+    def test_failures_leave_the_cache_alone(self):
+        """A flood of unknown ips doesn't push out the known ones"""
+        self.locator.locate({'ip': '129.21.1.1'})
+        for i in range(10):
+            self.locator.locate({'ip': '1.2.3.%i' % i})
+        assert self.locator.locate({'ip': '129.21.1.1'})
+        eq_(self.gi.lookups, 11)
+
+    def test_reserved(self):
+        """Private and reserved ips never get as far as the database"""
+        for ip in ['10.0.0.1', '192.168.1.1', '172.31.255.255', '127.0.0.1',
+                   '169.254.1.1', '224.0.0.1', '255.255.255.255',
+                   'not an ip', '::1']:
+            assert not self.locator.locate({'ip': ip})
+        eq_(self.gi.lookups, 0)
+        eq_(self.locator.negative_stats()['reserved'], 9)
+
+    def test_unroutable(self):
+        """Only reserved space is unroutable"""
+        assert geo.unroutable('172.16.0.1')
+        assert not geo.unroutable('172.32.0.1')
+        assert not geo.unroutable('8.8.8.8')
+        assert not geo.unroutable('129.21.1.1')
+
+    def test_no_cache(self):
+        """With cache_size=0 every lookup goes to the database"""
+        locator = geo.Locator(cache_size=0)
+        locator._gi = gi = FakeGeoIP()
+        for i in range(3):
+            locator.locate({'ip': '129.21.1.1'})
+        eq_(gi.lookups, 3)
+        eq_(locator.stats(), None)
+
+
+class FakeLogger(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+class TestUnresolvedLog(object):
+    """Unit tests for tallying hits that couldn't be geolocated."""
+
+    def test_tally(self):
+        """Failures are summed up, not logged one by one"""
+        logger = FakeLogger()
+        unresolved = geo.UnresolvedLog(logger, interval=3600)
+        for i in range(100):
+            unresolved.add(1, {'ip': '1.2.3.4'})
+        unresolved.add(20)
+        eq_(logger.warnings, [])
+
+        unresolved.flush()
+        eq_(len(logger.warnings), 1)
+        assert logger.warnings[0].startswith("120 hits could not be")
+        assert '1.2.3.4' in logger.warnings[0]
+
+        unresolved.flush()
+        eq_(len(logger.warnings), 1)
+
+    def test_interval(self):
+        """Once the interval is up, the next failure logs the tally"""
+        logger = FakeLogger()
+        unresolved = geo.UnresolvedLog(logger, interval=0)
+        unresolved.add(3)
+        unresolved.add(4)
+        eq_(len(logger.warnings), 2)
+        assert logger.warnings[1].startswith("4 hits")
+
+    def test_tick(self):
+        """The last of a burst is logged once the interval is up"""
+        logger = FakeLogger()
+        unresolved = geo.UnresolvedLog(logger, interval=3600)
+        unresolved.add(5)
+        geo.tick_unresolved()
+        eq_(logger.warnings, [])
+
+        unresolved.since -= 3600
+        geo.tick_unresolved()
+        eq_(len(logger.warnings), 1)
+        assert logger.warnings[0].startswith("5 hits")
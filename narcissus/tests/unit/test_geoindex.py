@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the precompiled GeoIP range index"""
+from nose.tools import eq_, assert_raises
+
+import narcissus.geoindex as geoindex
+import narcissus.geo as geo
+
+import tempfile
+import struct
+import os
+
+SEGMENTS = 3
+NOTHING, ROCHESTER, PARIS = SEGMENTS, SEGMENTS + 10, SEGMENTS + 20
+
+
+def record(value):
+    return struct.pack('<I', value)[:3]
+
+
+def city_database():
+    """ A three node GeoIP City trie: nothing below 64.0.0.0, Paris up to
+    127.255.255.255, and Rochester above that (as two ranges). """
+
+    nodes = [(1, 2), (NOTHING, PARIS), (ROCHESTER, ROCHESTER)]
+    tree = ''.join(record(left) + record(right) for left, right in nodes)
+    return tree + '\xff\xff\xff' + chr(2) + record(SEGMENTS)
+
+
+class FakeGeoIP(object):
+    """Knows the two places in city_database()."""
+
+    def __init__(self):
+        self.lookups = 0
+
+    def record_by_addr(self, ip):
+        self.lookups += 1
+        if geoindex.ip_to_int(ip) >= geoindex.ip_to_int('128.0.0.0'):
+            return {'latitude': 43.1548, 'longitude': -77.6156,
+                    'country_name': 'United States'}
+        return {'latitude': 48.8667, 'longitude': 2.3333,
+                'country_name': 'France'}
+
+
+class TestRangeIndex(object):
+    """Unit tests for compiling and searching the range index."""
+
+    def setUp(self):
+        self.gi = FakeGeoIP()
+        self.index = geoindex.RangeIndex.compile(city_database(), self.gi)
+        self.numpy = geoindex.numpy
+
+    def tearDown(self):
+        geoindex.numpy = self.numpy
+
+    def test_read_ranges(self):
+        """The trie comes out as ranges, lowest first"""
+        eq_(list(geoindex.read_ranges(city_database())), [
+            (geoindex.ip_to_int('64.0.0.0'),
+             geoindex.ip_to_int('127.255.255.255'), PARIS),
+            (geoindex.ip_to_int('128.0.0.0'),
+             geoindex.ip_to_int('191.255.255.255'), ROCHESTER),
+            (geoindex.ip_to_int('192.0.0.0'),
+             geoindex.ip_to_int('255.255.255.255'), ROCHESTER),
+        ])
+
+    def test_not_a_city_database(self):
+        """Other GeoIP editions are turned down"""
+        data = city_database()[:-4] + chr(1) + record(SEGMENTS)
+        assert_raises(ValueError, geoindex.city_segments, data)
+        assert_raises(ValueError, geoindex.city_segments, 'hello')
+
+    def test_compile(self):
+        """One lookup per place, and neighbours in the same place merge"""
+        eq_(self.gi.lookups, 2)
+        eq_(len(self.index), 2)
+        eq_(sorted(self.index.names), ['France', 'United States'])
+
+    def lookups(self):
+        return self.index.lookup_many(
+            ['10.0.0.1', '64.0.0.0', '127.255.255.255', '129.21.1.1',
+             '255.255.255.255', 'not an ip'])
+
+    def check(self, found):
+        paris = (48.8667, 2.3333, 'France')
+        rochester = (43.1548, -77.6156, 'United States')
+        eq_(found, [None, paris, paris, rochester, rochester, None])
+
+    def test_lookup_many(self):
+        """Bulk lookups find the range each ip falls in"""
+        self.check(self.lookups())
+
+    def test_lookup_many_without_numpy(self):
+        """Bisecting gives the same answers as numpy"""
+        geoindex.numpy = None
+        self.index = geoindex.RangeIndex.compile(city_database(), self.gi)
+        self.check(self.lookups())
+
+    def test_empty(self):
+        """An empty index knows nothing"""
+        index = geoindex.RangeIndex([], [], [], [], [], [])
+        eq_(index.lookup_many(['129.21.1.1']), [None])
+
+    def test_save_and_load(self):
+        """An index survives a trip through a file"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.index.save(path)
+            self.index = geoindex.RangeIndex.load(path)
+            self.check(self.lookups())
+
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:-1])
+            assert_raises(ValueError, geoindex.RangeIndex.load, path)
+        finally:
+            os.unlink(path)
+
+
+class TestCountries(object):
+    """Unit tests for the country level index."""
+
+    def setUp(self):
+        # Two cities in the US, then one in France.
+        self.index = geoindex.RangeIndex(
+            [0, 10, 30], [9, 29, 39], [40.0, 40.0, 48.8667],
+            [-100.0, -80.0, 2.3333], [0, 0, 1], ['United States', 'France'])
+
+    def test_countries_only(self):
+        """Ranges in the same country merge, at its centroid"""
+        countries = self.index.countries_only()
+        eq_(countries.resolution, 'country')
+        eq_(countries.starts.tolist(), [0, 30])
+        eq_(countries.ends.tolist(), [29, 39])
+
+        lat, lon, country = countries.lookup('0.0.0.5')
+        eq_(country, 'United States')
+        assert 40 < lat < 41 and -90 < lon < -85, (lat, lon)
+        eq_(countries.lookup('0.0.0.35'), (48.8667, 2.3333, 'France'))
+        eq_(countries.lookup('0.0.0.40'), None)
+
+    def test_centroids_given(self):
+        """Centroids can be overridden"""
+        countries = self.index.countries_only(
+            {'United States': (39.83, -98.58)})
+        eq_(countries.lookup('0.0.0.20'), (39.83, -98.58, 'United States'))
+
+    def test_antimeridian(self):
+        """A country either side of 180 degrees stays there"""
+        index = geoindex.RangeIndex([0, 10], [9, 19], [-17.0, -17.0],
+                                    [179.0, -179.0], [0, 0], ['Fiji'])
+        lat, lon = index.centroids()['Fiji']
+        assert abs(lat + 17) < 0.1 and abs(abs(lon) - 180) < 0.01, (lat, lon)
+
+    def test_saved(self):
+        """The resolution survives a trip through a file"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.index.countries_only().save(path)
+            eq_(geoindex.RangeIndex.load(path).resolution, 'country')
+        finally:
+            os.unlink(path)
+
+
+class TestLocateMany(object):
+    """Unit tests for geolocating batches of hits."""
+
+    def test_with_index(self):
+        """A locator with an index uses it, and skips the database"""
+        locator = geo.Locator()
+        locator._gi = gi = FakeGeoIP()
+        locator._index = geoindex.RangeIndex.compile(city_database(), gi)
+        gi.lookups = 0
+
+        hits = [{'ip': '129.21.1.1'}, {'ip': '10.0.0.1'}, {'ip': '64.1.1.1'}]
+        located = locator.locate_many(hits)
+        eq_([hit['ip'] for hit in located], ['129.21.1.1', '64.1.1.1'])
+        eq_(located[1]['country'], 'France')
+        eq_(gi.lookups, 0)
+
+    def test_without_index(self):
+        """Without one, each hit is looked up (and cached) on its own"""
+        locator = geo.Locator(index='/no/such/GeoLiteCity.idx')
+        locator._gi = FakeGeoIP()
+
+        located = locator.locate_many([{'ip': '129.21.1.1'}])
+        eq_(located[0]['country'], 'United States')
+        eq_(locator.index, None)
+        eq_(locator.stats()['misses'], 1)
+
+
+class TestCountryResolution(object):
+    """Unit tests for locating hits at country resolution."""
+
+    def test_needs_an_index(self):
+        """Country resolution without an index is refused"""
+        assert_raises(ValueError, geo.Locator, resolution='country')
+        assert_raises(ValueError, geo.Locator, index='x.idx',
+                      resolution='planet')
+
+    def test_skips_the_database(self):
+        """Every lookup is answered from the index"""
+        locator = geo.Locator(index='countries.idx', resolution='country')
+        locator._gi = gi = FakeGeoIP()
+        locator._index = geoindex.RangeIndex.compile(
+            city_database(), FakeGeoIP()).countries_only()
+
+        hit = {'ip': '129.21.1.1'}
+        assert locator.locate(hit)
+        eq_(hit['country'], 'United States')
+        assert not locator.locate({'ip': '10.0.0.1'})
+        eq_(gi.lookups, 0)
+
+    def test_falls_back(self):
+        """If the index won't load, the database it is"""
+        locator = geo.Locator(index='/no/such/countries.idx',
+                              resolution='country')
+        locator._gi = gi = FakeGeoIP()
+        assert locator.locate({'ip': '129.21.1.1'})
+        eq_(gi.lookups, 1)
+        eq_(locator.index_path, '/no/such/countries.idx')
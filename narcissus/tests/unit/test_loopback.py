@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the in-process loopback hub"""
+from nose.tools import eq_
+
+from narcissus.loopback import LoopbackHub
+
+
+class Recorder(object):
+    """A stand-in consumer that remembers what it was handed."""
+
+    def __init__(self, topic, jsonify):
+        self.topic = topic
+        self.jsonify = jsonify
+        self.got = []
+
+    def consume(self, message):
+        self.got.append(message)
+
+
+class TestLoopbackHub(object):
+    """Unit tests for message routing through the loopback hub."""
+
+    def setUp(self):
+        self.hub = LoopbackHub()
+
+    def test_json_roundtrip(self):
+        """Consumers with jsonify get the decoded body in a dict"""
+        recorder = self.hub.add_consumer(Recorder('foo', True))
+        self.hub.send_message('foo', {'a': 1})
+        self.hub.pump()
+        eq_(recorder.got, [{'topic': 'foo', 'body': {'a': 1}}])
+
+    def test_raw_body(self):
+        """Consumers without jsonify get the body untouched"""
+        recorder = self.hub.add_consumer(Recorder('foo', False))
+        self.hub.send_message('foo', 'raw line', jsonify=False)
+        self.hub.pump()
+        eq_(recorder.got[0].body, 'raw line')
+
+    def test_sinks_and_stages(self):
+        """Unconsumed topics are counted and deliveries are timed"""
+        self.hub.add_consumer(Recorder('foo', True))
+        self.hub.send_message('foo', 1)
+        self.hub.send_message('bar', 2)
+        self.hub.pump()
+        eq_(dict(self.hub.sunk), {'bar': 1})
+        eq_(len(self.hub.stages['Recorder'].service), 1)
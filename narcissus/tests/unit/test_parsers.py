@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the access log parsers"""
+from nose.tools import eq_, assert_raises
+from datetime import datetime, timedelta
+
+import narcissus.parsers as parsers
+
+import time
+
+
+class TestParsers(object):
+    """Unit tests for turning log lines into hit records."""
+
+    line = ('129.21.1.1 mirror.rit.edu - [15/Apr/2011:13:37:00 -0400] '
+            '"GET /fedora/linux/foo.rpm HTTP/1.1" 200 1234 "-" '
+            '"urlgrabber/3.9.1 yum/3.2.29" 312 1520\n')
+
+    def test_parse_line(self):
+        """A well formed line parses into a hit record"""
+        record = parsers.parse_line(self.line)
+        eq_(record['ip'], '129.21.1.1')
+        eq_(record['logdatetime'], '2011-04-15 13:37:00-04:00')
+        eq_(record['tag'], '/fedora/linux/foo.rpm')
+        eq_(record['statuscode'], '200')
+        eq_(record['bytesout'], '1520')
+
+    def test_parse_garbage(self):
+        """Lines in some other format don't parse"""
+        eq_(parsers.parse_line('not a log line\n'), None)
+
+    def test_record_roundtrip(self):
+        """Packed records unpack to the same hit record"""
+        record = parsers.parse_line(self.line)
+        eq_(parsers.unpack_record(parsers.pack_record(record)), record)
+
+    def test_malformed_record(self):
+        """Records with the wrong number of fields are rejected"""
+        assert_raises(ValueError, parsers.unpack_record, '["1.2.3.4"]')
+
+    def test_digest_mismatch(self):
+        """Records digested some other way than ours are rejected"""
+        try:
+            parsers.set_digest('crc32')
+            packed = parsers.pack_record(parsers.parse_line(self.line))
+        finally:
+            parsers.set_digest('md5')
+        assert_raises(ValueError, parsers.unpack_record, packed)
+
+    def test_long_user_agent(self):
+        """A huge user agent, escaped quotes and all, still parses"""
+        agent = 'Mozilla/5.0 (X11; U; Linux x86_64) \\"quoted\\" ' * 500
+        line = self.line.replace('urlgrabber/3.9.1 yum/3.2.29', agent)
+        fields = parsers.parse_fields(line)
+        eq_(fields[10], agent)
+        eq_(fields[11:], ('312', '1520'))
+
+    def test_quoted_referer(self):
+        """Referers are quoted strings too"""
+        line = self.line.replace('"-"', '"http://example.com/a b"')
+        eq_(parsers.parse_fields(line)[9], 'http://example.com/a b')
+
+    def test_long_garbage(self):
+        """Long lines that don't match are turned down quickly"""
+        line = self.line.rstrip('\n') + ' junk' * 20000
+        start = time.time()
+        eq_(parsers.parse_line(line), None)
+        assert time.time() - start < 0.5
+
+
+class TestDigester(object):
+    """Unit tests for the memoized user agent digests."""
+
+    def test_md5(self):
+        """md5 digests match hashlib's, however often they're asked for"""
+        from hashlib import md5
+        digest = parsers.Digester('md5')
+        for i in range(3):
+            eq_(digest('curl/7.21'), md5('curl/7.21').hexdigest())
+        eq_(digest.stats()['hits'], 2)
+
+    def test_crc32(self):
+        """crc32 digests are short and stable"""
+        digest = parsers.Digester('crc32')
+        eq_(digest('curl/7.21'), parsers.Digester('crc32')('curl/7.21'))
+        eq_(len(digest('curl/7.21')), 8)
+
+    def test_set_digest(self):
+        """Switching digests changes the refererhash of new records"""
+        try:
+            parsers.set_digest('crc32')
+            eq_(len(parsers.parse_line(TestParsers.line)['refererhash']), 8)
+        finally:
+            parsers.set_digest('md5')
+        eq_(len(parsers.parse_line(TestParsers.line)['refererhash']), 32)
+        assert_raises(ValueError, parsers.set_digest, 'sha9000')
+
+
+class TestTimestampDecoder(object):
+    """Unit tests for decoding logged timestamps."""
+
+    def setUp(self):
+        self.decode = parsers.TimestampDecoder(size=2)
+
+    def test_timezone(self):
+        """The UTC offset is kept, in the datetime and its text"""
+        when, text = self.decode('15/Apr/2011:13:37:00 -0400')
+        eq_(when.utcoffset(), timedelta(hours=-4))
+        eq_(when.replace(tzinfo=None), datetime(2011, 4, 15, 13, 37))
+        eq_(text, '2011-04-15 13:37:00-04:00')
+        eq_(self.decode('15/Apr/2011:17:37:00 +0000')[1],
+            '2011-04-15 17:37:00+00:00')
+
+    def test_matches_strptime(self):
+        """We decode the same wall clock time strptime would"""
+        stamp = '01/Dec/1999:23:59:59 +0530'
+        eq_(self.decode(stamp)[0].replace(tzinfo=None),
+            datetime.strptime(stamp.split()[0], "%d/%b/%Y:%H:%M:%S"))
+
+    def test_remembers(self):
+        """A stamp seen recently isn't decoded again"""
+        first = self.decode('15/Apr/2011:13:37:00 -0400')
+        self.decode('15/Apr/2011:13:37:01 -0400')
+        assert self.decode('15/Apr/2011:13:37:00 -0400') is first
+
+    def test_bounded(self):
+        """The cache never holds more than its size"""
+        for second in range(10):
+            self.decode('15/Apr/2011:13:37:%02i -0400' % second)
+        assert len(self.decode.cache) <= 2
+
+    def test_garbage(self):
+        """Stamps that aren't stamps raise ValueError"""
+        for stamp in ['15/Apr/2011:13:37:00', '15/Foo/2011:13:37:00 -0400',
+                      '31/Feb/2011:13:37:00 -0400', 'x' * 26]:
+            assert_raises(ValueError, self.decode, stamp)
+
+
+class TestLogFormats(object):
+    """Unit tests for the log format registry."""
+
+    combined = ('129.21.1.1 - - [15/Apr/2011:13:37:00 -0400] '
+                '"GET /fedora/foo.rpm HTTP/1.1" 200 1234 "-" '
+                '"Mozilla/5.0 \\"quoted\\" (X11)"\n')
+    common = '129.21.1.1 - - [15/Apr/2011:13:37:00 -0400] "GET / HTTP/1.0" 304 -\n'
+    nginx = ('{"remote_addr":"129.21.1.1","time_local":"15/Apr/2011:13:37:00 '
+             '-0400","request":"GET /fedora/foo.rpm HTTP/1.1","status":"200",'
+             '"body_bytes_sent":"1234","http_user_agent":"curl/7.21",'
+             '"request_length":"312","bytes_sent":"1520"}\n')
+
+    def test_builtin_formats(self):
+        """Each built-in format parses its own lines and nobody else's"""
+        lines = {
+            'lighttpd': TestParsers.line,
+            'combined': self.combined,
+            'common': self.common,
+            'nginx-json': self.nginx,
+        }
+        for name, line in lines.items():
+            for other in lines:
+                record = parsers.get_format(other).parse(line)
+                eq_(bool(record), name == other, (name, other))
+
+    def test_stamp(self):
+        """Each format can pick out just the timestamp"""
+        lines = {
+            'lighttpd': TestParsers.line,
+            'combined': self.combined,
+            'common': self.common,
+            'nginx-json': self.nginx,
+            'auto': self.combined,
+        }
+        for name, line in lines.items():
+            eq_(parsers.get_format(name).stamp(line),
+                '15/Apr/2011:13:37:00 -0400', name)
+            eq_(parsers.get_format(name).stamp('garbage\n'), None, name)
+
+    def test_same_record(self):
+        """Different formats of the same hit make the same record"""
+        nginx = parsers.get_format('nginx-json').parse(self.nginx)
+        eq_(nginx, parsers.parse_line(TestParsers.line.replace(
+            'urlgrabber/3.9.1 yum/3.2.29', 'curl/7.21').replace(
+            '/fedora/linux/foo.rpm', '/fedora/foo.rpm')))
+
+    def test_missing_values(self):
+        """Fields a format doesn't log come out as zeroes"""
+        record = parsers.get_format('common').parse(self.common)
+        eq_(record['statuscode'], '304')
+        eq_(record['filesize'], '0')
+        eq_(record['bytesout'], '0')
+
+    def test_null_json_values(self):
+        """Null JSON fields are treated like missing ones"""
+        line = self.nginx.replace('"curl/7.21"', 'null').replace(
+            '"1234"', 'null')
+        record = parsers.get_format('nginx-json').parse(line)
+        eq_(record['filesize'], '0')
+        eq_(record['refererhash'], parsers.digest_agent('-'))
+        eq_(parsers.get_format('nginx-json').parse(
+            self.nginx.replace('"200"', 'null')), None)
+
+    def test_custom_format(self):
+        """Apache LogFormat strings compile into formats of their own"""
+        log_format = parsers.get_format('%v %h %l %u %t "%r" %>s %b %D')
+        record = log_format.parse('mirror ' + self.common.rstrip() + ' 1234\n')
+        eq_(record['ip'], '129.21.1.1')
+        eq_(record['requesttype'], 'GET')
+
+    def test_bad_formats(self):
+        """Unknown names and formats without the essentials are refused"""
+        assert_raises(ValueError, parsers.get_format, 'iis')
+        assert_raises(ValueError, parsers.get_format, '%h %t %>s')
+
+    def test_detect(self):
+        """auto settles on whatever format most of the first lines are in"""
+        detector = parsers.get_format('auto')
+        for line in ['garbage\n', self.combined, self.combined]:
+            detector.parse(line)
+        eq_(detector.chosen, None)
+        for i in range(detector.sample):
+            assert detector.parse(self.combined)
+        eq_(detector.chosen, parsers.get_format('combined'))
+        eq_(detector.parse(self.nginx), None)
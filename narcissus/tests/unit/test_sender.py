@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the log sender's reading, batching and delivery"""
+from nose.tools import eq_
+
+from narcissus.sender import FileTailer, Batcher, HashRing, Ledger, Spool, \
+    Target
+import narcissus.wire as wire
+
+import tempfile
+import shutil
+import time
+import os
+
+
+class TempDir(object):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+class TestFileTailer(TempDir):
+    """Unit tests for tailing a log through rotations and restarts."""
+
+    def setUp(self):
+        super(TestFileTailer, self).setUp()
+        self.log = self.path('access.log')
+        self.checkpoint = self.path('access.log.offset')
+        self.write('old line\n')
+
+    def write(self, text):
+        with open(self.log, 'a') as f:
+            f.write(text)
+
+    def test_starts_at_the_end(self):
+        """Without a checkpoint, only new lines are read, like tail"""
+        tailer = FileTailer(self.log)
+        self.write('one\ntwo\n')
+        eq_(tailer.read_lines(0), ['one\n', 'two\n'])
+
+    def test_partial_lines(self):
+        """Half-written lines wait for the rest of them"""
+        tailer = FileTailer(self.log)
+        self.write('on')
+        eq_(tailer.read_lines(0), [])
+        self.write('e\n')
+        eq_(tailer.read_lines(0), ['one\n'])
+
+    def test_resume(self):
+        """A restart picks up at the checkpoint, less what's pending"""
+        tailer = FileTailer(self.log, self.checkpoint)
+        self.write('one\ntwo\n')
+        tailer.read_lines(0)
+        tailer.checkpoint(pending=len('two\n'))
+
+        eq_(FileTailer(self.log, self.checkpoint).read_lines(0), ['two\n'])
+
+    def test_rotation(self):
+        """A log moved away and recreated is followed to the new file"""
+        tailer = FileTailer(self.log, self.checkpoint)
+        self.write('one\n')
+        eq_(tailer.read_lines(0), ['one\n'])
+
+        os.rename(self.log, self.log + '.1')
+        self.write('two\n')
+        eq_(tailer.read_lines(0), [])
+        eq_(tailer.read_lines(0), ['two\n'])
+
+        tailer.checkpoint()
+        inode, offset = tailer.load_checkpoint()
+        eq_((inode, offset), (os.stat(self.log).st_ino, len('two\n')))
+
+    def test_truncation(self):
+        """A log truncated in place is read again from the top"""
+        tailer = FileTailer(self.log)
+        open(self.log, 'w').close()
+        eq_(tailer.read_lines(0), [])
+        self.write('one\n')
+        eq_(tailer.read_lines(0), ['one\n'])
+
+
+class TestBatcher(object):
+    """Unit tests for packing lines into messages."""
+
+    def test_full(self):
+        batcher = Batcher('topic', [], 2, 1.0)
+        batcher.add('a\n', 0)
+        assert not batcher.full()
+        batcher.add('b\n', 2)
+        assert batcher.full()
+        eq_(batcher.first, 0)
+        eq_(wire.unpack(batcher.flush()), ['a', 'b'])
+        eq_(batcher.lines, [])
+
+    def test_bare(self):
+        """Unbatched plain lines go out as they are"""
+        batcher = Batcher('topic', [], 1, 1.0)
+        batcher.add('a\n', 0)
+        eq_(batcher.flush(), 'a\n')
+
+    def test_timeout(self):
+        batcher = Batcher('topic', [], 10, 60.0)
+        eq_(batcher.timeout(), None)
+        batcher.add('a\n', 0)
+        assert 59 < batcher.timeout() <= 60
+
+
+class Named(object):
+    def __init__(self, target):
+        self.target = target
+
+
+class TestHashRing(object):
+    """Unit tests for sharding clients across targets."""
+
+    ips = ['10.0.%i.%i' % (i / 256, i % 256) for i in range(2000)]
+
+    def test_sticky(self):
+        """A client always goes to the same target"""
+        ring = HashRing([Named('a'), Named('b')])
+        eq_([ring.lookup(ip) for ip in self.ips],
+            [ring.lookup(ip) for ip in self.ips])
+
+    def test_spread(self):
+        """Clients are spread over every target"""
+        targets = [Named(name) for name in 'abc']
+        ring = HashRing(targets)
+        owners = [ring.lookup(ip) for ip in self.ips]
+        for target in targets:
+            assert owners.count(target) > len(self.ips) / 6
+
+    def test_few_move(self):
+        """Adding a target only moves the clients it takes over"""
+        a, b, c = Named('a'), Named('b'), Named('c')
+        before = HashRing([a, b])
+        after = HashRing([a, b, c])
+        moved = [ip for ip in self.ips
+                 if before.lookup(ip) is not after.lookup(ip)]
+        assert all(after.lookup(ip) is c for ip in moved)
+        assert len(moved) < len(self.ips) / 2
+
+
+class TestLedger(object):
+    """Unit tests for keeping track of what every target has taken."""
+
+    def test_low_water(self):
+        ledger = Ledger()
+        eq_(ledger.low_water(), None)
+        first = ledger.open(0, 2)
+        second = ledger.open(10, 1)
+        eq_(ledger.low_water(), 0)
+
+        ledger.settle(first)
+        eq_(ledger.low_water(), 0)
+        ledger.settle(first)
+        eq_(ledger.low_water(), 10)
+        ledger.settle(second)
+        eq_(ledger.low_water(), None)
+
+
+class Up(Target):
+    """ A target that takes everything. """
+
+    def open(self):
+        self.got = []
+        return self.got
+
+    def close(self):
+        pass
+
+    def publish(self, topic, msg):
+        self.session.append(msg)
+
+
+class Down(Target):
+    """ A target that can't be reached. """
+
+    def open(self):
+        raise IOError("unreachable")
+
+
+class TestCheckpoints(TempDir):
+    """Unit tests for checkpointing what every target has taken."""
+
+    def setUp(self):
+        super(TestCheckpoints, self).setUp()
+        self.log = self.path('access.log')
+        open(self.log, 'w').close()
+        self.ledger = Ledger()
+        self.up = Up('up', 'drop', 10, ledger=self.ledger)
+        self.down = Down('down', 'drop', 10, ledger=self.ledger,
+                         max_backoff=0)
+        self.tailer = FileTailer(self.log, self.path('access.log.offset'))
+        self.position = 0
+
+    def send(self, text):
+        with open(self.log, 'a') as f:
+            f.write(text)
+        for line in self.tailer.read_lines(0):
+            ticket = self.ledger.open(self.position, 2)
+            for target in [self.up, self.down]:
+                target.deliver('topic', line, ticket)
+            self.position += len(line)
+        self.tailer.checkpoint(self.ledger.behind(self.position))
+        return self.tailer.load_checkpoint()
+
+    def test_drop_advance_rotate(self):
+        """Drops while running don't hold the checkpoint back"""
+        inode = os.stat(self.log).st_ino
+        eq_(self.send('one\n'), (inode, 4))
+        eq_(self.send('two\n'), (inode, 8))
+        eq_(self.down.dropped, 2)
+
+        os.rename(self.log, self.log + '.1')
+        open(self.log, 'w').close()
+        self.tailer.read_lines(0)
+        eq_(self.send('three\n'), (os.stat(self.log).st_ino, 6))
+        eq_(self.up.got, ['one\n', 'two\n', 'three\n'])
+
+    def test_drop_on_the_way_out(self):
+        """What can't be delivered as we stop is left for the next run"""
+        inode = os.stat(self.log).st_ino
+        eq_(self.send('one\n'), (inode, 4))
+        self.down.stopping = True
+        eq_(self.send('two\n'), (inode, 4))
+
+
+class TestTarget(object):
+    """Unit tests for a target's worker thread."""
+
+    def test_connects_up_front(self):
+        """The worker connects before the first message, not on it"""
+        target = Up('up', 'drop', 10)
+        target.start()
+        deadline = time.time() + 5
+        while target.session is None and time.time() < deadline:
+            time.sleep(0.01)
+        eq_(target.session, [])
+        target.stop()
+
+
+class TestSpool(TempDir):
+    """Unit tests for holding messages on disk for targets that are away."""
+
+    def test_fifo(self):
+        """Messages come back out in order, binary bodies and all"""
+        spool = Spool(self.path('t.spool'), 1024)
+        spool.append('topic', 'one')
+        spool.append('topic', '\x00two\nlines')
+        eq_(spool.peek(), ('topic', 'one'))
+        spool.pop()
+        eq_(spool.peek(), ('topic', '\x00two\nlines'))
+        spool.pop()
+        assert not spool.pending()
+        eq_(os.path.getsize(self.path('t.spool')), 0)
+
+    def test_survives_restart(self):
+        """What one run spooled, the next run delivers"""
+        spool = Spool(self.path('t.spool'), 1024)
+        for msg in ['one', 'two']:
+            spool.append('topic', msg)
+        spool.peek()
+        spool.pop()
+        spool.close()
+
+        spool = Spool(self.path('t.spool'), 1024)
+        eq_(spool.peek(), ('topic', 'two'))
+
+    def test_torn_frame(self):
+        """A frame torn by a crash mid-append is cut off, not choked on"""
+        for torn in ['top', 'topic 10\nshort', 'topic x\n']:
+            path = self.path('t.spool')
+            spool = Spool(path, 1024)
+            spool.append('topic', 'one')
+            spool.close()
+            with open(path, 'ab') as f:
+                f.write(torn)
+
+            spool = Spool(path, 1024)
+            eq_(spool.peek(), ('topic', 'one'))
+            spool.pop()
+            assert spool.pending()
+            eq_(spool.peek(), None)
+            assert not spool.pending()
+            eq_(os.path.getsize(path), 0)
+
+            spool.append('topic', 'two')
+            eq_(spool.peek(), ('topic', 'two'))
+            spool.close()
+            os.remove(path)
+            os.remove(path + '.offset')
+
+    def test_full(self):
+        """A full spool turns messages down"""
+        spool = Spool(self.path('t.spool'), 20)
+        assert spool.append('topic', 'x' * 5)
+        assert not spool.append('topic', 'x' * 5)
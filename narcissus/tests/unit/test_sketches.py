@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the heavy hitter and unique client sketches"""
+from nose.tools import eq_, assert_raises
+
+from narcissus.sketches import CountMinSketch, TopK, OTHER, HyperLogLog, \
+    UniqueWindows, hll_position
+
+import random
+
+
+class TestCountMinSketch(object):
+    """Unit tests for approximate counting."""
+
+    def test_never_low(self):
+        """Estimates are at least the true count"""
+        sketch = CountMinSketch(width=64, depth=4)
+        truth = {}
+        for i in range(2000):
+            key = 'key%i' % random.randint(0, 300)
+            truth[key] = truth.get(key, 0) + 1
+            sketch.add(key)
+        for key, count in truth.items():
+            assert sketch.estimate(key) >= count
+
+    def test_decay(self):
+        """Decaying scales every count"""
+        sketch = CountMinSketch()
+        sketch.add('fedora', 10)
+        sketch.decay(0.5)
+        eq_(sketch.estimate('fedora'), 5)
+
+
+class TestTopK(object):
+    """Unit tests for tracking the busiest keys."""
+
+    def test_finds_the_heavy_hitters(self):
+        """A few busy keys stand out from a long tail"""
+        topk = TopK(3)
+        hits = ['fedora'] * 500 + ['epel'] * 300 + ['ubuntu'] * 200 + \
+            ['tail%i' % i for i in range(2000)]
+        random.shuffle(hits)
+        for key in hits:
+            topk.add(key)
+        eq_([key for key, count in topk.top()], ['fedora', 'epel', 'ubuntu'])
+
+    def test_bounded(self):
+        """Never more than k keys are tracked"""
+        topk = TopK(5)
+        for i in range(1000):
+            topk.add('key%i' % i)
+            assert len(topk.counts) <= 5
+        eq_(len(topk.heap), 5)
+
+    def test_evicts_the_least_busy(self):
+        """A key bumped since it was tracked isn't mistaken for the floor"""
+        topk = TopK(2)
+        topk.add('fedora')
+        topk.add('epel')
+        topk.add('fedora', 5)
+        topk.add('ubuntu', 3)
+        eq_(topk.top(), [('fedora', 6), ('ubuntu', 3)])
+
+    def test_fold(self):
+        """The tail of a timestep is rolled up into OTHER"""
+        topk = TopK(2)
+        bucket = {'fedora': 50, 'epel': 30, 'gnu': 1, 'cpan': 2}
+        folded = topk.fold(bucket)
+        eq_(folded, {'fedora': 50, 'epel': 30, OTHER: 3})
+        eq_(sum(folded.values()), sum(bucket.values()))
+
+    def test_newcomers_earn_their_place(self):
+        """A one-off key doesn't push out a busy one, a busy newcomer does"""
+        topk = TopK(2)
+        topk.fold({'fedora': 50, 'epel': 30})
+        eq_(topk.fold({'gnu': 1}), {OTHER: 1})
+        assert 'epel' in topk
+
+        eq_(topk.fold({'ubuntu': 100}), {'ubuntu': 100})
+        assert 'epel' not in topk and 'fedora' in topk
+
+    def test_decay(self):
+        """Keys that were busy a long time ago make way"""
+        topk = TopK(1, decay=0.5)
+        topk.fold({'fedora': 64})
+        for i in range(10):
+            topk.fold({'ubuntu': 8})
+        eq_(topk.top()[0][0], 'ubuntu')
+
+    def test_bad_k(self):
+        assert_raises(ValueError, TopK, 0)
+
+
+class TestHyperLogLog(object):
+    """Unit tests for counting unique clients."""
+
+    def test_small(self):
+        """A handful of clients are counted just about exactly"""
+        sketch = HyperLogLog()
+        for i in range(100):
+            sketch.add('10.0.0.%i' % (i % 50))
+        eq_(sketch.estimate(), 50)
+        eq_(sketch.registers, None)
+
+    def test_large(self):
+        """Many clients are counted to within a few percent"""
+        sketch = HyperLogLog()
+        for i in range(50000):
+            sketch.add('client%i' % i)
+        assert sketch.registers is not None
+        assert abs(sketch.estimate() - 50000) < 50000 * 0.05
+
+    def test_merge(self):
+        """Merged sketches count the union"""
+        a, b = HyperLogLog(), HyperLogLog()
+        for i in range(3000):
+            a.add('client%i' % i)
+        for i in range(2000, 4000):
+            b.add('client%i' % i)
+        a.merge(b)
+        assert abs(a.estimate() - 4000) < 4000 * 0.05
+
+    def test_positions(self):
+        """Adding by position is the same as adding the item"""
+        a, b = HyperLogLog(10), HyperLogLog(10)
+        a.add('1.2.3.4')
+        b.add_position(*hll_position('1.2.3.4', 10))
+        eq_(a.positions(), b.positions())
+
+    def test_dumps(self):
+        sketch = HyperLogLog(10)
+        for i in range(500):
+            sketch.add('client%i' % i)
+        loaded = HyperLogLog.loads(sketch.dumps())
+        eq_(loaded.precision, 10)
+        eq_(loaded.estimate(), sketch.estimate())
+
+    def test_dumps_sparse(self):
+        """A sparse sketch stays sparse, saved and loaded"""
+        sketch = HyperLogLog()
+        for i in range(10):
+            sketch.add('client%i' % i)
+        loaded = HyperLogLog.loads(sketch.dumps())
+        eq_((sketch.registers, loaded.registers), (None, None))
+        eq_(sorted(loaded.positions()), sorted(sketch.positions()))
+
+    def test_bad_merge(self):
+        assert_raises(ValueError, HyperLogLog(10).merge, HyperLogLog(12))
+
+
+class TestUniqueWindows(object):
+    """Unit tests for adding up unique clients over the hour and day."""
+
+    def sketch(self, *clients):
+        sketch = HyperLogLog()
+        for client in clients:
+            sketch.add(client)
+        return sketch
+
+    def test_estimates(self):
+        windows = UniqueWindows()
+        windows.roll(7200)
+        windows.add('fedora', self.sketch('a', 'b'))
+        windows.add('fedora', self.sketch('b', 'c'))
+        eq_(windows.estimates('fedora'), {'hour': 3, 'day': 3})
+        eq_(windows.estimates('epel'), {'hour': 0, 'day': 0})
+
+    def test_roll(self):
+        """A window that's up is handed back, and starts over"""
+        windows = UniqueWindows()
+        eq_(windows.roll(7200), [])
+        windows.add('fedora', self.sketch('a', 'b'))
+
+        eq_(windows.roll(7200 + 3599), [])
+        closed = windows.roll(7200 + 3600)
+        eq_([(name, start) for name, start, sketches in closed],
+            [('hour', 7200)])
+        eq_(closed[0][2]['fedora'].estimate(), 2)
+        eq_(windows.estimates('fedora'), {'hour': 0, 'day': 2})
+
+    def test_resume(self):
+        """Windows saved by an earlier run pick up where they left off"""
+        windows = UniqueWindows()
+        windows.roll(7200 + 60)
+        windows.add('fedora', self.sketch('a', 'b'))
+        saved = windows.current()
+        eq_([(name, start) for name, start, sketches in saved],
+            [('hour', 7200), ('day', 0)])
+
+        restarted = UniqueWindows()
+        now = 7200 + 120
+        for name, start, sketches in saved:
+            assert restarted.resume(name, start, sketches, now)
+        eq_(restarted.roll(now), [])
+        restarted.add('fedora', self.sketch('c'))
+        eq_(restarted.estimates('fedora'), {'hour': 3, 'day': 3})
+
+    def test_resume_too_late(self):
+        """A window that's over by the time we're back isn't picked up"""
+        windows = UniqueWindows()
+        assert not windows.resume('hour', 7200, {'fedora': self.sketch('a')},
+                                  7200 + 3600)
+        windows.roll(7200 + 3600)
+        eq_(windows.estimates('fedora'), {'hour': 0, 'day': 0})
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the sender <-> hub wire format"""
+from nose.tools import eq_, assert_raises
+
+import narcissus.wire as wire
+
+
+class TestWire(object):
+    """Unit tests for packing and unpacking batches."""
+
+    lines = [
+        '1.2.3.4 - - [15/Apr/2011:13:37:00 -0400] "GET /fedora/ HTTP/1.1"\n',
+        '5.6.7.8 - - [15/Apr/2011:13:37:01 -0400] "GET /ubuntu/ HTTP/1.1"\n',
+    ]
+
+    def test_legacy_single_line(self):
+        """A message without a header is a single raw line"""
+        eq_(wire.unpack(self.lines[0]), [self.lines[0]])
+
+    def test_roundtrip(self):
+        """Packed lines come back out without their newlines"""
+        body = wire.pack(self.lines)
+        assert wire.is_batch(body)
+        eq_(wire.unpack(body), [line.rstrip('\n') for line in self.lines])
+
+    def test_empty_batch(self):
+        """An empty batch unpacks to no lines at all"""
+        eq_(wire.unpack(wire.pack([])), [])
+
+    def test_unknown_codec(self):
+        """Batches with codecs we don't know about are rejected"""
+        assert_raises(ValueError, wire.unpack, wire.HEADER_PREFIX + 'lzma\nxx')
+
+    def test_zlib_roundtrip(self):
+        """Compressed batches decode back to the same lines"""
+        body = wire.pack(self.lines, wire.ZLIB)
+        eq_(wire.unpack(body), [line.rstrip('\n') for line in self.lines])
+
+    def test_zlib_custom_dictionary(self):
+        """A dictionary built from sample lines works on both ends"""
+        dict_id = wire.register_dictionary(
+            wire.build_dictionary(self.lines * 2))
+        body = wire.pack(self.lines, wire.ZLIB, dict_id)
+        eq_(wire.unpack(body), [line.rstrip('\n') for line in self.lines])
+
+    def test_zlib_unknown_dictionary(self):
+        """Batches compressed against a dictionary we lack are rejected"""
+        body = wire.pack(self.lines, wire.ZLIB)
+        body = body.replace(wire.DEFAULT_DICTIONARY_ID, 'deadbeef', 1)
+        assert_raises(ValueError, wire.unpack, body)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the parse/geolocate worker pool"""
+from nose.tools import eq_
+
+import narcissus.workers as workers
+
+import time
+import os
+
+
+# Worker tasks have to be importable to make it to the worker processes.
+def echo(items):
+    return items, 0
+
+def first_is_slow(items):
+    if items[0] == 0:
+        time.sleep(0.5)
+    return items, 0
+
+def slow(items):
+    time.sleep(0.6)
+    return items, 0
+
+def explode(items):
+    raise KeyError('boom')
+
+def first_dies(items):
+    if items[0] == 0:
+        os._exit(1)
+    return items, 0
+
+
+class TestWorkerPool(object):
+    """Unit tests for handing batches to worker processes."""
+
+    def setUp(self):
+        self.published = []
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool:
+            self.pool.close()
+
+    def publish(self, hits, failed, error):
+        self.published.append((hits, failed, error))
+
+    def start(self, task, **kw):
+        kw.setdefault('batch_lines', 2)
+        self.pool = workers.WorkerPool(2, task, self.publish, **kw)
+        return self.pool
+
+    def test_batches(self):
+        """Items are handed over in batches of batch_lines"""
+        pool = self.start(echo)
+        pool.submit(range(5))
+        assert pool.drain(10)
+        eq_([hits for hits, failed, error in self.published],
+            [[0, 1], [2, 3], [4]])
+
+    def test_ordered(self):
+        """Ordered pools publish in the order items came in"""
+        pool = self.start(first_is_slow)
+        pool.submit(range(6))
+        assert pool.drain(10)
+        eq_(self.published[0][0], [0, 1])
+
+    def test_unordered(self):
+        """Unordered pools don't wait for a slow batch"""
+        pool = self.start(first_is_slow, ordered=False)
+        pool.submit(range(6))
+        assert pool.drain(10)
+        eq_(self.published[-1][0], [0, 1])
+
+    def test_stale_batch(self):
+        """A batch that doesn't fill up goes anyway after batch_ms"""
+        pool = self.start(echo, batch_ms=50)
+        pool.submit([1])
+        time.sleep(1)
+        eq_(self.published, [([1], 0, None)])
+
+    def test_errors(self):
+        """A task blowing up is reported instead of stopping the pool"""
+        pool = self.start(explode)
+        pool.submit(range(3))
+        assert pool.drain(10)
+        eq_([(failed, 'boom' in error)
+             for hits, failed, error in self.published], [(2, True), (1, True)])
+
+    def test_dead_worker(self):
+        """A batch lost with its worker is given up on, the rest go out"""
+        pool = self.start(first_dies, batch_timeout=1)
+        pool.submit(range(6))
+        assert pool.drain(10)
+        eq_([hits for hits, failed, error in self.published],
+            [[], [2, 3], [4, 5]])
+        eq_(self.published[0][1], 2)
+        assert 'gave up' in self.published[0][2]
+
+    def test_timeout_starts_with_the_work(self):
+        """Time spent waiting for a free worker doesn't count as stuck"""
+        pool = self.start(slow, batch_timeout=1)
+        pool.submit(range(8))
+        assert pool.drain(10)
+        eq_([error for hits, failed, error in self.published], [None] * 4)
+
+    def test_max_batches(self):
+        """Submitting waits while max_batches are already out"""
+        pool = self.start(slow, max_batches=1)
+        began = time.time()
+        pool.submit(range(6))
+        assert time.time() - began >= 1
+        assert pool.drain(10)
+        eq_([hits for hits, failed, error in self.published],
+            [[0, 1], [2, 3], [4, 5]])
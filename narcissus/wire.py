@@ -0,0 +1,193 @@
+""" wire.py -- the on-the-wire format between amqp-log-sender.py and the hub.
+
+Historically every AMQP message on ``httpdlight_http_rawlogs`` carried exactly
+one raw log line.  The sender can now pack many lines into a single *batch*
+message to save on per-message overhead.  A batch looks like::
+
+    \\x00narc:<codec>[:<argument>]\\n<payload>
+
+The leading NUL byte can never show up in a text log line, so anything that
+doesn't start with the header is treated as a plain old single line.  That
+keeps old senders working against new hubs.
+
+Codecs:
+
+    plain           -- the lines, joined by newlines.
+    zlib:<dict id>  -- the same, deflated against a preset dictionary.
+
+Access logs are *very* repetitive (same vhost, same user agents, same path
+prefixes) so priming the compressor with a dictionary of those fragments buys
+a lot, especially for small batches.  Python 2's zlib can't take a preset
+dictionary directly, so we fake one: compress the dictionary, sync-flush, and
+``copy()`` that primed compressor for every message.  The hub primes a
+decompressor the same way.  Both sides must know the dictionary; it is named
+on the wire by its crc32.
+
+This module only depends on the standard library so that the sender can
+import it from a plain git checkout on the monitored machine.
+"""
+
+from collections import defaultdict
+
+import zlib
+
+HEADER_PREFIX = '\x00narc:'
+
+PLAIN = 'plain'
+ZLIB = 'zlib'
+
+COMPRESSION_LEVEL = 6
+
+# Fragments that show up in nearly every line our mirrors log.  deflate finds
+# nearby matches more cheaply, so the most common stuff goes at the end.
+DEFAULT_DICTIONARY = ''.join([
+    '"-" "Wget/1.12 (linux-gnu)" ',
+    '"-" "Debian APT-HTTP/1.3 (0.8.10.3)" ',
+    '"-" "urlgrabber/3.9.1 yum/3.2.29" ',
+    '"-" "Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 5.1; Trident/4.0)" ',
+    '"-" "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/534.24 '
+    '(KHTML, like Gecko) Chrome/11.0.696.34 Safari/534.24" ',
+    '"-" "Mozilla/5.0 (X11; Linux x86_64; rv:2.0) Gecko/20100101 '
+    'Firefox/4.0" ',
+    '"GET /centos/5/updates/x86_64/', '"GET /debian/pool/main/',
+    '"GET /ubuntu/dists/', '"GET /fedora/linux/updates/14/i386/',
+    '"GET /fedora/linux/releases/14/Everything/x86_64/os/Packages/',
+    'repodata/repomd.xml HTTP/1.1" 304 0 "-" ',
+    '.iso HTTP/1.1" 206 ', '.deb HTTP/1.1" 200 ', '.rpm HTTP/1.1" 200 ',
+    'HTTP/1.0" 200 ', 'HTTP/1.1" 404 ', 'HTTP/1.1" 200 ',
+    ' mirror.rit.edu - [', ' -0400] "GET /',
+])
+
+# dictionary id -> dictionary, and the primed (de)compressors built from them.
+_dictionaries = {}
+_compressors = {}
+_decompressors = {}
+
+
+def dictionary_id(zdict):
+    return '%08x' % (zlib.crc32(zdict) & 0xffffffff)
+
+
+def register_dictionary(zdict):
+    """ Make `zdict` available for packing and unpacking.  Returns its id. """
+    dict_id = dictionary_id(zdict)
+    _dictionaries[dict_id] = zdict
+    return dict_id
+
+
+def load_dictionary(path):
+    """ Register the dictionary stored in the file at `path`. """
+    with open(path, 'rb') as f:
+        return register_dictionary(f.read())
+
+
+DEFAULT_DICTIONARY_ID = register_dictionary(DEFAULT_DICTIONARY)
+
+
+def build_dictionary(lines, size=16384):
+    """ Build a preset dictionary out of a sample of raw log lines.
+
+    We count the quoted fields (requests, referers, user agents) and the
+    directory part of every requested path, then keep the fragments that
+    would save the most bytes.  The result fits in `size` bytes.
+    """
+
+    counts = defaultdict(int)
+    for line in lines:
+        parts = line.rstrip('\n').split('"')
+        for quoted in parts[1::2]:
+            counts['"' + quoted + '" '] += 1
+
+        if len(parts) > 1:
+            request = parts[1].split(' ')
+            if len(request) > 1:
+                directory = request[1].rsplit('/', 1)[0] + '/'
+                counts['"%s %s' % (request[0], directory)] += 1
+
+    # Most valuable fragments first while we fill up the budget ...
+    ranked = sorted(counts.items(), key=lambda (frag, n): n * len(frag),
+                    reverse=True)
+    chosen, total = [], 0
+    for fragment, n in ranked:
+        if n < 2 or total + len(fragment) > size:
+            continue
+        chosen.append(fragment)
+        total += len(fragment)
+
+    # ... but the most valuable ones end up closest to the payload.
+    return ''.join(reversed(chosen))
+
+
+def _primed(zdict):
+    """ Return the compressed form of `zdict`, sync-flushed. """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    prefix = compressor.compress(zdict) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressor, prefix
+
+
+def _lookup_dictionary(dict_id):
+    if dict_id not in _dictionaries:
+        raise ValueError("Unknown wire dictionary %r" % dict_id)
+    return _dictionaries[dict_id]
+
+
+def _compress(payload, dict_id):
+    if dict_id not in _compressors:
+        _compressors[dict_id] = _primed(_lookup_dictionary(dict_id))[0]
+
+    compressor = _compressors[dict_id].copy()
+    return compressor.compress(payload) + compressor.flush()
+
+
+def _decompress(payload, dict_id):
+    if dict_id not in _decompressors:
+        decompressor = zlib.decompressobj()
+        decompressor.decompress(_primed(_lookup_dictionary(dict_id))[1])
+        _decompressors[dict_id] = decompressor
+
+    decompressor = _decompressors[dict_id].copy()
+    try:
+        return decompressor.decompress(payload) + decompressor.flush()
+    except zlib.error as e:
+        raise ValueError("Corrupt %s batch: %s" % (ZLIB, e))
+
+
+def is_batch(body):
+    """ Return true if `body` is a batch envelope and not a single line. """
+    return body.startswith(HEADER_PREFIX)
+
+
+def pack(lines, codec=PLAIN, dict_id=DEFAULT_DICTIONARY_ID):
+    """ Pack a list of raw log lines into a single batch message body. """
+    payload = '\n'.join([line.rstrip('\n') for line in lines])
+
+    if codec == PLAIN:
+        return HEADER_PREFIX + PLAIN + '\n' + payload
+    elif codec == ZLIB:
+        header = HEADER_PREFIX + ZLIB + ':' + dict_id + '\n'
+        return header + _compress(payload, dict_id)
+    else:
+        raise ValueError("Unknown wire codec %r" % codec)
+
+
+def unpack(body):
+    """ Return the list of raw log lines carried by message `body`.
+
+    Legacy single-line messages come back as a list of one.  Raises
+    ValueError for batches we can't decode.
+    """
+
+    if not is_batch(body):
+        return [body]
+
+    header, payload = body.split('\n', 1)
+    codec, _, argument = header[len(HEADER_PREFIX):].partition(':')
+    if codec == ZLIB:
+        payload = _decompress(payload, argument)
+    elif codec != PLAIN:
+        raise ValueError("Unknown wire codec %r" % codec)
+
+    if not payload:
+        return []
+
+    return payload.split('\n')
@@ -0,0 +1,284 @@
+""" workers.py -- parsing and geolocating hits on more than one core.
+
+The raw-log consumers used to parse, hash and geolocate every hit inline, on
+the hub's own thread, which caps the whole hub at one core.  With
+``narcissus.workers`` set in the hub's config, they hand that work to a
+:class:`WorkerPool` instead::
+
+|  HttpLightConsumer.consume --> WorkerPool.submit (batches of lines)
+|                                      |
+|                         multiprocessing.Pool (N processes)
+|                                      |
+|                                      V
+|                 consumer.publish_batch(hits) --> http_latlon
+
+Lines are collected into batches of up to `batch_lines` before they cross
+over to a worker process, so the pickling and pipe overhead is paid once per
+batch instead of once per hit.  A batch that isn't full after `batch_ms`
+goes anyway.  In ordered mode, results are published in the order the lines
+came in; unordered mode publishes each batch as soon as it's done.
+
+If a worker process dies (the OOM killer, a crash in the GeoIP C code), the
+pool starts another one but never reports back on the batch it had.  So a
+batch that a worker has been on for more than `batch_timeout` seconds is
+given up on and published as failed, and the batches behind it go out as
+usual.  The clock starts when a worker picks the batch up, not while it
+waits its turn.
+
+No more than `max_batches` batches are out at once, counting those that are
+done but waiting to be published in order.  Past that, :meth:`submit` blocks
+until one comes back, which holds the hub's consumer up instead of letting
+batches pile up in memory.
+
+Only the standard library and pygeoip are needed in the workers, so they
+don't drag the moksha hub along.  They share the hub's GeoIP settings (see
+:mod:`narcissus.geo`) and open the database themselves when they first need
+it.
+"""
+
+import narcissus.parsers
+import narcissus.geo
+
+from multiprocessing.queues import SimpleQueue
+
+import multiprocessing
+import traceback
+import threading
+import time
+import os
+
+import logging
+log = logging.getLogger(__name__)
+
+# Set up once in every worker process by _init_worker.
+_log_format = None
+_started = None
+
+
+def _init_worker(geoip, log_format, digest, started=None):
+    global _log_format, _started
+    _started = started
+    narcissus.geo.configure(*geoip)
+    _log_format = narcissus.parsers.get_format(log_format)
+    narcissus.parsers.set_digest(*digest)
+
+
+def _locate(hits):
+    located = narcissus.geo.locate_many([hit for hit in hits if hit])
+    return located, len(hits) - len(located)
+
+
+def parse_lines(lines):
+    """ Worker task: parse and geolocate raw log lines. """
+    return _locate([_log_format.parse(line) for line in lines])
+
+
+def unpack_records(lines):
+    """ Worker task: geolocate records packed by ``--preparse``. """
+    records = []
+    for line in lines:
+        try:
+            records.append(narcissus.parsers.unpack_record(line))
+        except ValueError:
+            records.append(None)
+    return _locate(records)
+
+
+def locate_hits(hits):
+    """ Worker task: geolocate hits that already are dicts. """
+    return _locate(hits)
+
+
+def _run(task, items, seq=None):
+    """ Run `task` on `items`, handing any exception back as a string.  Says
+    when batch `seq` was picked up first, so its time out can start then. """
+    if _started is not None:
+        _started.put((seq, time.time()))
+    try:
+        hits, failed = task(items)
+        return hits, failed, None
+    except Exception:
+        return [], len(items), traceback.format_exc()
+
+
+class WorkerPool(object):
+    """ Runs `task` over batches of items in `processes` worker processes.
+
+    `publish` is called with ``(hits, failed, error)`` for every batch, from
+    the pool's result thread: the geolocated hits, how many items didn't make
+    it, and the traceback if the task blew up (or why it was given up on).
+    """
+
+    def __init__(self, processes, task, publish, log_format='lighttpd',
+                 ordered=True, batch_lines=500, batch_ms=100,
+                 digest=('md5', 1024), geoip=None, batch_timeout=60,
+                 max_batches=None):
+        self.task = task
+        self.publish = publish
+        self.ordered = ordered
+        self.batch_lines = batch_lines
+        self.batch_ms = batch_ms
+        self.batch_timeout = batch_timeout
+        self.max_batches = max_batches or 4 * processes
+
+        # The workers look things up the same way we do, unless told
+        # otherwise.
+        if geoip is None:
+            geoip = narcissus.geo.locator().settings()
+
+        # Workers say on here when they pick a batch up.  A SimpleQueue
+        # writes straight to its pipe, so a worker that dies right after
+        # still gets the word out.
+        self.started = SimpleQueue()
+        self.pool = multiprocessing.Pool(processes, _init_worker,
+                                         (geoip, log_format, digest,
+                                          self.started))
+
+        # Items waiting to be sent off, and when the first of them came in.
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_since = None
+
+        # Sequence numbers for ordered mode, and results that came back
+        # before those of an earlier batch.  Batches still out with the
+        # workers are in `outstanding`, as (AsyncResult, size, deadline);
+        # the deadline is None until a worker has started on the batch.
+        self.done = threading.Condition()
+        self.submitted = 0
+        self.published = 0
+        self.finished = {}
+        self.outstanding = {}
+        self.abandoned = 0
+
+        self.flusher = threading.Thread(target=self.flush_stale)
+        self.flusher.daemon = True
+        self.running = True
+        self.flusher.start()
+
+    def submit(self, items):
+        """ Queue up `items` for the workers. """
+        with self.lock:
+            if not self.pending:
+                self.pending_since = time.time()
+            self.pending.extend(items)
+            while len(self.pending) >= self.batch_lines:
+                self.dispatch(self.pending[:self.batch_lines])
+                self.pending = self.pending[self.batch_lines:]
+                self.pending_since = time.time()
+
+    def flush(self):
+        """ Send off whatever is pending, full batch or not. """
+        with self.lock:
+            if self.pending:
+                self.dispatch(self.pending)
+                self.pending = []
+
+    def flush_stale(self):
+        while self.running:
+            time.sleep(self.batch_ms / 1000.0)
+            if self.pending and (time.time() - self.pending_since) * 1000 \
+               >= self.batch_ms:
+                self.flush()
+            self.expire()
+
+    def dispatch(self, batch):
+        """ Hand one batch to the pool, first waiting for there to be fewer
+        than `max_batches` out.  Call with the lock held. """
+        with self.done:
+            while self.submitted - self.published >= self.max_batches:
+                # The flusher may be stuck behind our lock, so it's up to us
+                # to give up on batches whose worker died.
+                self.done.wait(min(1, self.batch_timeout))
+                self.expire()
+
+            seq = self.submitted
+            self.submitted += 1
+            result = self.pool.apply_async(
+                _run, (self.task, batch, seq),
+                callback=lambda result: self.finish(seq, result))
+            self.outstanding[seq] = (result, len(batch), None)
+
+    def finish(self, seq, result):
+        with self.done:
+            if self.outstanding.pop(seq, None) is None:
+                # We gave up on this one already.
+                return
+            self.finished[seq] = result
+            self.publish_ready(seq)
+            self.done.notify_all()
+
+    def expire(self):
+        """ Give up on the batches workers have been on for longer than
+        `batch_timeout`, publishing them as failed. """
+
+        now = time.time()
+        with self.done:
+            while not self.started.empty():
+                seq, started = self.started.get()
+                if seq in self.outstanding:
+                    result, size, deadline = self.outstanding[seq]
+                    self.outstanding[seq] = (result, size,
+                                             started + self.batch_timeout)
+
+            for seq in sorted(self.outstanding):
+                result, size, deadline = self.outstanding[seq]
+                if deadline is None or deadline > now:
+                    continue
+                if result.ready():
+                    # Its callback is on the way.
+                    continue
+
+                del self.outstanding[seq]
+                self.abandoned += 1
+                self.finished[seq] = ([], size, "gave up on batch %i of %i "
+                                      "items after %is; did a worker die?" % (
+                                          seq, size, self.batch_timeout))
+                self.publish_ready(seq)
+            self.done.notify_all()
+
+    def publish_ready(self, seq):
+        """ Publish batch `seq` if it's its turn, and any that were waiting
+        on it.  Call with `done` held. """
+        if self.ordered:
+            # `published` is also the next batch in line.
+            while self.published in self.finished:
+                self.deliver(self.published)
+        else:
+            self.deliver(seq)
+
+    def deliver(self, seq):
+        """ Publish the result of batch `seq`.  Call with `done` held. """
+        try:
+            self.publish(*self.finished.pop(seq))
+        except Exception:
+            # If this got out, it would take the pool's result thread down
+            # with it and nothing would ever be published again.
+            log.exception("%r failed to publish a batch" % self)
+        self.published += 1
+
+    def drain(self, timeout=None):
+        """ Flush, then wait until every batch so far has been published.
+        Returns False if `timeout` seconds went by first. """
+
+        self.flush()
+        deadline = timeout and time.time() + timeout
+        with self.done:
+            while self.published < self.submitted:
+                remaining = deadline and deadline - time.time()
+                if deadline and remaining <= 0:
+                    return False
+                self.done.wait(min(remaining or 1, 1))
+                self.expire()
+        return True
+
+    def close(self):
+        """ Publish what's left and shut the worker processes down.  Workers
+        that are stuck on a batch we gave up on are killed. """
+        self.running = False
+        self.flusher.join()
+        self.drain()
+        if self.abandoned:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
@@ -1,76 +1,368 @@
 #!/usr/bin/env python
 
-# TODO -- there's a bug where the watched file gets moved out from under
-# inotify.  We could address this with some pyinotify magic.
-#
-#   http://pyinotify.sourceforge.net/#The_EventsCodes_Class
-#
-# may need to watch IN_MOVE_* or something
-
-from qpid.connection import Connection
-from qpid.datatypes import Message, uuid4
-from qpid.util import connect
+# Either pipe a log into us on stdin or, better, let us tail it ourselves with
+# --file.  The built-in tailer survives logrotate (by inode and by truncation)
+# and, with --checkpoint, picks up after a restart from the first line that
+# was still on its way to some target.  Lines a target couldn't take on our
+# way out are sent again; the ones that followed them may be sent twice.
+
+import itertools
+import signal
+import time
 import sys
+import os
+import re
+
+# Each transport is optional; we only need the one we're asked to use.
+try:
+    from qpid.connection import Connection
+    from qpid.datatypes import Message, uuid4
+    from qpid.util import connect
+except ImportError:
+    Connection = None
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+# Pull narcissus out of the checkout we live in.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from narcissus.sender import StdinReader, FileTailer, Batcher, HashRing, \
+    Ledger, Spool, Target
+import narcissus.parsers
+import narcissus.wire
+
+POLICIES = ['drop', 'block']
+TRANSPORTS = ['amqp', 'zmq']
+SHARDING = ['broadcast', 'round-robin', 'client-ip']
 
 import optparse
 parser = optparse.OptionParser()
 parser.add_option("-t", "--targets", dest="targets", default="localhost",
-                  help="comma-separated list of target hostnames running qpid")
+                  help="comma-separated list of target hostnames running qpid "
+                  "(or, with --transport=zmq, endpoints to publish on).")
+parser.add_option("-T", "--transport", dest="transport", default="amqp",
+                  help="'amqp' to go through qpid, or 'zmq' to publish "
+                  "straight to the moksha hub.")
 parser.add_option("-p", "--topic", dest="topic",
                   default="httpdlight_http_rawlogs",
                   help="amqp topic to talk on.")
 parser.add_option("-d", "--debug", dest="debug", action="store_true",
                   help="debug what messages are being sent")
+parser.add_option("-n", "--batch-lines", dest="batch_lines", type="int",
+                  default=1,
+                  help="pack up to this many lines into a single message.")
+parser.add_option("-m", "--batch-ms", dest="batch_ms", type="int",
+                  default=250,
+                  help="send a partial batch after this many milliseconds.")
+parser.add_option("-z", "--compress", dest="compress", action="store_true",
+                  help="deflate batches against a preset dictionary.")
+parser.add_option("-D", "--dictionary", dest="dictionary", default=None,
+                  help="with --compress, use the dictionary in this file "
+                  "(see build-wire-dictionary.py).  The hub must know it too.")
+parser.add_option("-e", "--preparse", dest="preparse", action="store_true",
+                  help="parse lines here and send compact records to the "
+                  "hub instead of raw lines.")
+parser.add_option("-F", "--format", dest="format", default="lighttpd",
+                  help="log format for --preparse: %s, auto or an Apache "
+                  "LogFormat string." % ", ".join(
+                      narcissus.parsers.format_order))
+parser.add_option("-H", "--digest", dest="digest", default="md5",
+                  help="digest for the refererhash of --preparse records: "
+                  "%s.  Match the hub's narcissus.refererhash.digest." %
+                  ", ".join(sorted(narcissus.parsers.DIGESTS)))
+parser.add_option("-r", "--parsed-topic", dest="parsed_topic",
+                  default="httpdlight_http_parsed",
+                  help="amqp topic for --preparse records.")
+parser.add_option("-q", "--queue-size", dest="queue_size", type="int",
+                  default=10000,
+                  help="messages to hold for each target before the policy "
+                  "kicks in.")
+parser.add_option("-P", "--policy", dest="policy", default="drop",
+                  help="what to do when a target's queue is full: 'drop' the "
+                  "message or 'block' the reader.  Override per target with "
+                  "--targets=host:policy.")
+parser.add_option("-s", "--stats-interval", dest="stats_interval", type="int",
+                  default=60,
+                  help="print per-target counters every this many seconds "
+                  "(0 to disable).")
+parser.add_option("-f", "--file", dest="file", default=None,
+                  help="tail this log file ourselves instead of reading stdin.")
+parser.add_option("-c", "--checkpoint", dest="checkpoint", default=None,
+                  help="with --file, remember our offset in this file so we "
+                  "can resume after a restart.")
+parser.add_option("-C", "--checkpoint-interval", dest="checkpoint_interval",
+                  type="int", default=5,
+                  help="save the checkpoint every this many seconds.")
+parser.add_option("-S", "--spool-dir", dest="spool_dir", default=None,
+                  help="spool messages for unreachable targets to files in "
+                  "this directory instead of dropping them.")
+parser.add_option("-M", "--spool-mb", dest="spool_mb", type="int",
+                  default=1024,
+                  help="maximum size of each target's spool in megabytes.")
+parser.add_option("-R", "--catch-up-rate", dest="catch_up_rate", type="int",
+                  default=100,
+                  help="messages per second to replay from the spool once a "
+                  "target is back.")
+parser.add_option("-B", "--max-backoff", dest="max_backoff", type="int",
+                  default=60,
+                  help="longest wait in seconds between reconnect attempts.")
+parser.add_option("-x", "--shard", dest="shard", default="broadcast",
+                  help="'broadcast' every line to every target, or send each "
+                  "line to just one: 'round-robin' or by 'client-ip'.")
 options, args = parser.parse_args()
 
 options.targets = [t.strip() for t in options.targets.split(',')]
 
-# Create connection and session
-session_dicts = []
-for target in options.targets:
-    print "Attempting to setup connection with", target
-    try:
-        socket = connect(target, 5672)
-        connection = Connection(
+if options.policy not in POLICIES:
+    parser.error("--policy must be one of %s" % ", ".join(POLICIES))
+
+if options.shard not in SHARDING:
+    parser.error("--shard must be one of %s" % ", ".join(SHARDING))
+
+if options.transport not in TRANSPORTS:
+    parser.error("--transport must be one of %s" % ", ".join(TRANSPORTS))
+
+try:
+    log_format = narcissus.parsers.get_format(options.format)
+    narcissus.parsers.set_digest(options.digest)
+except ValueError as e:
+    parser.error(str(e))
+
+if options.transport == 'amqp' and Connection is None:
+    parser.error("--transport=amqp needs python-qpid")
+
+if options.transport == 'zmq' and zmq is None:
+    parser.error("--transport=zmq needs pyzmq")
+
+
+class AMQPTarget(Target):
+    """ A qpid broker that the moksha hub is listening to. """
+
+    def __init__(self, *args, **kw):
+        super(AMQPTarget, self).__init__(*args, **kw)
+        self.connection = None
+        self.properties = {}
+
+    def open(self):
+        """ Create connection and session. """
+        socket = connect(self.target, 5672)
+        self.connection = Connection(
             socket, username='guest', password='guest',
         )
-        connection.start(timeout=10000)
-        session = connection.session(str(uuid4()))
-
-        # Setup routing properties
-        print "Talking to %s on topic %s" % (target, options.topic)
-        properties = session.delivery_properties(routing_key=options.topic)
-        session_dicts.append({
-            'target' : target,
-            'socket' : socket,
-            'connection' : connection,
-            'session' : session,
-            'properties' : properties,
-        })
-        print "    Created target", target
-    except Exception as e:
-        print "    Failed to create target", target
-        print str(e)
-        import traceback
-        traceback.print_exc()
+        self.connection.start(timeout=10000)
+        self.properties = {}
+        return self.connection.session(str(uuid4()))
 
+    def close(self):
+        # This closes our session too.
+        self.connection.close(timeout=10)
 
-print "Entering mainloop"
-print "Sending to", ",".join([d['target'] for d in session_dicts])
-while True:
-    msg = sys.stdin.readline()
-    if not msg:
-        break
+    def delivery_properties(self, topic):
+        """ Setup (and remember) the routing properties for `topic` """
+        if topic not in self.properties:
+            print "Talking to %s on topic %s" % (self.target, topic)
+            self.properties[topic] = self.session.delivery_properties(
+                routing_key=topic)
+        return self.properties[topic]
 
+    def publish(self, topic, msg):
+        self.session.message_transfer(
+            destination='amq.topic',
+            message=Message(self.delivery_properties(topic), msg))
+
+
+class ZMQTarget(Target):
+    """ A zeromq PUB socket that the moksha hub subscribes to directly.
+
+    We bind the endpoint (``tcp://*:6543``, say) and the hub connects to us,
+    so add ``tcp://<this host>:6543`` to the hub's `zmq_subscribe_endpoints`.
+    There's no broker in between, so there's nothing to lose touch with: zmq
+    queues up to its high water mark for slow subscribers and drops past it.
+    """
+
+    context = None
+
+    def open(self):
+        if ZMQTarget.context is None:
+            ZMQTarget.context = zmq.Context()
+
+        socket = ZMQTarget.context.socket(zmq.PUB)
+        socket.bind(self.target)
+        return socket
+
+    def close(self):
+        self.session.close()
+
+    def publish(self, topic, msg):
+        # The same two-part framing the moksha hub itself uses.
+        self.session.send_multipart([topic, msg])
+
+
+ledger = Ledger()
+targets = []
+for spec in options.targets:
+    # Allow a per-target override of the queue policy like "hub2:block"
+    hostname, policy = spec, options.policy
+    if spec.rsplit(':', 1)[-1] in POLICIES:
+        hostname, policy = spec.rsplit(':', 1)
+
+    spool = None
+    if options.spool_dir:
+        if not os.path.isdir(options.spool_dir):
+            os.makedirs(options.spool_dir)
+        filename = re.sub(r'[^\w.-]', '_', hostname) + '.spool'
+        spool = Spool(os.path.join(options.spool_dir, filename),
+                      options.spool_mb * 1024 * 1024)
+
+    cls = {'amqp': AMQPTarget, 'zmq': ZMQTarget}[options.transport]
+    target = cls(hostname, policy, options.queue_size, spool,
+                 options.catch_up_rate, options.max_backoff, ledger)
+    target.start()
+    targets.append(target)
+
+
+def send(batcher):
+    first = batcher.first
+    msg = batcher.flush()
     if options.debug:
-        print "[sending]",msg
+        print "[sending]", batcher.topic, repr(msg)
+
+    recipients = batcher.targets
+    if options.shard == 'round-robin':
+        recipients = [round_robin.next()]
+
+    ticket = ledger.open(first, len(recipients))
+    for target in recipients:
+        target.put(batcher.topic, msg, ticket)
+
+
+def print_stats():
+    for target in targets:
+        print "[stats]", target.stats()
+
+
+if options.file:
+    reader = FileTailer(options.file, options.checkpoint)
+else:
+    reader = StdinReader(sys.stdin.fileno())
+
+codec, dict_id = narcissus.wire.PLAIN, narcissus.wire.DEFAULT_DICTIONARY_ID
+if options.compress:
+    codec = narcissus.wire.ZLIB
+    if options.dictionary:
+        dict_id = narcissus.wire.load_dictionary(options.dictionary)
+    print "Compressing batches with dictionary", dict_id
+
+def make_batchers(targets):
+    """ Return a raw and a pre-parsed batcher for a batch bound to `targets` """
+    raw = Batcher(options.topic, targets, max(1, options.batch_lines),
+                  options.batch_ms / 1000.0, codec, dict_id)
+
+    # Records always travel in a batch envelope, even a batch of one.
+    parsed = Batcher(options.parsed_topic, targets,
+                     max(1, options.batch_lines), options.batch_ms / 1000.0,
+                     codec, dict_id)
+    parsed.bare = False
+    return raw, parsed
+
+
+# When sharding by client, every target has batchers of its own.  Otherwise a
+# batch either goes to everybody or to whoever is next in line.
+if options.shard == 'client-ip':
+    ring = HashRing(targets)
+    shards = dict([(target, make_batchers([target])) for target in targets])
+else:
+    round_robin = itertools.cycle(targets)
+    shards = {None: make_batchers(targets)}
+
+batchers = sum([list(pair) for pair in shards.values()], [])
+
+
+def route(line):
+    """ Return the batcher and the message item that `line` should go to """
+    record = None
+    if options.preparse:
+        record = log_format.parse(line)
+
+    shard = None
+    if options.shard == 'client-ip':
+        ip = record['ip'] if record else line.split(' ', 1)[0]
+        shard = ring.lookup(ip)
+
+    raw_batcher, parsed_batcher = shards[shard]
+    if record:
+        return parsed_batcher, narcissus.parsers.pack_record(record)
+
+    # Couldn't parse it?  Let the hub have a crack at the raw line.
+    return raw_batcher, line
+
+
+def pending():
+    """ Bytes read that not every target has taken yet (see Ledger). """
+    return ledger.behind(position, [b.first for b in batchers if b.lines])
+
+
+def next_timeout():
+    """ Seconds until the next batch goes stale (None if all are empty). """
+    timeouts = [b.timeout() for b in batchers if b.lines]
+    if not timeouts:
+        return None
+    return min(timeouts)
+
+
+# Make `kill` shut us down cleanly so that the checkpoint is accurate.
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+print "Entering mainloop"
+print "Sending to", ",".join([t.target for t in targets])
+last_stats = last_checkpoint = time.time()
+position = 0    # Bytes read so far, across rotations.
+try:
+    while True:
+        timeout = next_timeout()
+        if options.stats_interval:
+            until_stats = max(
+                0, last_stats + options.stats_interval - time.time())
+            timeout = min(timeout, until_stats) if timeout is not None \
+                    else until_stats
+
+        lines = reader.read_lines(timeout)
+        if lines is None:
+            break
+
+        if options.stats_interval and \
+           time.time() - last_stats >= options.stats_interval:
+            print_stats()
+            last_stats = time.time()
+
+        for line in lines:
+            batcher, item = route(line)
+            batcher.add(item, position)
+            position += len(line)
+            if batcher.full():
+                send(batcher)
+
+        for batcher in batchers:
+            if batcher.lines and batcher.timeout() == 0:
+                send(batcher)
+
+        if time.time() - last_checkpoint >= options.checkpoint_interval:
+            reader.checkpoint(pending())
+            last_checkpoint = time.time()
+except (KeyboardInterrupt, SystemExit):
+    print "Shutting down"
+
+for batcher in batchers:
+    if batcher.lines:
+        send(batcher)
 
-    for d in session_dicts:
-        d['session'].message_transfer(
-            destination='amq.topic',
-            message=Message(d['properties'], msg))
 
+# Close sessions
+for target in targets:
+    target.stop()
 
-# Close session
-for d in session_dicts:
-    d['session'].close(timeout=10)
+# Whatever a target dropped on the way out is sent again next time.
+reader.checkpoint(pending())
+print_stats()
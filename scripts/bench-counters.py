@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+""" Benchmark the TimeSeriesConsumer's hit counters under contention.
+
+    $ ./bench-counters.py --threads=1,2,4,8 --messages=100000
+
+Each thread counts --messages synthetic hits: one count per category and one
+for the pair of them, like the TimeSeriesConsumer does.  Meanwhile a poller
+dumps the counters every --poll-ms, like the TimeSeriesProducer.
+
+Two ways of counting are compared, over the same counters.  GlobalLock is
+how the consumers counted before narcissus.counters: nested dicts behind one
+lock, taken for every single count.  Sharded is
+narcissus.counters.ShardedCounter: one shard per thread, bumped once per hit.
+Both report hits per second over all threads, and check that the poller got
+every last count.
+"""
+
+import threading
+import random
+import time
+import sys
+import os
+
+# Pull narcissus out of the checkout we live in.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import narcissus.counters
+from narcissus.counters import PAIRED
+
+import optparse
+parser = optparse.OptionParser()
+parser.add_option("-t", "--threads", dest="threads", default="1,2,4,8",
+                  help="comma separated numbers of counting threads to try.")
+parser.add_option("-m", "--messages", dest="messages", type="int",
+                  default=50000, help="hits to count in every thread.")
+parser.add_option("-p", "--poll-ms", dest="poll_ms", type="int", default=100,
+                  help="dump the counters this often.")
+options, args = parser.parse_args()
+
+COUNTRIES = ['United States', 'Germany', 'China', 'Brazil', 'France',
+             'India', 'Japan', 'Canada']
+TAGS = ['fedora', 'epel', 'ubuntu', 'debian', 'centos', 'gnu']
+
+
+class GlobalLock(object):
+    """ The consumers' counters as they were: one lock, nested dicts. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bucket = {}
+
+    def pump(self, category, key):
+        with self.lock:
+            if not category in self.bucket:
+                self.bucket[category] = {}
+            self.bucket[category][key] = self.bucket[category].get(key, 0) + 1
+
+    def pump_paired(self, cat1, cat2, key1, key2):
+        with self.lock:
+            level = self.bucket.setdefault(PAIRED, {}).setdefault(
+                cat1, {}).setdefault(cat2, {}).setdefault(key1, {})
+            level[key2] = level.get(key2, 0) + 1
+
+    def count(self, country, tag):
+        self.pump('country', country)
+        self.pump('tag', tag)
+        self.pump_paired('country', 'tag', country, tag)
+
+    def dump(self):
+        with self.lock:
+            bucket, self.bucket = self.bucket, {}
+        return sum(bucket.get('country', {}).values())
+
+
+class Sharded(object):
+    def __init__(self):
+        self.counter = narcissus.counters.ShardedCounter()
+
+    def count(self, country, tag):
+        self.counter.add([('country', country), ('tag', tag),
+                          (PAIRED, 'country', 'tag', country, tag)])
+
+    def dump(self):
+        return sum(count for key, count in self.counter.dump().iteritems()
+                   if key[0] == 'country')
+
+
+def hits():
+    return [(random.choice(COUNTRIES), random.choice(TAGS))
+            for i in range(options.messages)]
+
+
+def bench(counters, n_threads):
+    samples = [hits() for i in range(n_threads)]
+
+    def count(sample):
+        for country, tag in sample:
+            counters.count(country, tag)
+
+    threads = [threading.Thread(target=count, args=(sample,))
+               for sample in samples]
+
+    counted = [0]
+    running = [True]
+
+    def poll():
+        while running[0]:
+            time.sleep(options.poll_ms / 1000.0)
+            counted[0] += counters.dump()
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    running[0] = False
+    poller.join()
+    counted[0] += counters.dump()
+
+    total = n_threads * options.messages
+    print "  %-12s %2i threads %10.0f hits/sec %s" % (
+        type(counters).__name__, n_threads, total / elapsed,
+        "" if counted[0] == total else "(lost %i!)" % (total - counted[0]))
+
+
+for n_threads in map(int, options.threads.split(',')):
+    for counters in [GlobalLock(), Sharded()]:
+        bench(counters, n_threads)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+""" Micro-benchmark the access log parsers in narcissus.parsers.
+
+Run it against a real log sample, on one core::
+
+    $ tail -n 100000 /var/log/lighttpd/access.log > sample.log
+    $ ./bench-parsers.py sample.log
+
+First, every registered log format (and ``auto`` detection) is run over the
+sample.  Formats the sample isn't written in show what it costs to turn a line
+down, which is what ``auto`` pays while it makes up its mind.  Pass --format
+to try an Apache LogFormat string of your own as well.
+
+If the sample is httpd-light's format, we go on to compare LIGHTTPD_RE with
+the regex it replaced, whose greedy ``"(.+)"`` user agent group backtracks.
+For each we report lines per second per core.  The sample is run three ways:
+as is, with every user agent padded out to --agent-length characters, and
+padded with junk tacked on the end of every line so nothing matches.  That
+last one is where backtracking really hurts.
+
+Last come the user agent digests behind each record's 'refererhash', with and
+without the memo in front of them.
+"""
+
+import time
+import sys
+import os
+import re
+
+# Pull narcissus out of the checkout we live in.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import narcissus.parsers as parsers
+
+import optparse
+parser = optparse.OptionParser(usage="%prog [options] SAMPLE_LOG")
+parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                  help="take the best of this many runs.")
+parser.add_option("-a", "--agent-length", dest="agent_length", type="int",
+                  default=8000,
+                  help="pad user agents out to this long for the second run.")
+parser.add_option("-F", "--format", dest="formats", action="append",
+                  default=[],
+                  help="also bench this log format (may be repeated).")
+options, args = parser.parse_args()
+
+if len(args) != 1:
+    parser.error("give me a log sample to parse")
+
+with open(args[0]) as f:
+    sample = f.readlines()
+
+
+# What LIGHTTPD_RE used to be.
+GREEDY_RE = re.compile('^(\d+\.\d+\.\d+\.\d+)\s(\S+)\s(\S+)\s\[(\S+\s\S+)\]\s"(\S+)\s(\S+)\s(\S+)"\s(\d+)\s(\d+)\s"(\S+)"\s"(.+)"\s(\d+)\s(\d+)$')
+
+
+def long_agent(line):
+    fields = parsers.parse_fields(line)
+    if not fields:
+        return line
+    agent = (fields[10] + ' ') * (options.agent_length / (len(fields[10]) + 1))
+    return line.replace('"%s"' % fields[10], '"%s"' % agent.strip())
+
+
+def junk(line):
+    return line.rstrip('\n') + ' junk\n'
+
+
+def bench(name, parse, lines):
+    best = None
+    for i in range(options.repeat):
+        start = time.time()
+        for line in lines:
+            parse(line)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print "  %-34s %10.0f lines/sec/core" % (name, len(lines) / best)
+
+
+detector = parsers.get_format('auto')
+for line in sample[:detector.sample]:
+    detector.parse(line)
+print "sample looks like %s" % (detector.chosen and detector.chosen.name)
+
+formats = [parsers.log_formats[name] for name in parsers.format_order]
+for spec in options.formats:
+    try:
+        formats.append(parsers.get_format(spec))
+    except ValueError as e:
+        parser.error(str(e))
+
+for log_format in formats:
+    parsed = len(filter(None, map(log_format.parse, sample)))
+    bench("%s (%i parsed)" % (log_format.name, parsed), log_format.parse,
+          sample)
+
+bench("auto", parsers.get_format('auto').parse, sample)
+print
+
+if detector.chosen is not parsers.log_formats['lighttpd']:
+    sys.exit(0)
+
+for title, lines in [("sample", sample),
+                     ("long user agents", map(long_agent, sample)),
+                     ("long and unparseable",
+                      map(junk, map(long_agent, sample)))]:
+    failures = len([line for line in lines if not parsers.parse_fields(line)])
+    print "%s: %i lines, %i unparseable" % (title, len(lines), failures)
+
+    bench("greedy regex (before)", GREEDY_RE.match, lines)
+    bench("LIGHTTPD_RE", parsers.LIGHTTPD_RE.match, lines)
+    bench("parse_line (whole hit record)", parsers.parse_line, lines)
+    print
+
+agents = [fields[10] for fields in map(parsers.parse_fields, sample) if fields]
+print "user agent digests: %i agents, %i different" % (
+    len(agents), len(set(agents)))
+for name in sorted(parsers.DIGESTS):
+    bench("%s" % name, parsers.DIGESTS[name], agents)
+    digester = parsers.Digester(name)
+    bench("%s, memoized" % name, digester, agents)
+    print "  %-34s %9.1f%%" % ("memo hit rate",
+                               100 * digester.stats()['hit_rate'])
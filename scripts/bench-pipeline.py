@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+""" Benchmark the hub's consumer chain in-process with narcissus.loopback.
+
+No qpid, moksha-hub, orbited or paster needed -- just the python libraries
+narcissus itself imports (and GeoLiteCity.dat)::
+
+    $ ./bench-pipeline.py --entry=httpdlight --sample=access.log \\
+        --messages=50000 --batch-lines=100
+
+Prints overall throughput and, for every stage, how many messages it handled,
+its service time and how long messages sat in the queue before it got them.
+
+Compare against --workers=N to see what a pool of parse/geolocate worker
+processes buys (the entry stage then only times handing lines over).
+"""
+
+import random
+import time
+import sys
+import os
+
+# Pull narcissus out of the checkout we live in.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import narcissus.loopback
+import narcissus.geo
+import narcissus.parsers
+import narcissus.wire
+
+import simplejson
+
+import optparse
+parser = optparse.OptionParser()
+parser.add_option("-e", "--entry", dest="entry", default="rawip",
+                  help="where hits enter the pipeline: %s." % ", ".join(
+                      sorted(narcissus.loopback.entry_points)))
+parser.add_option("-s", "--sample", dest="sample", default=None,
+                  help="access log to take lines from (default: made up).")
+parser.add_option("-m", "--messages", dest="messages", type="int",
+                  default=10000,
+                  help="how many hits to push through.")
+parser.add_option("-n", "--batch-lines", dest="batch_lines", type="int",
+                  default=1,
+                  help="lines per message for httpdlight and preparsed.")
+parser.add_option("-p", "--poll-every", dest="poll_every", type="float",
+                  default=None,
+                  help="poll the TimeSeriesProducer every this many seconds "
+                  "(default: its own frequency).")
+parser.add_option("-r", "--rrd", dest="rrd", action="store_true",
+                  help="really log to rrdtool (slow!).")
+parser.add_option("-w", "--workers", dest="workers", type="int", default=0,
+                  help="parse and geolocate in this many worker processes.")
+parser.add_option("-b", "--worker-batch", dest="worker_batch", type="int",
+                  default=500,
+                  help="hits per batch handed to a worker.")
+parser.add_option("-u", "--unordered", dest="unordered", action="store_true",
+                  help="let workers publish batches out of order.")
+parser.add_option("-U", "--uniques", dest="uniques", action="store_true",
+                  help="count unique clients per key too.")
+options, args = parser.parse_args()
+
+if options.entry not in narcissus.loopback.entry_points:
+    parser.error("unknown entry point %r" % options.entry)
+
+
+def sample_lines():
+    if options.sample:
+        with open(options.sample) as f:
+            lines = [line for line in f if narcissus.parsers.parse_line(line)]
+    else:
+        lines = [
+            '%i.%i.%i.%i mirror.rit.edu - [15/Apr/2011:13:37:00 -0400] '
+            '"GET /%s/foo-%i.rpm HTTP/1.1" 200 %i "-" '
+            '"urlgrabber/3.9.1 yum/3.2.29" 312 %i\n' % (
+                random.randint(1, 223), random.randint(0, 255),
+                random.randint(0, 255), random.randint(1, 254),
+                random.choice(['fedora', 'ubuntu', 'centos', 'debian']),
+                i, random.randint(0, 10**7), random.randint(0, 10**7))
+            for i in range(1000)
+        ]
+    return (lines * (options.messages / len(lines) + 1))[:options.messages]
+
+
+def inputs(lines):
+    """ Return (topic, message, jsonify) tuples, as they'd reach the hub """
+    if options.entry == 'rawip':
+        # Just like the RandomIPProducer makes them.
+        topic = narcissus.loopback.entry_points['rawip'].topic
+        return [(topic, simplejson.dumps(dict(
+            (key, record[key]) for key in ['ip', 'tag', 'statuscode'])), True)
+            for record in map(narcissus.parsers.parse_line, lines)]
+
+    if options.entry == 'preparsed':
+        # The parsing happened at the edge, so it doesn't count here.
+        lines = [narcissus.parsers.pack_record(
+            narcissus.parsers.parse_line(line)) for line in lines]
+
+    topic = narcissus.loopback.entry_points[options.entry].topic
+    if options.batch_lines == 1 and options.entry == 'httpdlight':
+        return [(topic, line, False) for line in lines]
+
+    return [(topic, narcissus.wire.pack(lines[i:i + options.batch_lines]),
+             False) for i in range(0, len(lines), options.batch_lines)]
+
+
+config = {
+    'narcissus.workers': options.workers,
+    'narcissus.workers.ordered': not options.unordered,
+    'narcissus.workers.batch_lines': options.worker_batch,
+    'narcissus.timeseries.uniques': bool(options.uniques),
+}
+hub, producer = narcissus.loopback.build_pipeline(options.entry, config,
+                                                   rrd=options.rrd)
+poll_every = options.poll_every or producer.frequency.seconds
+
+lines = sample_lines()
+messages = inputs(lines)
+print "Pushing %i hits in %i messages through %s" % (
+    len(lines), len(messages), options.entry)
+
+start = last_poll = time.time()
+for topic, message, jsonify in messages:
+    hub.send_message(topic, message, jsonify=jsonify)
+    hub.pump()
+
+    if time.time() - last_poll >= poll_every:
+        hub.poll(producer)
+        last_poll = time.time()
+
+hub.drain()
+hub.poll(producer)
+elapsed = time.time() - start
+hub.close()
+
+print "%.0f hits/sec (%i hits in %.2fs)" % (
+    len(lines) / elapsed, len(lines), elapsed)
+print
+print hub.report()
+
+# The workers each have a cache of their own, which we can't see from here.
+stats = narcissus.geo.locator().stats()
+if stats and not options.workers:
+    print
+    print ("geo cache: %(hits)i hits, %(misses)i misses, %(evictions)i "
+           "evictions, " % stats) + "%.1f%% hit rate" % (
+               100 * stats['hit_rate'])
+
+stats = narcissus.geo.locator().negative_stats()
+if stats and not options.workers:
+    print ("unresolved: %(reserved)i reserved ips turned away, %(hits)i "
+           "unknown ips answered from the negative cache" % stats)
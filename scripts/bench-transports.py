@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+""" Compare lines per second through amqp-log-sender.py over AMQP and zmq.
+
+For each transport we start a receiver, run the real sender as a subprocess,
+pipe a sample log into it and time how long it takes for every line to come
+out the other side::
+
+    $ ./bench-transports.py --sample=/var/log/lighttpd/access.log \\
+        --lines=200000 --batch-lines=500
+
+The AMQP leg needs a qpid broker (--amqp-target), the zmq leg needs nothing
+but pyzmq.  Any transport whose library is missing is skipped.
+"""
+
+import subprocess
+import threading
+import random
+import time
+import sys
+import os
+
+# Pull the wire format helpers out of the narcissus checkout we live in.
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+import narcissus.wire
+
+import optparse
+parser = optparse.OptionParser()
+parser.add_option("-s", "--sample", dest="sample", default=None,
+                  help="log file to replay (default: made up lines).")
+parser.add_option("-l", "--lines", dest="lines", type="int", default=100000,
+                  help="how many lines to push through each transport.")
+parser.add_option("-n", "--batch-lines", dest="batch_lines", type="int",
+                  default=1,
+                  help="passed on to the sender.")
+parser.add_option("-z", "--compress", dest="compress", action="store_true",
+                  help="passed on to the sender.")
+parser.add_option("-a", "--amqp-target", dest="amqp_target",
+                  default="localhost",
+                  help="qpid broker for the AMQP leg.")
+parser.add_option("-e", "--zmq-endpoint", dest="zmq_endpoint",
+                  default="tcp://127.0.0.1:6543",
+                  help="endpoint for the zmq leg.")
+parser.add_option("-p", "--topic", dest="topic",
+                  default="httpdlight_http_rawlogs",
+                  help="topic to send on.")
+parser.add_option("-t", "--timeout", dest="timeout", type="int", default=60,
+                  help="give up on a transport after this many seconds.")
+options, args = parser.parse_args()
+
+
+def sample_lines():
+    """ Return `options.lines` log lines, from the sample or made up """
+    if options.sample:
+        with open(options.sample) as f:
+            lines = f.readlines()
+    else:
+        lines = [
+            '%i.%i.%i.%i mirror.rit.edu - [15/Apr/2011:13:37:00 -0400] '
+            '"GET /fedora/linux/updates/14/x86_64/foo-%i.rpm HTTP/1.1" 200 '
+            '%i "-" "urlgrabber/3.9.1 yum/3.2.29" 312 %i\n' % (
+                random.randint(1, 254), random.randint(0, 255),
+                random.randint(0, 255), random.randint(1, 254),
+                i, random.randint(0, 10**7), random.randint(0, 10**7))
+            for i in range(1000)
+        ]
+    return (lines * (options.lines / len(lines) + 1))[:options.lines]
+
+
+class Receiver(threading.Thread):
+    """ Counts the log lines that make it to the other side. """
+
+    def __init__(self, expected):
+        super(Receiver, self).__init__()
+        self.daemon = True
+        self.expected = expected
+        self.count = 0
+        self.finished = None
+        self.ready = threading.Event()
+
+    def tally(self, body):
+        self.count += len(narcissus.wire.unpack(body))
+        if self.count >= self.expected and self.finished is None:
+            self.finished = time.time()
+
+
+class AMQPReceiver(Receiver):
+    def run(self):
+        from qpid.connection import Connection
+        from qpid.datatypes import uuid4
+        from qpid.util import connect
+
+        socket = connect(options.amqp_target, 5672)
+        connection = Connection(socket, username='guest', password='guest')
+        connection.start(timeout=10000)
+        session = connection.session(str(uuid4()))
+
+        queue = 'bench-' + str(uuid4())
+        session.queue_declare(queue=queue, exclusive=True, auto_delete=True)
+        session.exchange_bind(exchange='amq.topic', queue=queue,
+                              binding_key=options.topic)
+        session.message_subscribe(queue=queue, destination='bench')
+        incoming = session.incoming('bench')
+        incoming.start()
+        self.ready.set()
+
+        while self.finished is None:
+            self.tally(incoming.get(timeout=options.timeout).body)
+
+        connection.close()
+
+
+class ZMQReceiver(Receiver):
+    def run(self):
+        import zmq
+
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, options.topic)
+        if hasattr(zmq, 'RCVHWM'):
+            # Queue everything on our side rather than drop past 1000.
+            socket.setsockopt(zmq.RCVHWM, 0)
+        socket.connect(options.zmq_endpoint)
+        self.ready.set()
+
+        while self.finished is None:
+            topic, body = socket.recv_multipart()
+            self.tally(body)
+
+        socket.close()
+
+
+def bench(transport, target, receiver_class, lines):
+    receiver = receiver_class(len(lines))
+    receiver.start()
+    receiver.ready.wait(options.timeout)
+
+    command = [
+        sys.executable, os.path.join(here, 'amqp-log-sender.py'),
+        '--transport=' + transport,
+        '--targets=' + target + ':block',
+        '--topic=' + options.topic,
+        '--batch-lines=%i' % options.batch_lines,
+        '--stats-interval=0',
+    ]
+    if options.compress:
+        command.append('--compress')
+
+    devnull = open(os.devnull, 'w')
+    sender = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=devnull)
+
+    # The sender connects (or binds) as soon as it starts; give that, and
+    # the zmq subscriber joining, a moment before the clock starts.
+    time.sleep(2)
+
+    start = time.time()
+    sender.stdin.write(''.join(lines))
+    sender.stdin.close()
+    receiver.join(options.timeout)
+    sender.wait()
+
+    if receiver.finished is None:
+        print "%-5s timed out after %i of %i lines" % (
+            transport, receiver.count, len(lines))
+        return
+
+    elapsed = receiver.finished - start
+    print "%-5s %10.0f lines/sec  (%i lines in %.2fs)" % (
+        transport, len(lines) / elapsed, len(lines), elapsed)
+
+
+lines = sample_lines()
+print "Pushing %i lines, %i per message" % (len(lines), options.batch_lines)
+
+try:
+    import qpid
+    bench('amqp', options.amqp_target, AMQPReceiver, lines)
+except ImportError:
+    print "amqp  skipped (no python-qpid)"
+
+try:
+    import zmq
+    bench('zmq', options.zmq_endpoint.replace('127.0.0.1', '*'),
+          ZMQReceiver, lines)
+except ImportError:
+    print "zmq   skipped (no pyzmq)"
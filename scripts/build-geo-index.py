@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+""" Compile GeoLiteCity.dat into a range index for bulk geolocation
+
+    $ ./build-geo-index.py GeoLiteCity.dat GeoLiteCity.idx
+
+Then copy GeoLiteCity.idx over to the hub and set `narcissus.geoip.index` in
+its config.  Build it again whenever the database is updated.
+
+With --countries, the index only knows countries, and places every hit at its
+country's centroid.  That's much smaller; use it with
+`narcissus.geoip.resolution = country`.  The centroids are worked out from
+the database, but --centroids can name a CSV file of better ones::
+
+    United States,39.83,-98.58
+
+With --bench, a sample access log's client ips are looked up both ways --
+one at a time through pygeoip, and all at once through the index -- and both
+rates are reported, along with how many answers differ.
+"""
+
+import time
+import csv
+import sys
+import os
+
+# Pull narcissus out of the checkout we live in.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import narcissus.geoindex
+import narcissus.parsers
+import narcissus.geo
+
+import optparse
+parser = optparse.OptionParser(usage="%prog [options] DATABASE INDEX")
+parser.add_option("-b", "--bench", dest="bench", default=None,
+                  help="compare lookups on the client ips of this log.")
+parser.add_option("-F", "--format", dest="format", default="auto",
+                  help="log format of the --bench sample (default: auto).")
+parser.add_option("-c", "--countries", dest="countries", action="store_true",
+                  default=False, help="only index countries, at centroids.")
+parser.add_option("-C", "--centroids", dest="centroids", default=None,
+                  help="CSV of country,lat,lon to use with --countries.")
+options, args = parser.parse_args()
+
+if len(args) != 2:
+    parser.error("give me a GeoIP City database and where to put the index")
+
+database, output = args
+locator = narcissus.geo.Locator(database, 'memory', cache_size=0,
+                                negative_cache_size=0)
+
+start = time.time()
+with open(database, 'rb') as f:
+    data = f.read()
+try:
+    index = narcissus.geoindex.RangeIndex.compile(data, locator.gi)
+except ValueError as e:
+    parser.error(str(e))
+
+if options.countries:
+    centroids = {}
+    if options.centroids:
+        with open(options.centroids) as f:
+            for row in csv.reader(f):
+                centroids[row[0]] = (float(row[1]), float(row[2]))
+    index = index.countries_only(centroids)
+
+index.save(output)
+print >> sys.stderr, "Indexed %i ranges in %i countries in %.1fs (%s)" % (
+    len(index), len(index.names), time.time() - start,
+    narcissus.geoindex.numpy and "numpy" or "no numpy")
+
+if not options.bench:
+    sys.exit(0)
+
+try:
+    log_format = narcissus.parsers.get_format(options.format)
+except ValueError as e:
+    parser.error(str(e))
+
+with open(options.bench) as f:
+    hits = filter(None, map(log_format.parse, f))
+ips = [hit['ip'] for hit in hits]
+index = narcissus.geoindex.RangeIndex.load(output)
+
+start = time.time()
+one_by_one = map(locator.lookup, ips)
+elapsed = time.time() - start
+print "  %-20s %10.0f ips/sec" % ("pygeoip", len(ips) / elapsed)
+
+start = time.time()
+map(index.lookup, ips)
+elapsed = time.time() - start
+print "  %-20s %10.0f ips/sec" % ("range index, singly", len(ips) / elapsed)
+
+start = time.time()
+all_at_once = index.lookup_many(ips)
+elapsed = time.time() - start
+print "  %-20s %10.0f ips/sec" % ("range index, bulk", len(ips) / elapsed)
+
+
+def differ(a, b):
+    # The index keeps coordinates to GeoIP's four places, no more, and a
+    # country index only has the one place per country.
+    if a is None or b is None:
+        return a is not b
+    if options.countries:
+        return a[2] != b[2]
+    return a[2] != b[2] or abs(a[0] - b[0]) > 1e-3 or abs(a[1] - b[1]) > 1e-3
+
+print "  %i ips, %i answered differently" % (
+    len(ips), len([1 for a, b in zip(one_by_one, all_at_once) if differ(a, b)]))
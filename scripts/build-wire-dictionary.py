@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+""" Build a compression dictionary for amqp-log-sender.py --dictionary
+
+Feed it a decent sample of the access log you'll be sending::
+
+    $ tail -n 100000 /var/log/lighttpd/access.log | \
+        ./build-wire-dictionary.py > mirror.dict
+
+Then copy mirror.dict over to the hub and list it under
+`narcissus.wire.dictionaries` in its config.
+"""
+
+import sys
+import os
+
+# Pull the wire format helpers out of the narcissus checkout we live in.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import narcissus.wire
+
+import optparse
+parser = optparse.OptionParser()
+parser.add_option("-s", "--size", dest="size", type="int", default=16384,
+                  help="maximum size of the dictionary in bytes.")
+options, args = parser.parse_args()
+
+zdict = narcissus.wire.build_dictionary(sys.stdin, options.size)
+sys.stdout.write(zdict)
+print >> sys.stderr, "Built dictionary %s (%i bytes)" % (
+    narcissus.wire.dictionary_id(zdict), len(zdict))
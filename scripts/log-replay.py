@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+""" Replay an archived access log, on schedule, for load testing narcissus.
+
+Lines are written to stdout so you can pipe them into the sender with
+whatever transport, batching and compression you want to test::
+
+    $ ./log-replay.py --speed=20 access.log-20110415.gz | \\
+        ./amqp-log-sender.py --targets=monitoring.host.org:block \\
+            --batch-lines=500
+
+With --speed the original inter-arrival pattern (bursts, lulls and all) is
+kept, just squeezed N times.  With --rate lines go out evenly at a fixed
+number of lines per second.  Every --report seconds we print to stderr how
+fast we are actually going and how far behind schedule we are; when the lag
+keeps growing, something downstream has hit its limit.
+"""
+
+import calendar
+import gzip
+import time
+import sys
+import os
+
+# Pull the log formats out of the narcissus checkout we live in.
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+from narcissus.parsers import TimestampDecoder, get_format, format_order
+
+import optparse
+parser = optparse.OptionParser(usage="%prog [options] LOGFILE [LOGFILE ...]")
+parser.add_option("-x", "--speed", dest="speed", type="float", default=None,
+                  help="replay at this many times real time.")
+parser.add_option("-r", "--rate", dest="rate", type="float", default=None,
+                  help="replay at a fixed number of lines per second.")
+parser.add_option("-l", "--loop", dest="loop", action="store_true",
+                  help="start over at the end of the last file.")
+parser.add_option("-F", "--format", dest="format", default="auto",
+                  help="log format, for the timestamps: %s, an Apache "
+                  "LogFormat string or auto (the default)." % ", ".join(
+                      format_order))
+parser.add_option("-R", "--report", dest="report", type="int", default=5,
+                  help="report progress every this many seconds (0 for "
+                  "never).")
+options, args = parser.parse_args()
+
+if not args:
+    parser.error("give me at least one log file to replay")
+
+if (options.speed is None) == (options.rate is None):
+    parser.error("pick exactly one of --speed or --rate")
+
+try:
+    log_format = get_format(options.format)
+except ValueError as e:
+    parser.error(str(e))
+
+decode_timestamp = TimestampDecoder()
+_last_stamp = (None, None)
+def timestamp(line):
+    """ Return the unix time `line` was logged at, or None """
+    global _last_stamp
+    stamp = log_format.stamp(line)
+    if not stamp:
+        return None
+
+    # Every line logged in the same second has the same stamp.
+    if stamp == _last_stamp[0]:
+        return _last_stamp[1]
+
+    try:
+        when = decode_timestamp(stamp)[0]
+    except ValueError:
+        return None
+    _last_stamp = (stamp, calendar.timegm(when.utctimetuple()))
+    return _last_stamp[1]
+
+
+def open_log(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    return open(filename)
+
+
+def lines():
+    """ Every line of every file, forever if we're looping.  Yields None
+    between passes so the schedule can start over. """
+    while True:
+        for filename in args:
+            f = open_log(filename)
+            for line in f:
+                yield line
+            f.close()
+
+        if not options.loop:
+            break
+        yield None
+
+
+# Sleeping for every single line would cost more than the writing, so we only
+# bother once we're at least this far ahead of schedule.
+min_sleep = 0.005
+
+out = sys.stdout
+began = start_wall = time.time()
+first_stamp = last_stamp = None
+sent = 0
+last_report, sent_at_report = time.time(), 0
+
+try:
+    for line in lines():
+        if line is None:
+            # Looping.  The timestamps start over, so must the schedule.
+            if options.speed:
+                start_wall, first_stamp = time.time(), None
+            continue
+
+        if options.rate:
+            due = start_wall + sent / options.rate
+        else:
+            last_stamp = timestamp(line) or last_stamp
+            if first_stamp is None:
+                first_stamp = last_stamp
+            due = start_wall + ((last_stamp or 0) -
+                                (first_stamp or 0)) / options.speed
+
+        now = time.time()
+        if due - now > min_sleep:
+            out.flush()
+            time.sleep(due - now)
+            now = time.time()
+
+        out.write(line)
+        sent += 1
+
+        if options.report and now - last_report >= options.report:
+            print >> sys.stderr, "%i lines, %.0f lines/sec, %.2fs behind" % (
+                sent, (sent - sent_at_report) / (now - last_report),
+                max(0, now - due))
+            last_report, sent_at_report = now, sent
+
+    out.flush()
+except KeyboardInterrupt:
+    pass
+except IOError:
+    # Whoever we were piping to went away.
+    pass
+
+print >> sys.stderr, "Replayed %i lines in %.2fs" % (
+    sent, time.time() - began)
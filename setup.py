@@ -90,6 +90,7 @@ setup(
         'moksha.consumer': (
             'raw_ip = narcissus.consumers:RawIPConsumer',
             'httpdlight = narcissus.consumers:HttpLightConsumer',
+            'httpdlight_parsed = narcissus.consumers:PreParsedHttpLightConsumer',
             'latlon2geo = narcissus.consumers:LatLon2GeoJsonConsumer',
             'series_con = narcissus.consumers:TimeSeriesConsumer',
         ),